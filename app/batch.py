@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+""" Headless batch runs of the estuary model from a file of scenarios.
+
+Each scenario is a set of `EstuaryModel` arguments and `run_model` settings
+(any of `sweep.RUN_KWARGS`), read from a JSON, CSV or YAML file:
+
+- JSON or YAML: a list of scenarios, or a mapping with a list of
+  `scenarios` and optional `defaults` shared by all of them;
+- CSV: one scenario per row, with a header of argument names; empty cells
+  are left at their defaults.
+
+A scenario's optional `name` names its output file (otherwise its position
+in the file is used). `tide_func` may be given as 'basic_tidal_flow', or in
+JSON/YAML as the arguments of a `tides.HarmonicTide`, e.g.
+`{"constituents": {"M2": [0.5, 0.]}}`.
+
+Scenarios are run in parallel in a pool of worker processes, and the output
+of each is written to its own file in the output directory: either NumPy
+.npz (arrays `time`, `V`, `S`, `N`, `O`, `Z` and a JSON `scenario`), or
+Parquet if pyarrow is installed. Files are written atomically, so an
+interrupted batch can be resumed by running it again: scenarios whose
+output already exists are skipped. A scenario which fails is reported and
+leaves no output, without stopping the others, and the batch then exits
+with an error. No plotting libraries are imported. From the top-level of
+the repository, run
+
+$ python -m app.batch scenarios.yaml -o results --workers 8
+
+"""
+
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+import traceback
+from argparse import ArgumentParser, RawTextHelpFormatter
+from collections import OrderedDict
+
+from numpy import savez
+
+try:
+    from .estuary import EstuaryModel, basic_tidal_flow
+    from .result import COLUMNS
+    from .sweep import imap, split_kwargs
+    from .tides import HarmonicTide, no_tidal_flow
+except ImportError:  # loaded as a top-level module
+    from estuary import EstuaryModel, basic_tidal_flow
+    from result import COLUMNS
+    from sweep import imap, split_kwargs
+    from tides import HarmonicTide, no_tidal_flow
+
+try:
+    import pyarrow  # noqa: F401, used by pandas for Parquet
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+FORMATS = ('npz', 'parquet')
+
+#: Tidal forcings which scenarios can refer to by name
+TIDE_FUNCS = dict(basic_tidal_flow=basic_tidal_flow)
+
+
+def read_scenarios(path):
+    """ Read a list of scenario dictionaries from a JSON, CSV or YAML file,
+    by its extension. """
+    ext = os.path.splitext(path)[1].lower()
+    with open(path) as f:
+        if ext == '.json':
+            data = json.load(f)
+        elif ext in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading YAML scenarios requires PyYAML")
+            data = yaml.safe_load(f)
+        elif ext == '.csv':
+            data = [dict((k, _parse_cell(v)) for k, v in row.items()
+                         if v is not None and v.strip() != '')
+                    for row in csv.DictReader(f)]
+        else:
+            raise ValueError("Unknown scenario file format '{}'; expected "
+                             ".json, .csv or .yaml".format(ext))
+
+    if isinstance(data, dict):
+        defaults = data.get('defaults', {})
+        data = [dict(defaults, **scenario)
+                for scenario in data.get('scenarios', [])]
+    return [dict(scenario) for scenario in data]
+
+
+def name_scenarios(scenarios):
+    """ File-safe, unique names for each scenario, from their `name` or
+    their position. """
+    width = len(str(max(len(scenarios) - 1, 0)))
+    names = []
+    for i, scenario in enumerate(scenarios):
+        name = scenario.get('name')
+        if name is None:
+            name = "scenario_{:0{}d}".format(i, width)
+        names.append(re.sub(r'[^A-Za-z0-9_.-]', '_', str(name)))
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise ValueError("Duplicate scenario names: {}".format(
+            ", ".join(duplicates)))
+    return names
+
+
+def make_tide(spec):
+    """ Tidal forcing for a scenario's `tide_func` setting. """
+    if spec is None or spec == 'none':
+        return no_tidal_flow
+    if isinstance(spec, dict):
+        return HarmonicTide(**spec)
+    try:
+        return TIDE_FUNCS[spec]
+    except KeyError:
+        raise ValueError("Unknown tide_func '{}'; expected one of {}".format(
+            spec, ", ".join(sorted(TIDE_FUNCS))))
+
+
+def run_scenario(job):
+    """ Run one scenario and write its output; the unit of work of the
+    worker processes. Errors are caught and returned, so that one failed
+    scenario doesn't end the batch.
+
+    Parameters
+    ----------
+    job : tuple
+        The scenario, the path of its output file, its format, and the
+        dtype to store the output as unless the scenario sets its own
+
+    Returns
+    -------
+    path : str
+        The output file of the scenario
+    error : str or None
+        Traceback of the error if the scenario failed, in which case no
+        output was written
+
+    """
+
+    scenario, path, fmt, dtype = job
+    try:
+        _write_scenario(scenario, path, fmt, dtype)
+    except Exception:
+        return path, traceback.format_exc()
+    return path, None
+
+
+def _write_scenario(scenario, path, fmt, dtype):
+    """ Run a scenario and atomically write its output to `path`. """
+    kwargs = dict((k, v) for k, v in scenario.items() if k != 'name')
+    model_kwargs, run_kwargs = split_kwargs(kwargs)
+    model_kwargs['tide_func'] = make_tide(model_kwargs.get('tide_func'))
+    run_kwargs.setdefault('dtype', dtype)
+    run_kwargs['as_frame'] = False
+
+    result = EstuaryModel(**model_kwargs).run_model(**run_kwargs)
+
+    # Write to a temporary file first, so that only complete outputs are
+    # found when resuming
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp",
+                                    dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if fmt == 'parquet':
+                result.to_frame().to_parquet(f)
+            else:
+                arrays = dict((c, result[c]) for c in COLUMNS)
+                savez(f, time=result.time, scenario=json.dumps(scenario),
+                      **arrays)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def run_batch(scenarios, output_dir, fmt='npz', dtype='float64',
+              max_workers=None, overwrite=False, progress=None):
+    """ Run every scenario whose output doesn't exist yet.
+
+    Parameters
+    ----------
+    scenarios : list of dicts
+        See `read_scenarios`
+    output_dir : str
+        Directory to write the outputs to; created if needed
+    fmt : str
+        Output format, one of `FORMATS`
+    dtype : str
+        Floating-point type to store the output as
+    max_workers : int, optional
+        Number of worker processes; defaults to the number of CPUs. If 1,
+        the scenarios are run serially in this process.
+    overwrite : bool
+        Re-run scenarios whose output already exists
+    progress : function, optional
+        Called as `progress(n_done, n_total, path, error)` as each run
+        finishes, where `error` is None unless the run failed
+
+    Returns
+    -------
+    paths : list of str
+        Output file of each scenario, in order
+    failures : OrderedDict
+        Traceback of the error of each scenario which failed this time, by
+        its output file
+
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format '{}'; expected one of {}".format(
+            fmt, ", ".join(FORMATS)))
+    if fmt == 'parquet' and not HAS_PARQUET:
+        raise ImportError("Parquet output requires pyarrow")
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    paths = [os.path.join(output_dir, name + "." + fmt)
+             for name in name_scenarios(scenarios)]
+    jobs = [(scenario, path, fmt, dtype)
+            for scenario, path in zip(scenarios, paths)
+            if overwrite or not os.path.exists(path)]
+
+    failures = OrderedDict()
+    for n_done, (path, error) in enumerate(
+            imap(run_scenario, jobs, max_workers), 1):
+        if error is not None:
+            failures[path] = error
+        if progress is not None:
+            progress(n_done, len(jobs), path, error)
+    return paths, failures
+
+
+def _parse_cell(value):
+    """ Parse a CSV cell as a number or boolean where possible. """
+    value = value.strip()
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument("scenarios", type=str,
+                        help="JSON, CSV or YAML file of scenarios")
+    parser.add_argument("-o", "--output", type=str, default="results",
+                        help="Directory to write the outputs to")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Number of worker processes (default: one "
+                             "per CPU)")
+    parser.add_argument("--format", choices=FORMATS, default='npz',
+                        help="Output file format")
+    parser.add_argument("--dtype", choices=['float64', 'float32'],
+                        default='float64', help="Precision of the output")
+    parser.add_argument("--overwrite", action='store_true',
+                        help="Re-run scenarios whose output exists")
+    args = parser.parse_args()
+    if args.format == 'parquet' and not HAS_PARQUET:
+        parser.error("Parquet output requires pyarrow")
+
+    scenarios = read_scenarios(args.scenarios)
+    n_todo = len(scenarios)
+    if not args.overwrite:
+        n_todo = sum(not os.path.exists(os.path.join(
+            args.output, name + "." + args.format))
+            for name in name_scenarios(scenarios))
+    print("Running {:d} of {:d} scenarios into {}".format(
+        n_todo, len(scenarios), args.output))
+
+    def _progress(n_done, n_total, path, error):
+        print("   {:d}/{:d} {}{}".format(n_done, n_total, path,
+                                        "" if error is None else " FAILED"))
+        sys.stdout.flush()
+
+    _, failures = run_batch(scenarios, args.output, fmt=args.format,
+                            dtype=args.dtype, max_workers=args.workers,
+                            overwrite=args.overwrite, progress=_progress)
+    if failures:
+        for path, error in failures.items():
+            sys.stderr.write("\n{} failed:\n{}".format(path, error))
+        sys.stderr.write("\n{:d} of {:d} scenarios failed\n".format(
+            len(failures), n_todo))
+        sys.exit(1)
+    print("Done")
@@ -0,0 +1,220 @@
+""" In-memory caching of model results.
+
+The app's sliders move in discrete steps, so many users end up requesting
+exactly the same model runs. Since the Bokeh server re-executes `main.py`
+for every session but imports this module only once, a cache created here
+is shared by every session in the server process. To share runs between
+server processes as well, set ESTUARY_SHARED_CACHE to a directory: the
+in-memory cache is then backed by a `sharedcache.SharedResultCache` there.
+
+"""
+
+import os
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    from .keys import make_key, normalize  # noqa: F401
+    from .sharedcache import SharedResultCache
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from keys import make_key, normalize  # noqa: F401
+    from sharedcache import SharedResultCache
+
+
+def result_nbytes(result):
+    """ Approximate in-memory size of a model result, in bytes. """
+    if hasattr(result, 'memory_usage'):
+        return int(result.memory_usage(index=True).sum())
+    return int(getattr(result, 'nbytes', 0))
+
+
+class ResultCache(object):
+
+    """ Bounded, thread-safe LRU cache of model results.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Approximate cap on the total memory held by cached results. The
+        least recently used results are evicted to stay under it.
+    max_entries : int, optional
+        Cap on the number of cached results, if any
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of lookups which did and didn't find a cached result
+
+    """
+
+    def __init__(self, max_bytes=256*1024**2, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, default=None):
+        """ Look up `key`, marking it as most recently used. """
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        """ Store `result` under `key`, evicting old results as needed.
+        Results larger than the whole cache are not stored. """
+        nbytes = result_nbytes(result)
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (result, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+
+    def get_or_run(self, key, func, *args, **kwargs):
+        """ Return the result cached under `key`, or compute it by calling
+        `func(*args, **kwargs)` and cache it. """
+        result = self.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """ Dictionary summarizing the cache usage and hit rate. """
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    hit_rate=(self.hits/lookups if lookups else 0.),
+                    entries=len(self._entries), nbytes=self._nbytes,
+                    max_bytes=self.max_bytes)
+
+    def _evict(self):
+        while self._entries and (
+                self._nbytes > self.max_bytes or
+                (self.max_entries is not None and
+                 len(self._entries) > self.max_entries)):
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+
+
+class TieredCache(object):
+
+    """ Chain of caches searched in order, e.g. a fast in-memory cache in
+    front of a shared on-disk one. Results found in a later cache are
+    copied into the earlier ones, and new results are stored in all of
+    them.
+
+    Parameters
+    ----------
+    *caches : ResultCache or SharedResultCache
+        The caches, fastest first
+
+    """
+
+    def __init__(self, *caches):
+        self.caches = caches
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.caches[0])
+
+    def __contains__(self, key):
+        return any(key in cache for cache in self.caches)
+
+    @property
+    def nbytes(self):
+        return self.caches[0].nbytes
+
+    def get(self, key, default=None):
+        """ Look up `key` in each cache in turn. """
+        for i, cache in enumerate(self.caches):
+            result = cache.get(key)
+            if result is not None:
+                for faster in self.caches[:i]:
+                    faster.put(key, result)
+                self.hits += 1
+                return result
+        self.misses += 1
+        return default
+
+    def put(self, key, result):
+        """ Store `result` under `key` in every cache. """
+        for cache in self.caches:
+            cache.put(key, result)
+
+    def get_or_run(self, key, func, *args, **kwargs):
+        """ Return the result cached under `key`, or compute it by calling
+        `func(*args, **kwargs)` and cache it. """
+        result = self.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        for cache in self.caches:
+            cache.clear()
+
+    def stats(self):
+        """ Dictionary summarizing the hit rate overall, and the usage of
+        each cache in turn under 'tiers'. """
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    hit_rate=(self.hits/lookups if lookups else 0.),
+                    tiers=[cache.stats() for cache in self.caches])
+
+
+#: Memory cap for the app's results cache, in MB; set the environment
+#: variable ESTUARY_CACHE_MB before starting the server to override
+CACHE_MB = float(os.environ.get("ESTUARY_CACHE_MB", 256))
+
+#: Directory of a results cache shared by every server process on the
+#: machine, if any; set the environment variable ESTUARY_SHARED_CACHE to
+#: enable it
+SHARED_CACHE_DIR = os.environ.get("ESTUARY_SHARED_CACHE")
+
+#: Size cap of the shared results cache, in MB, and the time in hours
+#: after which unused runs are evicted from it; set the environment
+#: variables ESTUARY_SHARED_CACHE_MB and ESTUARY_SHARED_CACHE_HOURS to
+#: override
+SHARED_CACHE_MB = float(os.environ.get("ESTUARY_SHARED_CACHE_MB", 1024))
+SHARED_CACHE_HOURS = float(os.environ.get("ESTUARY_SHARED_CACHE_HOURS",
+                                          24*7))
+
+#: Process-wide cache of model runs requested through the app
+results_cache = ResultCache(max_bytes=int(CACHE_MB*1024**2))
+if SHARED_CACHE_DIR:
+    results_cache = TieredCache(
+        results_cache,
+        SharedResultCache(SHARED_CACHE_DIR,
+                          max_bytes=int(SHARED_CACHE_MB*1024**2),
+                          max_age=SHARED_CACHE_HOURS*3600.)
+    )
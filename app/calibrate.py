@@ -0,0 +1,342 @@
+""" Calibration of model parameters against observed time series.
+
+`Calibration` fits `G`, `P`, `river_flow_rate` and `N_river` (or any other
+scalar `EstuaryModel` arguments) to observations of S, N and/or O. Its
+objective is evaluated for whole batches of candidate parameter sets at
+once: each batch runs as one `EstuaryEnsemble`, and batches are spread
+across worker processes. Runs are cached by their parameters, so candidates
+which recur (e.g. when refitting with other weights or observations) aren't
+run again.
+
+`fit` minimizes the misfit with differential evolution, a population-based
+optimizer whose every generation is one batch of candidates. For example,
+
+>>> obs = DataFrame({'S': [...], 'O': [...]}, index=times_in_hours)
+>>> calib = Calibration(obs, base_kwargs=dict(V=1e9, S=35., N=20.,
+...                                           O=231.2))
+>>> result = calib.fit(seed=0)
+>>> result.params
+{'G': ..., 'N_river': ..., 'P': ..., 'river_flow_rate': ...}
+
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from numpy import (absolute, arange, argmin, argsort, array, asarray, clip,
+                   isfinite, isnan, searchsorted, where, zeros)
+from numpy.random import RandomState
+
+try:
+    from .cache import ResultCache, make_key
+    from .kernels import euler_times
+    from .montecarlo import run_batch
+    from .tides import forcing_fingerprint
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from cache import ResultCache, make_key
+    from kernels import euler_times
+    from montecarlo import run_batch
+    from tides import forcing_fingerprint
+
+#: Default ranges of the calibrated parameters, as on the app's sliders
+CALIBRATION_BOUNDS = OrderedDict([
+    ('G', (1., 5.)),
+    ('P', (0.5, 2.)),
+    ('river_flow_rate', (0., 0.5)),
+    ('N_river', (0., 200.)),
+])
+
+#: Observed variables which can be calibrated against, and their columns in
+#: the output of `montecarlo.run_batch`
+OBSERVABLES = OrderedDict([('S', 1), ('N', 2), ('O', 3)])
+
+#: Memory for cached calibration runs, in MB; set the environment variable
+#: ESTUARY_CALIBRATION_MB to override
+CALIBRATION_MB = float(os.environ.get("ESTUARY_CALIBRATION_MB", 128))
+
+#: Simulated S, N, O of candidate parameter sets, shared by every
+#: `Calibration` in the process
+calibration_cache = ResultCache(max_bytes=int(CALIBRATION_MB*1024**2))
+
+
+class CalibrationResult(object):
+
+    """ Outcome of `Calibration.fit`.
+
+    Attributes
+    ----------
+    params : dict
+        Best-fitting parameter values, by name
+    misfit : float
+        Misfit of the best-fitting parameters
+    n_generations : int
+        Number of generations of the optimizer
+    n_evaluations : int
+        Number of candidate parameter sets evaluated, including those found
+        in the cache
+    converged : bool
+        Whether the misfits of the population converged before reaching
+        the maximum number of generations
+    history : list of floats
+        Best misfit after each generation
+
+    """
+
+    def __init__(self, params, misfit, n_generations, n_evaluations,
+                 converged, history):
+        self.params = params
+        self.misfit = misfit
+        self.n_generations = n_generations
+        self.n_evaluations = n_evaluations
+        self.converged = converged
+        self.history = history
+
+    def __repr__(self):
+        return "CalibrationResult(misfit={:.4g}, params={{{}}})".format(
+            self.misfit, ", ".join("{}={:.4g}".format(k, self.params[k])
+                                   for k in sorted(self.params)))
+
+
+class Calibration(object):
+
+    """ Fit of model parameters to observed S, N and/or O.
+
+    Parameters
+    ----------
+    observations : DataFrame
+        Observed values, indexed by time in hours since the start of the
+        run, with any of the columns 'S', 'N' and 'O' (in the units of the
+        model output); missing values may be NaN
+    bounds : dict, optional
+        Ranges (low, high) of the parameters to fit, by name; defaults to
+        `CALIBRATION_BOUNDS`
+    base_kwargs : dict, optional
+        `EstuaryModel` arguments shared by every run; must include the
+        initial state `V`, `S`, `N`, `O`. A `tide_func` must be picklable
+        (e.g. not a lambda) to run in worker processes.
+    run_kwargs : dict, optional
+        Arguments for `EstuaryEnsemble.run_model`; `t_end` defaults to the
+        last observation time
+    weights : dict, optional
+        Weight of each observed variable in the misfit; defaults to 1
+    batch_size : int
+        Largest number of candidates run together as one ensemble
+    max_workers : int, optional
+        Number of worker processes; defaults to the number of CPUs. If 1,
+        the candidates are run serially in this process.
+    cache : ResultCache
+        Where simulated runs are kept
+
+    Attributes
+    ----------
+    names : list of str
+        Names of the fitted parameters, in the order of candidate vectors
+    n_runs : int
+        Number of candidates actually run (i.e. not found in the cache)
+
+    """
+
+    def __init__(self, observations, bounds=None, base_kwargs=None,
+                 run_kwargs=None, weights=None, batch_size=64,
+                 max_workers=None, cache=calibration_cache):
+        bounds = CALIBRATION_BOUNDS if bounds is None else bounds
+        self.names = sorted(bounds)
+        self.bounds = array([bounds[name] for name in self.names],
+                            dtype=float)
+        self.base_kwargs = dict(base_kwargs or {})
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.cache = cache
+        self.n_runs = 0
+
+        self.variables = [v for v in OBSERVABLES if v in observations]
+        if not self.variables:
+            raise ValueError("Observations must include at least one of "
+                             "{}".format(", ".join(OBSERVABLES)))
+        self.times = asarray(observations.index, dtype=float)
+        self.observed = asarray(observations[self.variables], dtype=float)
+
+        self.run_kwargs = dict(dt=1., t_spinup=48., t_end=self.times.max())
+        self.run_kwargs.update(run_kwargs or {})
+        if self.times.min() < 0 or \
+                self.times.max() > self.run_kwargs['t_end']:
+            raise ValueError("Observation times must lie within the run")
+        self._ts = euler_times(self.run_kwargs['dt'], self.run_kwargs['t_end'])
+
+        # Normalize the squared errors of each variable by its observed
+        # variance, so that the weights compare like with like
+        weights = weights or {}
+        scale = zeros(len(self.variables))
+        for j, v in enumerate(self.variables):
+            obs = self.observed[:, j]
+            var = obs[~isnan(obs)].var()
+            scale[j] = weights.get(v, 1.)/(var if var > 0 else 1.)
+        self._scale = scale
+
+    def candidates(self, params_list):
+        """ Candidate vectors for a sequence of parameter dictionaries. """
+        return array([[p[name] for name in self.names] for p in params_list],
+                     dtype=float)
+
+    def simulate(self, candidates, executor=None):
+        """ Simulated S, N and O of each candidate at the observation
+        times, with shape `(n_candidates, n_times, n_variables)`. Cached
+        runs are reused; the rest are run in batches, in `executor` if
+        given. """
+
+        candidates = asarray(candidates, dtype=float)
+        keys = [self._key(c) for c in candidates]
+        runs = [self.cache.get(key) for key in keys]
+
+        todo = [i for i, run in enumerate(runs) if run is None]
+        if todo:
+            for i, run in zip(todo, self._run(candidates[todo], executor)):
+                runs[i] = run
+                self.cache.put(keys[i], run)
+            self.n_runs += len(todo)
+
+        return self._interpolate(array(runs))
+
+    def misfit(self, candidates, executor=None):
+        """ Weighted misfit of each candidate: the sum over the observed
+        variables of the mean squared error, divided by the variance of the
+        observations of each variable and multiplied by its weight. """
+        simulated = self.simulate(candidates, executor)
+        errors = (simulated - self.observed)**2
+        observed = ~isnan(self.observed)
+        errors = where(observed, errors, 0.)
+        mse = errors.sum(axis=1)/observed.sum(axis=0)
+        total = (mse*self._scale).sum(axis=1)
+        # Runs which broke down (e.g. emptied the estuary) fit worst
+        return where(isfinite(total), total, float('inf'))
+
+    def fit(self, popsize=10, maxiter=100, tol=1e-3, atol=1e-8,
+            mutation=0.7, recombination=0.9, seed=None, progress=None):
+        """ Fit the parameters by differential evolution (DE/rand/1/bin).
+
+        Parameters
+        ----------
+        popsize : int
+            Population size, per fitted parameter
+        maxiter : int
+            Maximum number of generations
+        tol, atol : floats
+            Stop once the standard deviation of the misfits of the
+            population is below `atol` plus `tol` times their mean
+        mutation, recombination : floats
+            Differential weight and crossover probability
+        seed : int, optional
+            Seed for the optimizer, for reproducible fits
+        progress : function, optional
+            Called as `progress(generation, best_misfit)` after every
+            generation
+
+        Returns
+        -------
+        result : CalibrationResult
+
+        """
+
+        random_state = RandomState(seed)
+        n_params = len(self.names)
+        n_pop = max(popsize*n_params, 4)
+        low, high = self.bounds.T
+
+        executor = None
+        if self.max_workers != 1:
+            executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            # Work in the unit cube, with a stratified initial population
+            pop = (random_state.rand(n_pop, n_params) +
+                   array([random_state.permutation(n_pop)
+                          for _ in range(n_params)]).T)/n_pop
+            costs = self.misfit(low + pop*(high - low), executor)
+            n_evaluations = n_pop
+            history = []
+
+            converged = False
+            generation = 0
+            for generation in range(1, maxiter + 1):
+                # Three distinct other members for each member's mutant
+                order = argsort(random_state.rand(n_pop, n_pop) +
+                                2*(arange(n_pop)[:, None] == arange(n_pop)),
+                                axis=1)
+                r1, r2, r3 = order[:, 0], order[:, 1], order[:, 2]
+                mutant = clip(pop[r1] + mutation*(pop[r2] - pop[r3]), 0., 1.)
+
+                cross = random_state.rand(n_pop, n_params) < recombination
+                cross[arange(n_pop),
+                      random_state.randint(n_params, size=n_pop)] = True
+                trial = where(cross, mutant, pop)
+
+                trial_costs = self.misfit(low + trial*(high - low), executor)
+                n_evaluations += n_pop
+                better = trial_costs <= costs
+                pop[better] = trial[better]
+                costs[better] = trial_costs[better]
+
+                history.append(float(costs.min()))
+                if progress is not None:
+                    progress(generation, history[-1])
+                if isfinite(costs).all() and \
+                        costs.std() <= atol + tol*absolute(costs.mean()):
+                    converged = True
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        best = argmin(costs)
+        params = dict(zip(self.names, low + pop[best]*(high - low)))
+        return CalibrationResult(dict((k, float(v))
+                                      for k, v in params.items()),
+                                 float(costs[best]), generation,
+                                 n_evaluations, converged, history)
+
+    def _key(self, candidate):
+        # Equal forcings share runs; those which can't be recognized are
+        # keyed by identity
+        tide_func = self.base_kwargs.get('tide_func')
+        tide_key = None
+        if tide_func is not None:
+            tide_key = forcing_fingerprint(tide_func) or tide_func
+        base = dict((k, v) for k, v in self.base_kwargs.items()
+                    if k != 'tide_func')
+        return make_key('calibration', tide_key, base, self.run_kwargs,
+                        dict(zip(self.names, candidate)))
+
+    def _run(self, candidates, executor):
+        """ Run candidates in batches, returning the simulated S, N and O of
+        each at the output times. """
+        n = len(candidates)
+        n_workers = 1 if executor is None else \
+            (self.max_workers or os.cpu_count() or 1)
+        size = min(self.batch_size, -(-n // n_workers))
+        batches = [
+            (dict((name, candidates[start:start + size, j])
+                  for j, name in enumerate(self.names)),
+             self.base_kwargs, self.run_kwargs)
+            for start in range(0, n, size)
+        ]
+        if executor is None:
+            outputs = map(run_batch, batches)
+        else:
+            outputs = executor.map(run_batch, batches)
+
+        columns = list(OBSERVABLES.values())
+        runs = []
+        for _, output in outputs:
+            runs.extend(member[:, columns] for member in output)
+        return runs
+
+    def _interpolate(self, ys):
+        """ Linearly interpolate the simulated S, N, O `ys` (with shape
+        `(n_candidates, n_times, 3)`) onto the observation times. """
+        ts = self._ts
+        right = clip(searchsorted(ts, self.times), 1, len(ts) - 1)
+        left = right - 1
+        w = ((self.times - ts[left])/(ts[right] - ts[left]))[:, None]
+        columns = [list(OBSERVABLES).index(v) for v in self.variables]
+        ys = ys[:, :, columns]
+        return ys[:, left]*(1. - w) + ys[:, right]*w
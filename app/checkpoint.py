@@ -0,0 +1,112 @@
+""" Checkpointing and restarting of model runs.
+
+At the end of every run, `EstuaryModel` records a `Checkpoint` of the full
+state of the integration: the model state and time, the window of N
+concentrations over the preceding 24 hours which scales productivity, and
+any internal state of the integration scheme. A run restarted from a
+checkpoint (see `EstuaryModel.run_model` and `EstuaryModel.extend`)
+continues exactly as the original run would have.
+
+Checkpoints can be saved to and loaded from disk; see also
+`spinup.spinup_checkpoint`, which caches the checkpoints reached at the end
+of common spin-up periods.
+
+"""
+
+import json
+
+from numpy import asarray, load, savez
+
+try:
+    from .keys import normalize
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from keys import normalize
+
+
+class Checkpoint(object):
+
+    """ Complete state of a model run at one of its output times.
+
+    Parameters
+    ----------
+    t : float
+        Time of the checkpoint, in hours
+    y : array
+        Model state at time `t`
+    window : dict
+        State of the rolling 24-hour average of N; see `RollingMean.state`
+    integrator : dict
+        State of the integration scheme; see `Integrator.get_state`
+    dt, t_spinup, method, options :
+        Settings of the run; see `EstuaryModel.run_model`
+    parameters : dict
+        Parameters of the model; see `EstuaryModel.parameters`
+
+    """
+
+    def __init__(self, t, y, window, integrator, dt, t_spinup, method,
+                 options, parameters):
+        self.t = float(t)
+        self.y = asarray(y, dtype=float).copy()
+        self.window = window
+        self.integrator = integrator
+        self.dt = dt
+        self.t_spinup = t_spinup
+        self.method = method
+        self.options = dict(options)
+        self.parameters = dict(parameters)
+
+    def __repr__(self):
+        return "Checkpoint(t={:g}, dt={:g}, method={!r})".format(
+            self.t, self.dt, self.method)
+
+    @property
+    def nbytes(self):
+        """ Approximate memory held by the checkpoint, in bytes. """
+        arrays = [self.y, self.window['values']] + [
+            v for v in self.integrator.values() if hasattr(v, 'nbytes')]
+        return sum(a.nbytes for a in arrays)
+
+    def matches(self, dt, t_spinup, method, options, parameters):
+        """ Whether a run with the given settings can be restarted from
+        this checkpoint; never if either tidal forcing couldn't be
+        recognized (see `tides.forcing_fingerprint`). """
+        if self.parameters.get('tide_func') is None or \
+                parameters.get('tide_func') is None:
+            return False
+        return normalize((self.dt, self.t_spinup, self.method, self.options,
+                          self.parameters)) == \
+            normalize((dt, t_spinup, method, options, parameters))
+
+    def save(self, path):
+        """ Save the checkpoint to a NumPy .npz file at `path`. """
+        arrays = dict(y=self.y, window_values=self.window['values'])
+        scalars = {}
+        for name, value in self.integrator.items():
+            if hasattr(value, 'shape'):
+                arrays['integrator_' + name] = value
+            else:
+                scalars[name] = value
+        meta = dict(
+            t=self.t, dt=self.dt, t_spinup=self.t_spinup,
+            method=self.method, options=self.options,
+            parameters=self.parameters, integrator=scalars,
+            window=dict((k, self.window[k])
+                        for k in ('pos', 'count', 'total')),
+        )
+        with open(path, 'wb') as f:
+            savez(f, meta=json.dumps(meta), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a checkpoint saved with `save`. """
+        with load(path) as data:
+            meta = json.loads(str(data['meta']))
+            window = dict(meta['window'], values=data['window_values'])
+            integrator = dict(meta['integrator'])
+            for name in data.files:
+                if name.startswith('integrator_'):
+                    integrator[name[len('integrator_'):]] = data[name]
+            return cls(meta['t'], data['y'], window, integrator,
+                       meta['dt'], meta['t_spinup'], meta['method'],
+                       meta['options'], meta['parameters'])
@@ -46,6 +46,9 @@ import flask
 from bokeh.embed import autoload_server
 from bokeh.util.string import encode_utf8
 
+from export import (FORMATS, MIMETYPES, encode, export_filename,
+                    load_results, parse_params)
+
 from argparse import ArgumentParser, RawTextHelpFormatter
 parser = ArgumentParser(description=__doc__,
                         formatter_class=RawTextHelpFormatter)
@@ -87,6 +90,35 @@ def static_proxy_(path):
     return app.send_static_file(path)
 
 
+def download(fmt):
+    """ Streams the full-resolution output of the model run with the
+    settings given as query arguments, e.g.
+
+        /estuary/data.csv?has_tide=1&river_flow_rate=0.05&N_river=100&G=3&P=1
+
+    Runs which are precomputed or cached are served without re-running the
+    model. """
+
+    if fmt not in FORMATS:
+        flask.abort(404)
+    try:
+        params = parse_params(flask.request.args)
+        chunks = encode(load_results(*params), fmt)
+    except ValueError as e:
+        return flask.Response(str(e), status=400, mimetype='text/plain')
+    except ImportError as e:
+        return flask.Response(str(e), status=501, mimetype='text/plain')
+
+    filename = export_filename(*(params + (fmt, )))
+    return flask.Response(
+        flask.stream_with_context(chunks), mimetype=MIMETYPES[fmt],
+        headers={'Content-Disposition':
+                 'attachment; filename="{}"'.format(filename)}
+    )
+
+app.add_url_rule("/estuary/data.<fmt>", view_func=download)
+
+
 if __name__ == "__main__":
 
     args = parser.parse_args()
@@ -127,5 +159,7 @@ if __name__ == "__main__":
         # send_static_file will guess the correct MIME type
         return app.send_static_file(path)
 
+    app.add_url_rule("/estuary/data.<fmt>", view_func=download)
+
     # Run the app
     app.run(port=PORT, host=HOST)
@@ -0,0 +1,125 @@
+""" Downsampling of model output for display.
+
+A run with a fine timestep can have far more points than the app's figures
+have pixels to show them, and every one of them would be sent to every
+browser. The functions here pick out a subset of the points of each series
+which preserves its visual shape at a given display resolution.
+
+"""
+
+from numpy import (absolute, arange, asarray, concatenate, linspace, lexsort,
+                   union1d)
+
+METHODS = ('minmax', 'lttb')
+
+
+def _bucket_edges(n, n_buckets):
+    """ Boundaries splitting `n` points into `n_buckets` contiguous groups of
+    (nearly) equal size. """
+    return linspace(0, n, n_buckets + 1).astype(int)
+
+
+def minmax_indices(y, n_buckets):
+    """ Indices of the minimum and maximum of `y` within each of `n_buckets`
+    equal-sized buckets, plus the first and last points. This preserves the
+    full envelope of the series, e.g. each tidal cycle's extremes. """
+    y = asarray(y)
+    n = y.size
+    if 2*n_buckets + 2 >= n:
+        return arange(n)
+
+    edges = _bucket_edges(n, n_buckets)
+    labels = edges[1:].searchsorted(arange(n), side='right')
+
+    # Sorting by bucket and then value puts each bucket's minimum first and
+    # maximum last, at the bucket's own boundaries
+    order = lexsort((y, labels))
+    lows = order[edges[:-1]]
+    highs = order[edges[1:] - 1]
+
+    return union1d(concatenate([[0, n - 1], lows]), highs)
+
+
+def lttb_indices(x, y, n_out):
+    """ Indices of `n_out` points chosen by the largest-triangle-three-
+    buckets algorithm (Steinarsson, 2013), which keeps the points
+    contributing most to the visual shape of the series. """
+    x, y = asarray(x, dtype=float), asarray(y, dtype=float)
+    n = y.size
+    if n_out >= n or n_out < 3:
+        return arange(n)
+
+    # The first and last points are always kept; the rest are divided into
+    # n_out - 2 buckets
+    edges = 1 + _bucket_edges(n - 2, n_out - 2)
+    selected = [0]
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point)
+        if i < n_out - 3:
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+
+        areas = absolute((x[a] - cx)*(y[lo:hi] - y[a]) -
+                         (x[a] - x[lo:hi])*(cy - y[a]))
+        a = lo + int(areas.argmax())
+        selected.append(a)
+    selected.append(n - 1)
+
+    return asarray(selected)
+
+
+def decimate(results, n_out, x='day', columns=('S', 'N', 'O', 'Z'),
+             method='minmax'):
+    """ Downsample model output for display.
+
+    Each of `columns` is downsampled separately to an equal share of the
+    `n_out` points, and the union of the points selected for any of them is
+    kept, so that the result still shares one x-coordinate between all its
+    series and has at most `n_out` rows (or a few per column, if more).
+
+    Parameters
+    ----------
+    results : DataFrame
+        Model output
+    n_out : int
+        Target number of points, e.g. twice the width in pixels of the
+        figures; results with fewer points are returned unchanged
+    x : str
+        Column used as the x-coordinate
+    columns : sequence of str
+        Columns which are plotted
+    method : str
+        'minmax' for the minimum/maximum envelope of each column within
+        buckets, or 'lttb' for largest-triangle-three-buckets
+
+    Returns
+    -------
+    decimated : DataFrame
+        Subset of the rows of `results`
+
+    """
+
+    if len(results) <= n_out:
+        return results
+
+    # Points per column; minmax keeps up to two per bucket plus the first
+    # and last points
+    n_col = max(n_out//len(columns), 4)
+
+    keep = arange(0)
+    for col in columns:
+        y = results[col].values
+        if method == 'minmax':
+            idx = minmax_indices(y, (n_col - 2)//2)
+        elif method == 'lttb':
+            idx = lttb_indices(results[x].values, y, n_col)
+        else:
+            raise ValueError("Unknown method '{}'; expected one of "
+                             "{}".format(method, ", ".join(METHODS)))
+        keep = union1d(keep, idx)
+
+    return results.iloc[keep]
@@ -10,12 +10,200 @@ Version: January 18, 2016
 
 """
 
-from numpy import array, ceil, mean, sin, pi, vstack
-from pandas import DataFrame, Index
+from timeit import default_timer
 
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set(style='ticks', context='talk')
+from numpy import (absolute, arange, array, asarray, ceil, column_stack,
+                   empty, inf, maximum, sin, pi, repeat, tile, where,
+                   zeros)
+from pandas import DataFrame, Index, MultiIndex
+
+try:
+    from .checkpoint import Checkpoint
+    from .integrators import make_integrator
+    from .kernels import HAS_NUMBA, euler_march, euler_times
+    from .result import ModelResult
+    from .tides import forcing_fingerprint, no_tidal_flow, repeats_every
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from checkpoint import Checkpoint
+    from integrators import make_integrator
+    from kernels import HAS_NUMBA, euler_march, euler_times
+    from result import ModelResult
+    from tides import forcing_fingerprint, no_tidal_flow, repeats_every
+
+
+class Trajectory(object):
+
+    """ Preallocated, array-backed storage for a model trajectory.
+
+    Rather than growing the output stack on every step, the storage for the
+    times and states is allocated once up front and filled in place. If a
+    run takes more steps than anticipated, the buffers are doubled in size.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of time levels to allocate storage for
+    n_vars : int or tuple of ints
+        Number of components in the model state vector, or the full shape
+        of the state array (e.g. `(n_members, 4)` for an ensemble)
+
+    Attributes
+    ----------
+    size : int
+        Number of time levels filled so far
+
+    """
+
+    def __init__(self, capacity, n_vars=4):
+        if isinstance(n_vars, int):
+            n_vars = (n_vars, )
+        self._ts = empty(capacity)
+        self._ys = empty((capacity, ) + tuple(n_vars))
+        self.size = 0
+
+    @classmethod
+    def for_run(cls, dt, t_end, n_vars=4):
+        """ Allocate a trajectory large enough for a run from 0 to `t_end`
+        with timestep `dt`, including the initial state. """
+        # Leave room for the extra step that round-off in the accumulated
+        # time can introduce.
+        capacity = int(ceil(t_end/dt)) + 2
+        return cls(capacity, n_vars)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return self._ts.shape[0]
+
+    @property
+    def ts(self):
+        """ View of the filled portion of the time levels. """
+        return self._ts[:self.size]
+
+    @property
+    def ys(self):
+        """ View of the filled portion of the states. """
+        return self._ys[:self.size]
+
+    @property
+    def last(self):
+        """ View of the most recently recorded state. """
+        return self._ys[self.size - 1]
+
+    def clear(self):
+        """ Discard the recorded time levels, keeping the storage. """
+        self.size = 0
+
+    def append(self, t, y):
+        """ Record the state `y` at time `t`. """
+        if self.size == self.capacity:
+            self._grow()
+        self._ts[self.size] = t
+        self._ys[self.size] = y
+        self.size += 1
+
+    def extend(self, ts, ys):
+        """ Record the states `ys` at the times `ts`. """
+        while self.size + len(ts) > self.capacity:
+            self._grow()
+        self._ts[self.size:self.size + len(ts)] = ts
+        self._ys[self.size:self.size + len(ts)] = ys
+        self.size += len(ts)
+
+    def _grow(self):
+        capacity = max(2*self.capacity, 1)
+        ts = empty(capacity)
+        ys = empty((capacity, ) + self._ys.shape[1:])
+        ts[:self.size] = self._ts[:self.size]
+        ys[:self.size] = self._ys[:self.size]
+        self._ts, self._ys = ts, ys
+
+
+class RollingMean(object):
+
+    """ Running average over a fixed-length window of the most recent values.
+
+    Values are kept in a ring buffer alongside their running total, so that
+    pushing a new value and reading the mean are both constant-time. To keep
+    round-off from accumulating in the running total, it is re-summed from
+    the ring buffer once every full pass through the window.
+
+    Parameters
+    ----------
+    window : int
+        Number of most recent values to average over
+    shape : tuple of ints
+        Shape of each value, if averaging arrays element-wise
+
+    """
+
+    def __init__(self, window, shape=()):
+        self.window = window
+        self._values = zeros((window, ) + tuple(shape))
+        self._pos = 0
+        self._count = 0
+        self._total = 0.
+
+    @classmethod
+    def from_state(cls, state):
+        """ Re-create a rolling mean from the output of `state`. """
+        values = asarray(state['values'], dtype=float)
+        rolling = cls(values.shape[0], values.shape[1:])
+        rolling._values[:] = values
+        rolling._pos = int(state['pos'])
+        rolling._count = int(state['count'])
+        rolling._total = state['total']
+        return rolling
+
+    def state(self):
+        """ Copy of the contents of the window, from which it can be
+        re-created exactly. """
+        return dict(values=self._values.copy(), pos=self._pos,
+                    count=self._count, total=self._total)
+
+    def __len__(self):
+        return self._count
+
+    def push(self, value):
+        """ Add `value` to the window, dropping the oldest if it is full. """
+        if self._count == self.window:
+            self._total -= self._values[self._pos]
+        else:
+            self._count += 1
+        self._values[self._pos] = value
+        self._total += value
+
+        self._pos += 1
+        if self._pos == self.window:
+            self._pos = 0
+            self._total = self._values[:self._count].sum(axis=0)
+
+    @property
+    def mean(self):
+        return self._total/self._count
+
+
+#: Number of steps from which backend='auto' runs the compiled kernel, which
+#: makes up for the seconds it takes to compile it in a fresh process
+AUTO_KERNEL_STEPS = 500000
+
+#: Ways of completing a run which has reached a periodic steady state
+STEADY_FILLS = ('tile', 'truncate')
+
+
+def cycle_converged(ys, n_period, tol, floor=(0., 0., 0.)):
+    """ Whether the concentrations S/V, N/V and O/V over the last
+    `n_period` rows of raw model states `ys` match those over the previous
+    `n_period` rows, to within `tol` relative to the largest magnitude of
+    each over the previous cycle or to `floor`, whichever is larger. The
+    floor keeps concentrations which decay towards zero (e.g. salinity
+    flushed out by the river) from never counting as converged. """
+    conc = ys[-2*n_period:, 1:]/ys[-2*n_period:, :1]
+    prev, last = conc[:n_period], conc[n_period:]
+    scale = maximum(absolute(prev).max(axis=0), absolute(floor))
+    return bool((absolute(last - prev).max(axis=0) <= tol*scale).all())
 
 
 class EstuaryModel(object):
@@ -33,7 +221,9 @@ class EstuaryModel(object):
         A function of the argument `t` (again in hours) which yields
         the mass transport due to tidal inflow and outflow in m3/hr.
         By convention, the function should return positive values for
-        inflow and negative values for outflow.
+        inflow and negative values for outflow. Forcings with a
+        `precompute` method (see `tides.TidalForcing`) are tabulated over
+        the whole run before integrating.
     river_flow_rate : float
         Fraction (preferably between 0 and 0.2) of river flow per day
         relative to estuary mean volume. Set to `0` to disable river
@@ -63,11 +253,22 @@ class EstuaryModel(object):
     has_river, has_tides : boolean
         Flags indicating whether the simulation has river flow and tides,
         respectively
+    trajectory : Trajectory
+        Raw (un-converted) state history from the most recent call to
+        `run_model`, or None if the model hasn't been run
+    converged_at : float
+        Time in hours at which the most recent call to `run_model` detected
+        a periodic steady state, or None if it didn't (see `steady_tol`)
+    checkpoint : Checkpoint
+        Full state of the integration at the end of the most recent call to
+        `run_model` or `extend`, from which it can be restarted; None if
+        the model hasn't been run, or if its output was tiled from a steady
+        state
 
     """
 
     def __init__(self, V, S, N, O,
-                 z=5., tide_func=lambda t: 0,
+                 z=5., tide_func=no_tidal_flow,
                  river_flow_rate=0.05, N_river=100., O_river=231.2,
                  S_ocean=35., N_ocean=20., O_ocean=231.2,
                  G=3., P=1.):
@@ -100,10 +301,27 @@ class EstuaryModel(object):
         self.has_river = river_flow_rate > 0
         self.has_tides = tide_func(1.15) != tide_func(1.85)
 
+        self.trajectory = None
+        self.converged_at = None
+        self.checkpoint = None
+
     def __call__(self, y, t, *args, **kwargs):
         """ Alias to call the model system of ODEs directly. """
         return self.model_ode(y, t, *args, **kwargs)
 
+    def parameters(self):
+        """ Parameters and initial state of the model, by name. The tidal
+        forcing is identified by `tides.forcing_fingerprint`, which is None
+        if it can't be. """
+        return dict(
+            V=self.V, S=self.S, N=self.N, O=self.O, z=self.z,
+            tide_func=forcing_fingerprint(self.tide_func),
+            river_flow_rate=self.river_flow_rate,
+            N_river=self.N_river, O_river=self.O_river,
+            S_ocean=self.S_ocean, N_ocean=self.N_ocean,
+            O_ocean=self.O_ocean, G=self.G, P=self.P,
+        )
+
     def estuary_ode(self, y, t, P_scale=1.0):
         """ Model system of ODEs.
 
@@ -180,66 +398,466 @@ class EstuaryModel(object):
 
         return array([dV_dt, dS_dt, dN_dt, dO_dt])
 
-    def run_model(self, dt=1., t_end=1000., t_spinup=48.):
-        """ Run the current model with a simple Euler marching algorithm
+    def run_model(self, dt=1., t_end=1000., t_spinup=48., method='euler',
+                  backend='auto', metrics=None, steady_tol=None, period=24.,
+                  fill='tile', restart=None, as_frame=True, dtype=float,
+                  **options):
+        """ Run the current model, by default with a simple Euler marching
+        algorithm
 
         Parameters
         ----------
         dt : float
-            Timestep, in hours
+            Timestep, in hours; for the adaptive integrator, this is the
+            spacing of the output times rather than of the internal steps
         t_end : float
             Cut-off time in hours to end integration/marching
         t_spinup : float
             Time in hours after which productivity will be scaled by
             daily averages of nutrient availability
+        method : str
+            Integration scheme: 'euler' (forward Euler), 'rk4' (classic
+            fourth-order Runge-Kutta) or 'dopri5' (adaptive Dormand-Prince
+            5(4) with error control)
+        backend : str
+            'numba' to run the compiled forward Euler kernel (see
+            `kernels`), 'numpy' to run the pure-NumPy integration, or 'auto'
+            to use the compiled kernel if Numba is installed, the method is
+            'euler' and the run has at least `AUTO_KERNEL_STEPS` steps
+        metrics : RunMetrics, optional
+            If given, records step counts and timings of the run; see
+            `metrics`
+        steady_tol : float, optional
+            If given, stop integrating once the run has settled into a
+            periodic steady state: when the concentrations S, N and O over
+            the last `period` hours match those over the previous `period`
+            to within this tolerance, relative to their magnitude or that
+            of the ocean concentrations (see `cycle_converged`). The
+            time at which this happened is recorded as `converged_at`, of
+            the model and of the result (in `attrs` of a DataFrame).
+        period : float
+            Period of the steady state, in hours, which must be a multiple
+            of `dt`; by default that of the productivity cycle. With tides,
+            the forcing must repeat over the same period (see
+            `tides.repeats_every`); tides with another period (such as
+            `basic_tidal_flow`) shift from one cycle to the next, so the run
+            never reaches a periodic steady state, and are rejected.
+        fill : str
+            How to complete a run which has converged: 'tile' to repeat
+            the last cycle up to `t_end`, or 'truncate' to return only the
+            output up to `converged_at`
+        restart : Checkpoint, optional
+            Continue a run from its checkpoint (e.g. the `checkpoint` of an
+            earlier run, or see `spinup.spinup_checkpoint`) rather than
+            from the initial state; the output then starts at the time of
+            the checkpoint. The checkpoint must come from a run of a model
+            with the same parameters and the same `dt`, `t_spinup`,
+            `method` and `options`, and with a tidal forcing which can be
+            recognized (see `tides.forcing_fingerprint`).
+        as_frame : bool
+            Return the output as a DataFrame; if False, return a compact
+            `ModelResult` which computes columns on demand (see `result`)
+        dtype : dtype
+            Floating-point type of the arrays of a `ModelResult`, e.g.
+            'float32' to halve its memory
+        **options :
+            Additional arguments for the integration scheme, e.g. `rtol`,
+            `atol` and `max_step` for 'dopri5'; see `integrators`
 
         Returns
         -------
-        result : DataFrame
+        result : DataFrame or ModelResult
             A DataFrame with the columns V, S, N, O corresponding to the
             components of the model state vector, indexed along time in hours.
             S, N, O are in kg/m3 and mmol/m3, and V is % of initial volume
 
         """
 
-        # Initialize output as an array
-        out_y = vstack([self.y0, ])
-        ts = [0., ]
+        if metrics is not None:
+            start = default_timer()
+            metrics.reset()
+            metrics.method = method
+
+        steady = None
+        if steady_tol is not None:
+            steady = self._steady_check(dt, t_spinup, steady_tol, period,
+                                        fill)
+        if restart is not None:
+            parameters = self.parameters()
+            if parameters['tide_func'] is None:
+                raise ValueError("Can't restart with a tidal forcing which "
+                                 "can't be recognized, such as a lambda; "
+                                 "see tides.forcing_fingerprint")
+            if not restart.matches(dt, t_spinup, method, options,
+                                   parameters):
+                raise ValueError("Can't restart from a checkpoint of a run "
+                                 "with different parameters or settings")
+
+        traj = self._integrate(dt, t_end, t_spinup, method, backend, metrics,
+                               steady, restart, options)
+
+        self.converged_at = None
+        if steady is not None:
+            ts = euler_times(dt, t_end, traj.ts[0])
+            if len(traj) < ts.size:
+                self.converged_at = float(traj.ts[-1])
+                if fill == 'tile':
+                    self._tile_cycle(traj, ts, steady[0])
+                    self.checkpoint = None
+        if metrics is not None:
+            metrics.converged_at = self.converged_at
+        self.trajectory = traj
+        result = self._output(traj, metrics, as_frame, dtype,
+                              self.converged_at)
+
+        if metrics is not None:
+            metrics.total_time = default_timer() - start
+            metrics.finish()
+
+        return result
+
+    def extend(self, t_end, backend='auto', metrics=None, as_frame=True,
+               dtype=float):
+        """ Continue the most recent run up to a later `t_end`, integrating
+        only the new interval.
+
+        Parameters
+        ----------
+        t_end : float
+            New cut-off time, in hours
+        backend, metrics, as_frame, dtype :
+            See `run_model`; the other settings are those of the most
+            recent run
+
+        Returns
+        -------
+        result : DataFrame or ModelResult
+            The complete output from time 0, as `run_model` would return
+            with the new `t_end`
+
+        """
+
+        start = self.checkpoint
+        if (start is None or self.trajectory is None or
+                self.trajectory.ts[-1] != start.t):
+            raise ValueError("There is no run to extend; call run_model "
+                             "first")
+
+        if metrics is not None:
+            started = default_timer()
+            metrics.reset()
+            metrics.method = start.method
+
+        piece = self._integrate(start.dt, t_end, start.t_spinup,
+                                start.method, backend, metrics, None, start,
+                                start.options)
+        self.trajectory.extend(piece.ts[1:], piece.ys[1:])
+        result = self._output(self.trajectory, metrics, as_frame, dtype)
+
+        if metrics is not None:
+            metrics.total_time = default_timer() - started
+            metrics.finish()
+
+        return result
+
+    def iter_model(self, dt=1., t_end=1000., t_spinup=48., chunk_hours=24.,
+                   method='euler', metrics=None, **options):
+        """ Run the current model, yielding the output in fixed-length chunks
+        as the integration proceeds.
+
+        Only one chunk of the trajectory is held in memory at a time, so this
+        is suitable for very long runs or for displaying output progressively.
+
+        Parameters
+        ----------
+        dt, t_end, t_spinup, method, metrics, **options :
+            See `run_model`; the metrics' `total_time` excludes time spent
+            outside of the model between chunks
+        chunk_hours : float
+            Length of each chunk of output, in hours
+
+        Yields
+        ------
+        result : DataFrame
+            Consecutive pieces of the DataFrame which `run_model` would
+            return; the first starts with the initial state at time 0
+
+        """
+        chunk_len = max(int(round(chunk_hours/dt)), 1)
+        if metrics is None:
+            for traj in self._march(dt, t_end, t_spinup, chunk_len, method,
+                                    **options):
+                yield self._to_frame(traj)
+            return
+
+        metrics.reset()
+        metrics.method = method
+        marching = self._march(dt, t_end, t_spinup, chunk_len, method,
+                               metrics, **options)
+        while True:
+            start = default_timer()
+            try:
+                traj = next(marching)
+            except StopIteration:
+                break
+            result = self._to_frame(traj, metrics)
+            metrics.total_time += default_timer() - start
+            yield result
+        metrics.finish()
+
+    def _integrate(self, dt, t_end, t_spinup, method, backend, metrics,
+                   steady, start, options):
+        """ Integrate the model with the compiled kernel or in pure NumPy,
+        as chosen by `backend`; returns the whole trajectory. """
+        t0 = 0. if start is None else start.t
+        if self._use_kernel(method, backend, options, (t_end - t0)/dt):
+            return self._march_compiled(dt, t_end, t_spinup, metrics, steady,
+                                        start)
+        traj, = self._march(dt, t_end, t_spinup, None, method, metrics,
+                            steady, start, **options)
+        return traj
+
+    def _initial_window(self, dt, start=None):
+        """ Rolling 24-hour average of N for the start of a run, either
+        from its initial state or restored from the `start` checkpoint. """
+        if start is not None:
+            return RollingMean.from_state(start.window)
+        window = RollingMean(int(ceil(24./dt)))
+        window.push(self.y0[2]/self.y0[0])
+        return window
+
+    def _march(self, dt, t_end, t_spinup, chunk_len=None, method='euler',
+               metrics=None, steady=None, start=None, **options):
+        """ Integrate the model, recording the state every `dt` hours.
+
+        If `chunk_len` is None, the whole trajectory is stored and yielded
+        once at the end. Otherwise, it is yielded each time `chunk_len` time
+        levels have been filled and then cleared for re-use, so it must be
+        consumed before the integration is resumed. If `metrics` is given,
+        the steps and time are recorded into it, and if it's `detailed`,
+        the model system of ODEs, rolling average and clipping are wrapped
+        to record into it too. If `steady` is given (see `_steady_check`), the
+        integration stops early once it reaches a periodic steady state;
+        this requires the whole trajectory to be stored. The integration
+        starts from the `start` checkpoint, if given, and a checkpoint of
+        its end is recorded as `self.checkpoint` unless it was chunked.
+
+        """
+
+        if start is None:
+            t0, y0 = 0., self.y0
+        else:
+            t0, y0 = start.t, start.y
+
+        # Initialize output storage up front
+        if chunk_len is None:
+            traj = Trajectory.for_run(dt, t_end - t0)
+        else:
+            traj = Trajectory(chunk_len)
+        traj.append(t0, y0)
+
+        # Track the N concentration over the last 24 hours
+        N_24hrs = window = self._initial_window(dt, start)
+
+        f = self.estuary_ode
+        if metrics is not None:
+            metrics.backend = 'numpy'
+            # The initial state isn't a step
+            metrics.n_steps = -1
+            if metrics.detailed:
+                f = metrics.wrap_rhs(f)
+                N_24hrs = metrics.wrap_window(N_24hrs)
+            resumed = default_timer()
+
+        integrator = make_integrator(method, f, y0, dt, t0, **options)
+        if start is not None:
+            integrator.set_state(start.integrator)
+        if metrics is not None and metrics.detailed:
+            integrator.clip = metrics.wrap_clip(integrator.clip)
+
+        # Length of the trajectory at the end of the next cycle to check
+        # for a steady state, if any
+        n_period, t_check, tol = steady or (0, inf, 0.)
+        ocean = (self.S_ocean, self.N_ocean, self.O_ocean)
+        next_check = 2*n_period + 1 if n_period > 0 else 0
+
+        # Tabulate the tidal forcing over the whole run, if it supports it;
+        # the half-step grid includes the RK4 stage times
+        if hasattr(self.tide_func, 'precompute'):
+            self.tide_func.precompute(t_end + dt, dt/2.)
 
         # Main integration loop
-        i, t = 1, 0.
+        t = t0
         while t < t_end:
-            # Pop last state off of stack
-            y = out_y[-1].T
+            if len(traj) == chunk_len:
+                if metrics is not None:
+                    metrics.n_steps += len(traj)
+                    metrics.integration_time += default_timer() - resumed
+                yield traj
+                traj.clear()
+                if metrics is not None:
+                    resumed = default_timer()
 
             # If we're past spin-up, then average the N concentration over
             # the last 24 hours to scale productivity
             if t > t_spinup:
-                n_24hrs = int(ceil(24./dt))
-                P_scale = \
-                    mean(out_y[-n_24hrs:, 2]/out_y[-n_24hrs:, 0])/self.N_ocean
+                P_scale = N_24hrs.mean/self.N_ocean
             else:
                 P_scale = 1.
 
-            # Euler step
+            # Step to the next output time; non-physical V, S, N, or O
+            # (where they're < 0) are corrected by the integrator
             t += dt
-            new_y = y + dt*self.estuary_ode(y, t, P_scale)
-
-            # Correct non-physical V, S, N, or O (where they're < 0)
-            new_y[new_y < 0] = 0.
+            new_y = integrator.advance(t, P_scale)
 
             # Save output onto stack
-            out_y = vstack([out_y, new_y])
-            ts.append(t)
+            traj.append(t, new_y)
+            N_24hrs.push(new_y[2]/new_y[0])
+
+            if len(traj) == next_check:
+                if t >= t_check and cycle_converged(traj.ys, n_period, tol,
+                                                    ocean):
+                    break
+                next_check += n_period
+
+        if metrics is not None:
+            metrics.n_steps += len(traj)
+            metrics.integration_time += default_timer() - resumed
+        if chunk_len is None:
+            self.checkpoint = Checkpoint(
+                t, traj.last, window.state(), integrator.get_state(), dt,
+                t_spinup, method, options, self.parameters()
+            )
+        yield traj
+
+    def _use_kernel(self, method, backend, options, n_steps):
+        """ Whether to integrate `n_steps` steps with the compiled kernel.
+        """
+        supported = (method == 'euler' and not options and
+                     type(self).estuary_ode is EstuaryModel.estuary_ode)
+        if backend == 'numpy':
+            return False
+        elif backend == 'auto':
+            return HAS_NUMBA and supported and n_steps >= AUTO_KERNEL_STEPS
+        elif backend == 'numba':
+            if not HAS_NUMBA:
+                raise ImportError("Numba is required for backend='numba'")
+            if not supported:
+                raise ValueError("The numba backend only supports "
+                                 "method='euler'")
+            return True
+        raise ValueError("Unknown backend '{}'; expected 'auto', 'numpy' or "
+                         "'numba'".format(backend))
+
+    def _steady_check(self, dt, t_spinup, steady_tol, period, fill):
+        """ Validate the steady-state options of `run_model`, returning the
+        number of steps per cycle, the time after which to start checking
+        for convergence, and the tolerance. """
+        if fill not in STEADY_FILLS:
+            raise ValueError("Unknown fill '{}'; expected one of "
+                             "{}".format(fill, ", ".join(STEADY_FILLS)))
+        n_period = int(round(period/dt))
+        if n_period < 1 or abs(n_period*dt - period) > 1e-9*period:
+            raise ValueError("The steady-state period ({} hours) must be a "
+                             "multiple of dt ({} hours)".format(period, dt))
+        if self.has_tides and not repeats_every(self.tide_func, period):
+            raise ValueError("The tidal forcing doesn't repeat every {} "
+                             "hours, so the run can't reach a periodic "
+                             "steady state; see tides.repeats_every"
+                             .format(period))
+        # Only compare cycles which are both past spin-up
+        return n_period, float(t_spinup + 2*period), float(steady_tol)
+
+    def _tile_cycle(self, traj, ts, n_period):
+        """ Fill the rest of a converged trajectory, up to the output times
+        `ts`, by repeating its last `n_period` states. """
+        n = len(traj)
+        while traj.capacity < ts.size:
+            traj._grow()
+        cycle = n - n_period + arange(ts.size - n) % n_period
+        traj._ys[n:ts.size] = traj._ys[cycle]
+        traj._ts[n:ts.size] = ts[n:]
+        traj.size = ts.size
+
+    def _march_compiled(self, dt, t_end, t_spinup, metrics=None,
+                        steady=None, start=None):
+        """ Integrate the model with the compiled forward Euler kernel,
+        from the `start` checkpoint if given. """
+        if metrics is not None:
+            started = default_timer()
+        if start is None:
+            t0, y0 = 0., self.y0
+        else:
+            t0, y0 = start.t, start.y
+        ts = euler_times(dt, t_end, t0)
+        window = self._initial_window(dt, start)
+
+        traj = Trajectory(ts.size)
+        n, window._count, window._pos, window._total = euler_march(
+            asarray(y0, dtype=float), self.tide_at(ts[1:]), ts, float(dt),
+            float(t_spinup), window._values, window._count, window._pos,
+            float(window._total), float(self.estuary_area), float(self.V0),
+            float(self.river_flow_rate), float(self.N_river),
+            float(self.O_river), float(self.S_ocean), float(self.N_ocean),
+            float(self.O_ocean), float(self.G), float(self.P), traj._ys,
+            *(steady or ())
+        )
+        traj._ts[:] = ts
+        traj.size = n
+
+        # The state of forward Euler is just the current time and state
+        t, y = traj.ts[-1], traj.last
+        self.checkpoint = Checkpoint(t, y, window.state(),
+                                     dict(y=y.copy(), t=t), dt, t_spinup,
+                                     'euler', {}, self.parameters())
+
+        if metrics is not None:
+            metrics.integration_time = default_timer() - started
+            metrics.backend = 'numba'
+            metrics.n_steps = metrics.n_rhs = n - 1
+            metrics.n_clipped = int((traj.ys[1:] == 0).any(axis=1).sum())
+            # Not separable from the rest of the compiled loop
+            metrics.ode_time = metrics.averaging_time = None
+
+        return traj
+
+    def tide_at(self, ts):
+        """ Evaluate the tidal forcing at an array of times at once. """
+        tide_func = getattr(self.tide_func, 'flow', self.tide_func)
+        try:
+            values = asarray(tide_func(ts), dtype=float)
+        except (ValueError, TypeError):
+            # Only works on scalars, e.g. by branching on `t`
+            values = None
+        if values is None or values.shape != ts.shape:
+            # Not vectorized, e.g. the default `no_tidal_flow`
+            values = array([self.tide_func(t) for t in ts], dtype=float)
+        return values
+
+    def _output(self, traj, metrics, as_frame, dtype, converged_at=None):
+        """ Shape a raw trajectory into a DataFrame or a `ModelResult`,
+        recording the time at which it converged, if any. """
+        if as_frame:
+            result = self._to_frame(traj, metrics)
+            result.attrs['converged_at'] = converged_at
+            return result
+        if metrics is not None:
+            start = default_timer()
+        result = ModelResult(traj.ts, traj.ys, self.V, self.estuary_area,
+                             dtype)
+        result.converged_at = converged_at
+        if metrics is not None:
+            metrics.frame_time += default_timer() - start
+        return result
 
-            i += 1
+    def _to_frame(self, traj, metrics=None):
+        """ Shape a raw trajectory into an output DataFrame. """
+        if metrics is not None:
+            start = default_timer()
 
-        # Shape output into DataFrame
-        out = out_y[:]
-        ts = array(ts)
-        result = DataFrame(data=out, columns=['V', 'S', 'N', 'O'],
-                           dtype=float,
-                           index=Index(ts, name='time'))
+        result = DataFrame(data=traj.ys, columns=['V', 'S', 'N', 'O'],
+                           dtype=float, copy=True,
+                           index=Index(traj.ts, name='time'))
 
         # Convert to molar concentrations
         result.S /= result.V
@@ -252,6 +870,216 @@ class EstuaryModel(object):
         # Convert volume to percentage relative to initial
         result.V = 100*(result.V - self.V)/self.V
 
+        if metrics is not None:
+            metrics.frame_time += default_timer() - start
+
+        return result
+
+
+class EstuaryEnsemble(object):
+
+    """ Batch of estuary models integrated together as NumPy arrays.
+
+    Each member is described by an `EstuaryModel`; their parameters are
+    gathered into arrays so that the system of ODEs is evaluated for every
+    member at once, and the whole ensemble is marched forward in time with a
+    single loop.
+
+    Parameters
+    ----------
+    models : sequence of EstuaryModel
+        The members of the ensemble
+
+    Attributes
+    ----------
+    y0 : array of floats
+        Initial conditions, with shape `(n_members, 4)`
+    trajectory : Trajectory
+        Raw (un-converted) state history of every member from the most recent
+        call to `run_model`, with states of shape `(n_members, 4)`
+
+    """
+
+    _params = ['V', 'V0', 'estuary_area', 'river_flow_rate',
+               'N_river', 'O_river', 'S_ocean', 'N_ocean', 'O_ocean',
+               'G', 'P']
+
+    def __init__(self, models):
+        self.models = list(models)
+        self.n_members = len(self.models)
+
+        for param in self._params:
+            setattr(self, param,
+                    array([getattr(m, param) for m in self.models],
+                          dtype=float))
+        self.y0 = array([m.y0 for m in self.models], dtype=float)
+
+        # Evaluate each distinct tidal forcing function only once per
+        # timestep, then scatter its value to the members which use it
+        self._tide_funcs = []
+        tide_index = []
+        for m in self.models:
+            if m.tide_func not in self._tide_funcs:
+                self._tide_funcs.append(m.tide_func)
+            tide_index.append(self._tide_funcs.index(m.tide_func))
+        self._tide_index = array(tide_index, dtype=int)
+
+        self.trajectory = None
+
+    @classmethod
+    def from_kwargs(cls, kwargs_list):
+        """ Build an ensemble from a sequence of `EstuaryModel` keyword
+        argument dictionaries. """
+        return cls([EstuaryModel(**kwargs) for kwargs in kwargs_list])
+
+    def __len__(self):
+        return self.n_members
+
+    def tide(self, t):
+        """ Tidal forcing for every member at time `t`. """
+        values = array([tide_func(t) for tide_func in self._tide_funcs],
+                       dtype=float)
+        return values[self._tide_index]
+
+    def estuary_ode(self, y, t, P_scale=1.0):
+        """ Model system of ODEs, evaluated for every member at once.
+
+        Parameters
+        ----------
+        y : array
+            The current state of each member, with shape `(n_members, 4)`;
+            see `EstuaryModel.estuary_ode`
+        t : float
+            The current evaluation time, in hours.
+        P_scale : float or array of floats
+            Factor to scale system productivity, either for all members or
+            for each one individually
+
+        Returns
+        -------
+        dy_dt : array
+            Derivative of the current state-time, with shape
+            `(n_members, 4)`.
+
+        """
+
+        # Un-pack current state
+        V, S, N, O = y.T
+
+        # Biological production minus respiration
+        J = P_scale*self.P*(125.*16./154.)*sin(2.*pi*(t+0.75)/24. + pi)
+
+        # Current molar concentrations
+        S = S/V
+        N = N/V
+        O = O/V
+
+        # Tidal source gradients, given direction of tide in each member
+        tidal_flow = self.estuary_area*self.tide(t)
+        inflow = tidal_flow > 0
+        tidal_S_contrib = tidal_flow*where(inflow, self.S_ocean, S)
+        tidal_N_contrib = tidal_flow*where(inflow, self.N_ocean, N)
+        tidal_O_contrib = tidal_flow*where(inflow, self.O_ocean, O)
+
+        # Compute derivative terms
+        dV_dt = tidal_flow
+
+        dS_dt = -self.river_flow_rate*self.V0*S + tidal_S_contrib
+
+        dN_dt = -J*self.estuary_area \
+              - self.river_flow_rate*self.V0*(N - self.N_river) \
+              + tidal_N_contrib
+
+        dO_dt = J*(154./16.)*self.estuary_area \
+              + (self.G/24.)*(self.O_river - O)*self.estuary_area \
+              - self.river_flow_rate*self.V0*(O - self.O_river) \
+              + tidal_O_contrib
+
+        return column_stack([dV_dt, dS_dt, dN_dt, dO_dt])
+
+    def run_model(self, dt=1., t_end=1000., t_spinup=48., as_frame=True):
+        """ Run every member with a simple Euler marching algorithm
+
+        Parameters
+        ----------
+        dt, t_end, t_spinup : floats
+            See `EstuaryModel.run_model`
+        as_frame : bool
+            Shape the output into a DataFrame; if False, return only the
+            raw `trajectory`
+
+        Returns
+        -------
+        result : DataFrame or Trajectory
+            A long-format DataFrame with the same columns as returned by
+            `EstuaryModel.run_model`, indexed by member number and time in
+            hours. The raw, stacked state history is retained in the
+            `trajectory` attribute.
+
+        """
+
+        # Initialize output storage for the whole run up front
+        traj = Trajectory.for_run(dt, t_end, n_vars=self.y0.shape)
+        traj.append(0., self.y0)
+
+        # Tabulate the tidal forcings over the whole run, if they support it
+        for tide_func in self._tide_funcs:
+            if hasattr(tide_func, 'precompute'):
+                tide_func.precompute(t_end + dt, dt)
+
+        # Track the N concentration of each member over the last 24 hours
+        N_24hrs = RollingMean(int(ceil(24./dt)), shape=(self.n_members, ))
+        N_24hrs.push(self.y0[:, 2]/self.y0[:, 0])
+
+        # Main integration loop
+        t = 0.
+        while t < t_end:
+            y = traj.last
+
+            # If we're past spin-up, then average the N concentration over
+            # the last 24 hours to scale productivity
+            if t > t_spinup:
+                P_scale = N_24hrs.mean/self.N_ocean
+            else:
+                P_scale = 1.
+
+            # Euler step
+            t += dt
+            new_y = y + dt*self.estuary_ode(y, t, P_scale)
+
+            # Correct non-physical V, S, N, or O (where they're < 0)
+            new_y[new_y < 0] = 0.
+
+            traj.append(t, new_y)
+            N_24hrs.push(new_y[:, 2]/new_y[:, 0])
+
+        self.trajectory = traj
+        if not as_frame:
+            return traj
+
+        # Shape output into a long DataFrame, member-major
+        n_times = len(traj)
+        out = traj.ys.transpose(1, 0, 2).reshape(-1, 4)
+        index = MultiIndex.from_arrays(
+            [repeat(arange(self.n_members), n_times),
+             tile(traj.ts, self.n_members)],
+            names=['member', 'time']
+        )
+        result = DataFrame(data=out, columns=['V', 'S', 'N', 'O'],
+                           dtype=float, index=index)
+
+        # Convert to molar concentrations
+        result.S /= result.V
+        result.N /= result.V
+        result.O /= result.V
+
+        # Add tidal height (meters) and convert volume to percentage relative
+        # to initial, member-by-member
+        area = repeat(self.estuary_area, n_times)
+        V_initial = repeat(self.V, n_times)
+        result['Z'] = result.V/area
+        result.V = 100*(result.V - V_initial)/V_initial
+
         return result
 
 
@@ -263,6 +1091,12 @@ def basic_tidal_flow(t):
 def quick_plot(results, aspect=4., size=3., palette='Dark2'):
     """ Make a quick 3-panel plot with the results timeseries. """
 
+    # Plotting libraries are only imported when needed, so that the model
+    # itself can be used with just numpy and pandas
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set(style='ticks', context='talk')
+
     colors = sns.cycle(sns.color_palette(palette, 3))
 
     # Compute figure size based on aspect/size
@@ -0,0 +1,140 @@
+""" Numba-compiled forward Euler kernel of the estuary model.
+
+This module requires Numba, and is only imported through
+`kernels.compiled`, which always loads it under the same module name so
+that Numba's on-disk cache of the compiled functions stays valid whether
+the app is imported as the `app` package or as top-level modules (as by
+`bokeh serve`).
+
+"""
+
+from numba import njit
+from numpy import inf, pi, sin
+
+
+@njit(cache=True, nogil=True, error_model='numpy')
+def euler_march(y0, tide, ts, dt, t_spinup, window, count, pos, total,
+                estuary_area, V0, river_flow_rate, N_river, O_river, S_ocean,
+                N_ocean, O_ocean, G, P, out, n_period=0, t_check=inf,
+                tol=0.):
+    """ Forward Euler integration of the estuary model.
+
+    Parameters
+    ----------
+    y0 : array
+        Initial model state
+    tide : array
+        Tidal forcing (rate of tidal height change) at the end of each
+        step, i.e. at `ts[1:]`
+    ts : array
+        Output times, starting from the time of `y0`
+    dt : float
+        Timestep, in hours
+    t_spinup : float
+        Time after which productivity is scaled by the 24-hour average N
+    window, count, pos, total :
+        State of the rolling 24-hour average of N/V, including `y0`; see
+        `RollingMean`. `window` is updated in place.
+    estuary_area, V0, river_flow_rate, N_river, O_river, S_ocean, N_ocean,
+    O_ocean, G, P : floats
+        Model parameters; see `EstuaryModel`
+    out : array
+        Output array for the states, with shape (len(ts), 4)
+    n_period, t_check, tol :
+        If `n_period` is positive, stop once the concentrations over the
+        last `n_period` steps match those over the previous `n_period` to
+        within `tol`, checking at the end of every such cycle after
+        `t_check`, relative to at least the ocean concentrations; see
+        `estuary.cycle_converged`
+
+    Returns
+    -------
+    n : int
+        Number of rows of `out` which were filled; less than `len(ts)` if
+        the run was stopped at a steady state
+    count, pos, total :
+        Final state of the rolling average
+
+    """
+
+    n_window = window.size
+    out[0, :] = y0
+    next_check = 2*n_period + 1 if n_period > 0 else 0
+
+    for k in range(ts.size - 1):
+        V, S, N, O = out[k, 0], out[k, 1], out[k, 2], out[k, 3]
+
+        if ts[k] > t_spinup:
+            P_scale = (total/count)/N_ocean
+        else:
+            P_scale = 1.
+
+        t = ts[k + 1]
+        J = P_scale*P*(125.*16./154.)*sin(2.*pi*(t+0.75)/24. + pi)
+
+        S_c = S/V
+        N_c = N/V
+        O_c = O/V
+
+        tidal_flow = estuary_area*tide[k]
+        if tidal_flow > 0:
+            tidal_S_contrib = tidal_flow*S_ocean
+            tidal_N_contrib = tidal_flow*N_ocean
+            tidal_O_contrib = tidal_flow*O_ocean
+        else:
+            tidal_S_contrib = tidal_flow*S_c
+            tidal_N_contrib = tidal_flow*N_c
+            tidal_O_contrib = tidal_flow*O_c
+
+        dV_dt = tidal_flow
+        dS_dt = -river_flow_rate*V0*S_c + tidal_S_contrib
+        dN_dt = -J*estuary_area \
+            - river_flow_rate*V0*(N_c - N_river) \
+            + tidal_N_contrib
+        dO_dt = J*(154./16.)*estuary_area \
+            + (G/24.)*(O_river - O_c)*estuary_area \
+            - river_flow_rate*V0*(O_c - O_river) \
+            + tidal_O_contrib
+
+        new = (V + dt*dV_dt, S + dt*dS_dt, N + dt*dN_dt, O + dt*dO_dt)
+        for j in range(4):
+            out[k + 1, j] = 0. if new[j] < 0. else new[j]
+
+        # Push the new N/V onto the rolling window
+        ratio = out[k + 1, 2]/out[k + 1, 0]
+        if count == n_window:
+            total -= window[pos]
+        else:
+            count += 1
+        window[pos] = ratio
+        total += ratio
+        pos += 1
+        if pos == n_window:
+            pos = 0
+            total = window[:count].sum()
+
+        if k + 2 == next_check:
+            floor = (S_ocean, N_ocean, O_ocean)
+            if t >= t_check and _cycle_converged(out[:k + 2], n_period, tol,
+                                                 floor):
+                return k + 2, count, pos, total
+            next_check += n_period
+
+    return ts.size, count, pos, total
+
+
+@njit(cache=True, nogil=True, error_model='numpy')
+def _cycle_converged(ys, n_period, tol, floor):
+    """ Compiled counterpart of `estuary.cycle_converged`. """
+    n = ys.shape[0]
+    for j in range(1, 4):
+        scale = abs(floor[j - 1])
+        diff = 0.
+        for i in range(n - n_period, n):
+            prev = ys[i - n_period, j]/ys[i - n_period, 0]
+            last = ys[i, j]/ys[i, 0]
+            scale = max(scale, abs(prev))
+            diff = max(diff, abs(last - prev))
+        if diff > tol*scale:
+            return False
+    return True
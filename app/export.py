@@ -0,0 +1,158 @@
+""" Export of full-resolution model output for download.
+
+The app only sends the browser as many points as its figures can show, so
+downloads are produced on the server instead: `client.py` serves them from
+its `/estuary/data.<format>` route, using the functions here to find the
+requested run and encode it incrementally.
+
+"""
+
+import logging
+from io import BytesIO
+from math import isinf, isnan
+
+try:
+    from .cache import make_key, results_cache
+    from .lattice import (APP_AXES, APP_MODEL_KWARGS, APP_RUN_KWARGS,
+                          PARAMS, open_store, run_scenario)
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from cache import make_key, results_cache
+    from lattice import (APP_AXES, APP_MODEL_KWARGS, APP_RUN_KWARGS,
+                         PARAMS, open_store, run_scenario)
+
+try:
+    import pyarrow  # noqa: F401, used by pandas for Parquet
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+FORMATS = ('csv', 'parquet')
+
+#: MIME type of each export format
+MIMETYPES = dict(csv='text/csv', parquet='application/octet-stream')
+
+#: Columns of model output included in exports, after the time index
+EXPORT_COLUMNS = ('day', 'V', 'S', 'N', 'O', 'Z')
+
+#: Number of rows encoded at a time when streaming CSV
+CSV_CHUNK_ROWS = 4096
+
+logger = logging.getLogger(__name__)
+
+
+def lookup_results(has_tide, river_flow_rate, N_river, G, P,
+                   model_kwargs=APP_MODEL_KWARGS,
+                   model_run_kwargs=APP_RUN_KWARGS, cache=results_cache):
+    """ Find an already-computed model run, either precomputed in the
+    scenario store or cached from an identical earlier request in this
+    process; returns None if the model needs to be run. The returned
+    DataFrame may be shared with other users and must not be modified. """
+
+    store = open_store()
+    if store is not None and store.matches(model_kwargs, model_run_kwargs):
+        results = store.get(has_tide, river_flow_rate, N_river, G, P)
+        if results is not None:
+            logger.info("run_model served from scenario store")
+            return results
+
+    results = cache.get(make_key(has_tide, river_flow_rate, N_river, G, P,
+                                 model_kwargs=model_kwargs,
+                                 model_run_kwargs=model_run_kwargs))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("run_model cache %s; %r",
+                    "miss" if results is None else "hit", cache.stats())
+
+    return results
+
+
+def load_results(has_tide, river_flow_rate, N_river, G, P,
+                 model_kwargs=APP_MODEL_KWARGS,
+                 model_run_kwargs=APP_RUN_KWARGS, cache=results_cache):
+    """ Full-resolution output for a set of app parameters, re-using an
+    already-computed run if possible (see `lookup_results`) and running
+    the model otherwise. Output is always float64; runs from the scenario
+    store are upcast, but only have the precision of its float32. """
+
+    params = (has_tide, river_flow_rate, N_river, G, P)
+    results = lookup_results(*params, model_kwargs=model_kwargs,
+                             model_run_kwargs=model_run_kwargs, cache=cache)
+    if results is not None:
+        if (results.dtypes != 'float64').any():
+            results = results.astype('float64')
+    else:
+        results = run_scenario(*(params + (model_kwargs, model_run_kwargs)))
+        cache.put(make_key(*params, model_kwargs=model_kwargs,
+                           model_run_kwargs=model_run_kwargs), results)
+
+    return results
+
+
+def parse_params(args):
+    """ App parameters from a mapping of strings, such as the query
+    arguments of a request; raises ValueError if any are missing or
+    invalid. Only the values reachable with the app's sliders (see
+    `lattice.APP_AXES`) are valid, so that requests can't fill the results
+    cache with arbitrary runs. """
+    params = []
+    for name in PARAMS:
+        if name not in args:
+            raise ValueError("Missing parameter '{}'".format(name))
+        value = args[name]
+        if name == 'has_tide':
+            if value.lower() not in ('0', '1', 'true', 'false'):
+                raise ValueError("Invalid value '{}' for "
+                                 "has_tide".format(value))
+            params.append(value.lower() in ('1', 'true'))
+            continue
+
+        number = float(value)
+        axis = APP_AXES[name]
+        if isnan(number) or isinf(number) or \
+                not axis[0] <= number <= axis[-1]:
+            raise ValueError("Invalid value '{}' for {}; expected a number "
+                             "from {:g} to {:g}".format(value, name, axis[0],
+                                                        axis[-1]))
+        step = axis[1] - axis[0]
+        nearest = axis[int(round((number - axis[0])/step))]
+        if abs(number - nearest) > 1e-9*step:
+            raise ValueError("Invalid value '{}' for {}; expected a "
+                             "multiple of {:g}".format(value, name, step))
+        params.append(nearest)
+    return tuple(params)
+
+
+def iter_csv(results, chunk_rows=CSV_CHUNK_ROWS):
+    """ Encode model output as CSV, yielding the text `chunk_rows` rows at a
+    time so that it can be streamed without building the whole file. """
+    results = results.loc[:, list(EXPORT_COLUMNS)]
+    yield results.iloc[:0].to_csv()
+    for start in range(0, len(results), chunk_rows):
+        yield results.iloc[start:start + chunk_rows].to_csv(header=False)
+
+
+def to_parquet(results):
+    """ Encode model output as a Parquet file, returned as bytes; requires
+    pyarrow. """
+    if not HAS_PARQUET:
+        raise ImportError("Parquet export requires pyarrow")
+    buf = BytesIO()
+    results.loc[:, list(EXPORT_COLUMNS)].to_parquet(buf)
+    return buf.getvalue()
+
+
+def encode(results, fmt):
+    """ Encode model output in one of `FORMATS`, as an iterator of chunks
+    of str or bytes. """
+    if fmt == 'csv':
+        return iter_csv(results)
+    elif fmt == 'parquet':
+        return iter([to_parquet(results)])
+    raise ValueError("Unknown format '{}'; expected one of "
+                     "{}".format(fmt, ", ".join(FORMATS)))
+
+
+def export_filename(has_tide, river_flow_rate, N_river, G, P, fmt):
+    """ Name of the downloaded file for a set of app parameters. """
+    return "estuary_{}_Q{:g}_N{:g}_G{:g}_P{:g}.{}".format(
+        "tide" if has_tide else "notide", river_flow_rate, N_river, G, P,
+        fmt)
@@ -0,0 +1,260 @@
+""" Time integration schemes for the estuary model.
+
+Each integrator wraps a model system of ODEs, `f(y, t, P_scale)`, and
+advances its state to successive output times, spaced `dt` apart. The
+productivity scaling `P_scale` is held fixed over each call to `advance`,
+and any non-physical (negative) components of the state are reset to zero
+after every step.
+
+"""
+
+from copy import copy
+
+from numpy import absolute, inf, maximum
+
+
+def clip_negative(y):
+    """ Correct non-physical V, S, N, or O (where they're < 0), in place. """
+    y[y < 0] = 0.
+    return y
+
+
+class Integrator(object):
+
+    """ Base class for the time integration schemes.
+
+    Parameters
+    ----------
+    f : function
+        The model system of ODEs, called as `f(y, t, P_scale)`
+    y0 : array
+        Initial model state
+    dt : float
+        Spacing of the output times, in hours
+    t0 : float
+        Initial time, in hours
+
+    Attributes
+    ----------
+    clip : function
+        Correction applied to each new state; `clip_negative` by default
+
+    """
+
+    #: Attributes which make up the state of the integration
+    state_attrs = ('y', 't')
+
+    def __init__(self, f, y0, dt, t0=0.):
+        self.f = f
+        self.y = y0
+        self.dt = dt
+        self.t = t0
+        self.clip = clip_negative
+
+    def advance(self, t_out, P_scale=1.):
+        """ Integrate from the current time to the next output time,
+        `t_out`, returning the model state there. """
+        raise NotImplementedError
+
+    def get_state(self):
+        """ Copy of the state of the integration, from which it can be
+        resumed with `set_state`. """
+        return dict((name, copy(getattr(self, name)))
+                    for name in self.state_attrs)
+
+    def set_state(self, state):
+        """ Resume the integration from the output of `get_state`. """
+        for name in self.state_attrs:
+            setattr(self, name, copy(state[name]))
+
+
+class Euler(Integrator):
+
+    """ Forward Euler, stepping directly from one output time to the next.
+
+    For consistency with the original model code, the derivative is
+    evaluated with the current state but at the end of the step.
+
+    """
+
+    def advance(self, t_out, P_scale=1.):
+        new_y = self.clip(self.y + self.dt*self.f(self.y, t_out, P_scale))
+        self.y, self.t = new_y, t_out
+        return new_y
+
+
+class RK4(Integrator):
+
+    """ Classic fourth-order Runge-Kutta, stepping directly from one output
+    time to the next. """
+
+    def advance(self, t_out, P_scale=1.):
+        f, y, t, h = self.f, self.y, self.t, self.dt
+
+        k1 = f(y, t, P_scale)
+        k2 = f(y + 0.5*h*k1, t + 0.5*h, P_scale)
+        k3 = f(y + 0.5*h*k2, t + 0.5*h, P_scale)
+        k4 = f(y + h*k3, t_out, P_scale)
+
+        new_y = self.clip(y + (h/6.)*(k1 + 2.*k2 + 2.*k3 + k4))
+        self.y, self.t = new_y, t_out
+        return new_y
+
+
+class DormandPrince(Integrator):
+
+    """ Adaptive, embedded Runge-Kutta 5(4) scheme of Dormand and Prince.
+
+    Internal steps are chosen to keep the estimated local error within the
+    given tolerances, but never run past the next output time, where the
+    productivity scaling changes; so they are at most `dt` long. The
+    derivative at the end of each step is re-used to start the next one
+    while the productivity scaling stays the same.
+
+    Parameters
+    ----------
+    f, y0, dt, t0 :
+        See `Integrator`
+    rtol : float
+        Relative error tolerance
+    atol : float
+        Absolute error tolerance, as a fraction of the magnitude of each
+        component of the initial state (or of 1, if larger)
+    first_step : float, optional
+        Size of the first internal step, in hours; by default, `dt`
+    max_step : float
+        Largest internal step allowed, in hours
+
+    Attributes
+    ----------
+    n_steps, n_rejected : int
+        Number of accepted and rejected internal steps taken so far
+
+    """
+
+    # Butcher tableau
+    C = (0., 1./5, 3./10, 4./5, 8./9, 1., 1.)
+    A = (
+        (),
+        (1./5, ),
+        (3./40, 9./40),
+        (44./45, -56./15, 32./9),
+        (19372./6561, -25360./2187, 64448./6561, -212./729),
+        (9017./3168, -355./33, 46732./5247, 49./176, -5103./18656),
+        (35./384, 0., 500./1113, 125./192, -2187./6784, 11./84),
+    )
+    # Difference between the fifth- and fourth-order weights
+    E = (71./57600, 0., -71./16695, 71./1920, -17253./339200, 22./525,
+         -1./40)
+
+    SAFETY = 0.9
+    MIN_FACTOR = 0.2
+    MAX_FACTOR = 5.
+
+    # The absolute tolerance is scaled by the initial state of the run,
+    # so is carried over to restarts along with the step size
+    state_attrs = Integrator.state_attrs + (
+        'atol', 'h', 'n_steps', 'n_rejected', '_t0', '_y0', '_f0', '_f',
+        '_P_scale'
+    )
+
+    def __init__(self, f, y0, dt, t0=0., rtol=1e-6, atol=1e-8,
+                 first_step=None, max_step=inf):
+        super(DormandPrince, self).__init__(f, y0, dt, t0)
+        self.rtol = rtol
+        self.atol = atol*maximum(absolute(y0), 1.)
+        self.max_step = max_step
+        self.h = dt if first_step is None else first_step
+
+        self.n_steps = 0
+        self.n_rejected = 0
+
+        # Start and end of the most recent internal step, with the
+        # derivatives there and the productivity scaling they were
+        # evaluated with
+        self._t0, self._y0, self._f0 = t0, y0, None
+        self._f = None
+        self._P_scale = None
+
+    def advance(self, t_out, P_scale=1.):
+        while self.t < t_out:
+            self._step(t_out, P_scale)
+        return self._interpolate(t_out)
+
+    def _step(self, t_out, P_scale):
+        f, y, t = self.f, self.y, self.t
+
+        if self._f is not None and P_scale == self._P_scale:
+            k1 = self._f
+        else:
+            k1 = f(y, t, P_scale)
+        while True:
+            h_max = min(self.h, self.max_step)
+            h = min(h_max, t_out - t)
+            if h <= 1e-12*max(1., abs(t)):
+                raise RuntimeError("Step size underflow at t = {}".format(t))
+
+            ks = [k1, ]
+            for c, a in zip(self.C[1:], self.A[1:]):
+                dy = sum(a_j*k_j for a_j, k_j in zip(a, ks))
+                ks.append(f(y + h*dy, t + c*h, P_scale))
+            # The last stage is evaluated at the fifth-order solution
+            new_y = y + h*sum(a_j*k_j for a_j, k_j in zip(self.A[-1], ks))
+
+            err_y = h*sum(e_j*k_j for e_j, k_j in zip(self.E, ks))
+            scale = self.atol + self.rtol*maximum(absolute(y),
+                                                  absolute(new_y))
+            err = (absolute(err_y)/scale).max()
+
+            if err <= 1.:
+                factor = self.MAX_FACTOR if err == 0. else \
+                    min(self.MAX_FACTOR, self.SAFETY*err**-0.2)
+                # A step cut short at the output time doesn't shrink the
+                # next one
+                self.h = h*factor if h == h_max else max(h*factor, h_max)
+                break
+
+            self.n_rejected += 1
+            self.h = h*max(self.MIN_FACTOR, self.SAFETY*err**-0.2)
+
+        # Land exactly on the output time, rather than just short of it
+        t_new = t_out if h == t_out - t else t + h
+        new_f = ks[-1]
+        if (new_y < 0).any():
+            new_y = self.clip(new_y)
+            new_f = f(new_y, t_new, P_scale)
+
+        self._t0, self._y0, self._f0 = t, y, k1
+        self.t, self.y, self._f = t_new, new_y, new_f
+        self._P_scale = P_scale
+        self.n_steps += 1
+
+    def _interpolate(self, t_out):
+        """ Cubic Hermite interpolation within the last internal step. """
+        t0, t1 = self._t0, self.t
+        if t_out == t1:
+            return self.y.copy()
+
+        h = t1 - t0
+        s = (t_out - t0)/h
+        h00 = (1. + 2.*s)*(1. - s)**2
+        h10 = s*(1. - s)**2
+        h01 = s*s*(3. - 2.*s)
+        h11 = s*s*(s - 1.)
+        y = h00*self._y0 + h10*h*self._f0 + h01*self.y + h11*h*self._f
+        return self.clip(y)
+
+
+#: Integration schemes available by name
+INTEGRATORS = dict(euler=Euler, rk4=RK4, dopri5=DormandPrince)
+
+
+def make_integrator(method, f, y0, dt, t0=0., **options):
+    """ Construct the integrator named `method` (one of the keys of
+    `INTEGRATORS`), passing it any additional `options`. """
+    try:
+        cls = INTEGRATORS[method]
+    except KeyError:
+        raise ValueError("Unknown integration method '{}'; expected one of "
+                         "{}".format(method, ", ".join(sorted(INTEGRATORS))))
+    return cls(f, y0, dt, t0, **options)
@@ -0,0 +1,68 @@
+""" Compiled kernels for the estuary model.
+
+If Numba is installed, the forward Euler marching loop of `EstuaryModel`
+can be run as a single compiled function, which avoids the Python
+interpreter overhead of evaluating the model system of ODEs step by step.
+The kernel takes the model parameters as plain scalars and the tidal
+forcing pre-evaluated at every step, and reproduces the results of the
+pure-NumPy integration to within floating-point round-off.
+
+Numba is only imported, and the kernel compiled (or loaded from Numba's
+on-disk cache), the first time the kernel is called, so that importing the
+model stays fast. Without Numba, `HAS_NUMBA` is False and the model falls
+back to its pure-NumPy integration.
+
+"""
+
+import os
+import sys
+from importlib.util import find_spec, module_from_spec, spec_from_file_location
+from threading import Lock
+
+from numpy import ceil, cumsum, empty
+
+HAS_NUMBA = find_spec('numba') is not None
+
+#: Name of the module of compiled kernels in `sys.modules`, which is the same
+#: however this module was imported
+KERNEL_MODULE = 'estuary_euler_kernel'
+
+_load_lock = Lock()
+
+
+def compiled():
+    """ The module of compiled kernels (`euler_kernel.py`), imported on first
+    use. """
+    module = sys.modules.get(KERNEL_MODULE)
+    if module is not None:
+        return module
+    if not HAS_NUMBA:
+        raise ImportError("Numba is required for the compiled kernels")
+    with _load_lock:
+        module = sys.modules.get(KERNEL_MODULE)
+        if module is None:
+            spec = spec_from_file_location(KERNEL_MODULE, os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'euler_kernel.py'))
+            module = module_from_spec(spec)
+            spec.loader.exec_module(module)
+            sys.modules[KERNEL_MODULE] = module
+    return module
+
+
+def euler_march(*args):
+    """ Forward Euler integration of the estuary model with the compiled
+    kernel; see `euler_kernel.euler_march`. """
+    return compiled().euler_march(*args)
+
+
+def euler_times(dt, t_end, t0=0.):
+    """ Output times of an Euler run from `t0`, accumulated exactly as the
+    marching loop in `EstuaryModel` does, so that the number of steps and
+    the times at which the ODEs are evaluated match. """
+    # np.cumsum adds sequentially, just like `t += dt`
+    ts = empty(max(int(ceil((t_end - t0)/dt)), 0) + 3)
+    ts[0] = t0
+    ts[1:] = dt
+    ts = cumsum(ts)
+    n_steps = int((ts < t_end).sum())
+    return ts[:n_steps + 1]
@@ -0,0 +1,28 @@
+""" Cache keys built from model parameters and settings.
+
+Kept apart from `cache`, so that modules which only compare parameters
+(such as `checkpoint`) don't import the caches themselves.
+
+"""
+
+#: Number of decimal places that float parameters are rounded to when
+#: building cache keys, so that e.g. 0.1 + 0.2 and 0.3 share a key
+KEY_DECIMALS = 8
+
+
+def normalize(value):
+    """ Normalize a parameter value for use in a cache key. """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return round(float(value), KEY_DECIMALS)
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(v) for v in value)
+    return value
+
+
+def make_key(*args, **kwargs):
+    """ Build a hashable cache key from positional and keyword arguments. """
+    return normalize(args) + normalize(kwargs)
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+""" Precomputed lattice of app scenarios in a memory-mapped store.
+
+The app's toggle and sliders only take on a finite set of values, so every
+run a user can request lies on a lattice of scenarios. This module builds
+model output for (a subset of) that lattice offline, and writes it to disk
+as a single float32 array which the app memory-maps and slices into instead
+of integrating the model.
+
+A store is a directory with two files:
+
+- `data.npy`: an array of shape (n_runs, n_times, n_columns), with runs
+  ordered as the product of the lattice axes in the order of `PARAMS`
+- `index.json`: the lattice axes, column names, output times, and the
+  model settings the runs were computed with
+
+To build the default store, from the top-level of the repository run
+
+$ python -m app.lattice
+
+and see `--help` for configuring the lattice and store location.
+
+"""
+
+import json
+import os
+from argparse import ArgumentParser, RawTextHelpFormatter
+from collections import OrderedDict
+from copy import copy
+from itertools import product
+
+from numpy import arange, array, ravel_multi_index
+from numpy.lib.format import open_memmap
+from pandas import DataFrame, Index
+
+try:
+    from .cache import normalize
+    from .estuary import EstuaryModel, basic_tidal_flow
+    from .sweep import imap
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from cache import normalize
+    from estuary import EstuaryModel, basic_tidal_flow
+    from sweep import imap
+
+#: App parameters spanning the lattice, in storage order
+PARAMS = ('has_tide', 'river_flow_rate', 'N_river', 'G', 'P')
+
+#: Output columns saved for each run; 'day' is re-derived from the times
+COLUMNS = ('V', 'S', 'N', 'O', 'Z')
+
+
+def axis_range(start, stop, step):
+    """ Inclusive range of values from `start` to `stop`, as slider steps. """
+    n = int(round((stop - start)/step)) + 1
+    return [round(start + i*step, 10) for i in range(n)]
+
+
+#: Every value reachable with the app's toggle and sliders
+APP_AXES = OrderedDict([
+    ('has_tide', [False, True]),
+    ('river_flow_rate', axis_range(0., 0.5, 0.01)),
+    ('N_river', axis_range(0., 200., 0.1)),
+    ('G', axis_range(1., 5., 2.)),
+    ('P', axis_range(0.5, 2., 0.5)),
+])
+
+#: Coarser subset of the app lattice which is built by default
+DEFAULT_AXES = OrderedDict([
+    ('has_tide', [False, True]),
+    ('river_flow_rate', axis_range(0., 0.5, 0.05)),
+    ('N_river', axis_range(0., 200., 10.)),
+    ('G', axis_range(1., 5., 2.)),
+    ('P', axis_range(0.5, 2., 0.5)),
+])
+
+#: Model settings used by the app for every run
+APP_MODEL_KWARGS = dict(V=1e9, z=5., S_ocean=35., N_ocean=20.,
+                        O_ocean=231.2, O_river=231.2,
+                        S0=35., N0=20., O0=231.2)
+APP_RUN_KWARGS = dict(dt=1.0, t_end=24*42.)
+
+#: Location of the store the app looks for; set the environment variable
+#: ESTUARY_LATTICE to override
+DEFAULT_PATH = os.environ.get(
+    "ESTUARY_LATTICE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "lattice_store")
+)
+
+
+def scenario_model(has_tide, river_flow_rate, N_river, G, P, model_kwargs):
+    """ Construct the estuary model for a set of app parameters.
+
+    Parameters
+    ----------
+    has_tide, river_flow_rate, N_river, G, P :
+        Settings from the app's toggle and sliders
+    model_kwargs : dict
+        Remaining `EstuaryModel` arguments, with the initial state given as
+        `V` and `S0`, `N0`, `O0`
+
+    """
+
+    kwargs = copy(model_kwargs)
+    kwargs.update(dict(
+        river_flow_rate=river_flow_rate, N_river=N_river,
+        G=G, P=P
+    ))
+    # Set initial conditions
+    for elem in ['S', 'N', 'O']:
+        kwargs[elem] = kwargs[elem+'0']
+        del kwargs[elem+'0']
+    if has_tide:
+        kwargs['tide_func'] = basic_tidal_flow
+
+    return EstuaryModel(**kwargs)
+
+
+def run_scenario(has_tide, river_flow_rate, N_river, G, P,
+                 model_kwargs, model_run_kwargs, metrics=None):
+    """ Run the estuary model for a set of app parameters.
+
+    Parameters
+    ----------
+    has_tide, river_flow_rate, N_river, G, P, model_kwargs :
+        See `scenario_model`
+    model_run_kwargs : dict
+        Arguments for `EstuaryModel.run_model`
+    metrics : RunMetrics, optional
+        Records step counts and timings of the run
+
+    Returns
+    -------
+    results : DataFrame
+        Model output, with an additional column for time in days
+
+    """
+
+    model = scenario_model(has_tide, river_flow_rate, N_river, G, P,
+                           model_kwargs)
+    results = model.run_model(metrics=metrics, **model_run_kwargs)
+    results['day'] = results.index/24.
+
+    return results
+
+
+def iter_scenario(has_tide, river_flow_rate, N_river, G, P,
+                  model_kwargs, model_run_kwargs, chunk_hours=24.,
+                  metrics=None):
+    """ Run the estuary model for a set of app parameters, yielding the
+    output in chunks of `chunk_hours` as in `EstuaryModel.iter_model`; see
+    `run_scenario` for the other arguments. """
+
+    model = scenario_model(has_tide, river_flow_rate, N_river, G, P,
+                           model_kwargs)
+    for results in model.iter_model(chunk_hours=chunk_hours, metrics=metrics,
+                                     **model_run_kwargs):
+        results['day'] = results.index/24.
+        yield results
+
+
+def _run_lattice_point(args):
+    """ Worker for building a store; returns the stored columns of one run
+    as a float32 array along with its times. """
+    results = run_scenario(*args)
+    return results.index.values, results[list(COLUMNS)].values.astype('f4')
+
+
+def build_store(path, model_kwargs, model_run_kwargs, axes=DEFAULT_AXES,
+                max_workers=None, chunksize=16, progress=None):
+    """ Compute every scenario on a lattice and write them to a store.
+
+    Parameters
+    ----------
+    path : str
+        Directory to write the store to; it will be created if necessary
+    model_kwargs, model_run_kwargs : dicts
+        Model settings shared by every run; see `run_scenario`
+    axes : dict
+        Mapping from each of `PARAMS` to the (non-empty) sequence of values
+        to compute
+    max_workers, chunksize :
+        Passed to `sweep.imap` to distribute the runs across processes
+    progress : function, optional
+        Called as `progress(n_done, n_total)` each time a run completes.
+
+    Returns
+    -------
+    store : ScenarioStore
+        The newly built store, opened for reading
+
+    """
+
+    axes = OrderedDict((name, list(axes[name])) for name in PARAMS)
+    empty = [name for name, values in axes.items() if not values]
+    if empty:
+        raise ValueError("No values given for lattice axes: {}".format(
+            ", ".join(empty)))
+
+    # Row-major order over the axes, matching `ravel_multi_index`
+    points = [point + (model_kwargs, model_run_kwargs)
+              for point in product(*axes.values())]
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    data, times = None, None
+    outputs = imap(_run_lattice_point, points, max_workers, chunksize)
+    for i, (ts, values) in enumerate(outputs):
+        if data is None:
+            times = ts
+            data = open_memmap(os.path.join(path, "data.npy"), mode='w+',
+                               dtype='f4',
+                               shape=(len(points), ) + values.shape)
+        data[i] = values
+        if progress is not None:
+            progress(i + 1, len(points))
+    data.flush()
+    del data
+
+    index = dict(axes=axes, columns=list(COLUMNS), times=times.tolist(),
+                 model_kwargs=model_kwargs,
+                 model_run_kwargs=model_run_kwargs)
+    with open(os.path.join(path, "index.json"), 'w') as f:
+        json.dump(index, f)
+
+    return ScenarioStore(path)
+
+
+class ScenarioStore(object):
+
+    """ Read-only, memory-mapped store of precomputed scenarios.
+
+    Parameters
+    ----------
+    path : str
+        Directory containing the store's `index.json` and `data.npy`
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            index = json.load(f)
+
+        self.axes = OrderedDict((name, index['axes'][name])
+                                for name in PARAMS)
+        self.columns = index['columns']
+        self.model_kwargs = index['model_kwargs']
+        self.model_run_kwargs = index['model_run_kwargs']
+        self.times = array(index['times'])
+
+        self.data = open_memmap(os.path.join(path, "data.npy"), mode='r')
+        self._positions = [dict((normalize(v), i) for i, v in
+                                enumerate(values))
+                           for values in self.axes.values()]
+        self._shape = tuple(len(values) for values in self.axes.values())
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def matches(self, model_kwargs, model_run_kwargs):
+        """ Whether the store was built with the given model settings. """
+        return (normalize(model_kwargs) == normalize(self.model_kwargs) and
+                normalize(model_run_kwargs) ==
+                normalize(self.model_run_kwargs))
+
+    def locate(self, has_tide, river_flow_rate, N_river, G, P):
+        """ Position of a scenario in the store, or None if it isn't one of
+        the precomputed lattice points. """
+        values = (bool(has_tide), river_flow_rate, N_river, G, P)
+        try:
+            idx = [positions[normalize(value)] for positions, value
+                   in zip(self._positions, values)]
+        except KeyError:
+            return None
+        return int(ravel_multi_index(idx, self._shape))
+
+    def get_array(self, has_tide, river_flow_rate, N_river, G, P):
+        """ Read-only view of the stored output for a scenario, with shape
+        (n_times, n_columns), or None if it isn't in the store. """
+        i = self.locate(has_tide, river_flow_rate, N_river, G, P)
+        if i is None:
+            return None
+        return self.data[i]
+
+    def get(self, has_tide, river_flow_rate, N_river, G, P):
+        """ Stored output for a scenario in the same form as returned by
+        `run_scenario`, or None if it isn't in the store. """
+        values = self.get_array(has_tide, river_flow_rate, N_river, G, P)
+        if values is None:
+            return None
+        results = DataFrame(values, columns=self.columns, copy=False,
+                            index=Index(self.times, name='time'))
+        results['day'] = self.times/24.
+        return results
+
+
+_stores = {}
+
+
+def open_store(path=DEFAULT_PATH):
+    """ Open the store at `path`, re-using it if already opened in this
+    process; returns None if there is no store there. """
+    if path not in _stores:
+        if os.path.exists(os.path.join(path, "index.json")):
+            _stores[path] = ScenarioStore(path)
+        else:
+            return None
+    return _stores[path]
+
+
+def _parse_axis(spec):
+    """ Parse an axis given as 'start:stop:step' or 'v1,v2,...'. """
+    if ':' in spec:
+        return axis_range(*[float(x) for x in spec.split(':')])
+    return [float(x) for x in spec.split(',')]
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--path", type=str, default=DEFAULT_PATH,
+                        help="Directory to write the store to")
+    for name in PARAMS[1:]:
+        parser.add_argument("--" + name.replace('_', '-'), type=str,
+                            help="Values of {}, as 'start:stop:step' or "
+                                 "a comma-separated list".format(name))
+    parser.add_argument("--tide", choices=['both', 'on', 'off'],
+                        default='both', help="Tide settings to include")
+    parser.add_argument("--dt", type=float, default=APP_RUN_KWARGS['dt'],
+                        help="Model timestep, in hours")
+    parser.add_argument("--t-end", type=float,
+                        default=APP_RUN_KWARGS['t_end'],
+                        help="Model run length, in hours")
+    parser.add_argument("--max-workers", type=int, default=None,
+                        help="Number of worker processes")
+    args = parser.parse_args()
+
+    axes = copy(DEFAULT_AXES)
+    axes['has_tide'] = dict(both=[False, True], on=[True],
+                            off=[False])[args.tide]
+    for name in PARAMS[1:]:
+        spec = getattr(args, name)
+        if spec is not None:
+            axes[name] = _parse_axis(spec)
+
+    model_run_kwargs = dict(dt=args.dt, t_end=args.t_end)
+
+    n_runs = 1
+    for values in axes.values():
+        n_runs *= len(values)
+    n_times = int(arange(0., args.t_end + args.dt, args.dt).size)
+    print("Building {:d} runs ({:.1f} MB) in {}".format(
+        n_runs, n_runs*n_times*len(COLUMNS)*4/1024.**2, args.path
+    ))
+
+    def _progress(n_done, n_total):
+        if n_done % 100 == 0 or n_done == n_total:
+            print("   {:d}/{:d}".format(n_done, n_total))
+
+    build_store(args.path, APP_MODEL_KWARGS, model_run_kwargs, axes,
+                max_workers=args.max_workers, progress=_progress)
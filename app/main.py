@@ -2,14 +2,21 @@
 """ Interactive Estuary model app in Bokeh.
 
 """
+import logging
 import sys
 sys.path.append(".")
 
-from numpy import arange
+from numpy import arange, ascontiguousarray, ceil, empty
 from pandas import DataFrame, Index
 
 from copy import copy
-from estuary import EstuaryModel, basic_tidal_flow
+from functools import partial
+from cache import make_key, results_cache
+from metrics import RunMetrics
+from decimate import decimate
+from lattice import APP_MODEL_KWARGS, APP_RUN_KWARGS, PARAMS, iter_scenario
+import export
+from runner import stream_in_background
 
 from bokeh.io import curdoc
 from bokeh.models import ColumnDataSource, Range1d, LinearAxis, CustomJS
@@ -18,10 +25,8 @@ from bokeh.models import DataTable, TableColumn
 from bokeh.plotting import Figure
 
 # Default model settings - can be made accessible to user!
-model_kwargs = dict(V=1e9, z=5., S_ocean=35., N_ocean=20.,
-                    O_ocean=231.2, O_river=231.2,
-                    S0=35., N0=20., O0=231.2)
-model_run_kwargs = dict(dt=1.0, t_end=24*42.)
+model_kwargs = copy(APP_MODEL_KWARGS)
+model_run_kwargs = copy(APP_RUN_KWARGS)
 colors = [
     'MediumSeaGreen', 'OrangeRed', 'DarkViolet'
 ]
@@ -32,47 +37,90 @@ day_range = Range1d(0, model_run_kwargs['t_end']/24.)
 # Hardcoded constants
 SPINUP_DAYS = 2
 HYPO_THRESH = 60.
+STREAM_CHUNK_HOURS = 24.
 
 # Figure sizes/styling
 figure_style_kws = dict(
     plot_width=600, plot_height=200, min_border=0
 )
 
+# Display resolution: model output is downsampled to about this many points
+# per series before being sent to the browser, independently of the model
+# timestep set in `model_run_kwargs`. Full-resolution output is kept in
+# `results`.
+display_points = 2*figure_style_kws['plot_width']
+decimate_method = 'minmax'
+
+# Columns of model output sent to the browser, as contiguous NumPy arrays of
+# this dtype so that Bokeh can transfer them as binary buffers
+source_columns = ['V', 'S', 'N', 'O', 'Z', 'day']
+source_dtype = 'float32'
+
+# Downloads of the full-resolution output are served by the Flask app in
+# `client.py`, which the app is embedded in
+export_url = "/estuary/data.csv"
+
+logger = logging.getLogger(__name__)
+
 
 def get_timestep_index():
     t_end, dt = model_run_kwargs['t_end'], model_run_kwargs['dt']
     return Index(arange(0., t_end+dt, dt), name='time')
 
 
+def to_source_data(results=None):
+    """ Convert model output to a dict of contiguous NumPy arrays for a
+    ColumnDataSource, or empty arrays if `results` is None. """
+    if results is None:
+        return dict((col, empty(0, dtype=source_dtype))
+                    for col in source_columns)
+    return dict((col, ascontiguousarray(results[col].values,
+                                        dtype=source_dtype))
+                for col in source_columns)
+
+
+def for_display(results):
+    """ Downsample (part of) a model run to the display resolution. """
+    n_total = len(get_timestep_index())
+    n_out = int(ceil(display_points*len(results)/float(n_total)))
+    return decimate(results, max(n_out, 2), method=decimate_method)
+
+
 # Callback functions for running the model with different settings and
 # plotting results
+def cache_key(has_tide, river_flow_rate, N_river, G, P):
+    """ Key for a model run in the results cache """
+    return make_key(has_tide, river_flow_rate, N_river, G, P,
+                    model_kwargs=model_kwargs,
+                    model_run_kwargs=model_run_kwargs)
+
+
+def lookup_results(has_tide, river_flow_rate, N_river, G, P):
+    """ Find an already-computed model run, either precomputed in the
+    scenario store or cached from an identical earlier request in this
+    server process; returns None if the model needs to be run. The returned
+    DataFrame may be shared with other sessions and must not be modified. """
+    return export.lookup_results(has_tide, river_flow_rate, N_river, G, P,
+                                 model_kwargs, model_run_kwargs)
+
+
 def run_model(has_tide, river_flow_rate, N_river, G, P):
-    """ Alias to quickly run the estuary model """
-
-    kwargs = copy(model_kwargs)
-    kwargs.update(dict(
-        river_flow_rate=river_flow_rate, N_river=N_river,
-        G=G, P=P
-    ))
-    # Set initial conditions
-    for elem in ['S', 'N', 'O']:
-        kwargs[elem] = kwargs[elem+'0']
-        del kwargs[elem+'0']
-    if has_tide:
-        kwargs['tide_func'] = basic_tidal_flow
-
-    model = EstuaryModel(**kwargs)
-    results = model.run_model(**model_run_kwargs)
-    results['day'] = results.index/24.
-
-    return results
+    """ Run the estuary model, re-using an already-computed run if possible
+    (see `lookup_results`). """
+    return export.load_results(has_tide, river_flow_rate, N_river, G, P,
+                               model_kwargs, model_run_kwargs)
+
 
 ########################################################################
 
 # Construct basic plot architecture
 results = DataFrame({'day': 1, 'S': 0, 'N': 0, 'O': 0, 'V': 1e9, 'Z': 5.},
                     dtype=float, index=get_timestep_index())
-source = ColumnDataSource(results)
+source = ColumnDataSource(data=to_source_data(results))
+
+# Settings of the model run shown in the plots, which the download button
+# passes on to `export_url`
+run_params = ColumnDataSource(data=dict((name, []) for name in PARAMS))
 
 # Create a new plot and add a renderer
 top = Figure(tools=tools, title=None, x_range=day_range,
@@ -144,23 +192,23 @@ plots = VBox(top, mid, bot,
 # plots = gridplot([[top,], [mid,], [bot,]])
 
 
+# Latest model run requested in this session; runs which have been
+# superseded by a newer request are cancelled and stop updating the plots
+current_run = None
+
+
 def update_plots():
     """ Callback function to re-run model with new settings. """
-    global results
+    global results, current_run
 
     has_tide = tide_toggle.active
     river_flow_rate = river_flow_slider.value
     N_river = river_N_slider.value
     G = gas_exchange_slider.value
     P = productivity_slider.value
-
-    results = run_model(has_tide, river_flow_rate, N_river, G, P)
-
-    # Update internal data handler with latest results/model run output
-    source.data = dict(V=results['V'], S=results['S'],
-                       N=results['N'], O=results['O'],
-                       Z=results['Z'],
-                       day=results['day'])
+    params = (has_tide, river_flow_rate, N_river, G, P)
+    run_params.data = dict((name, [value]) for name, value
+                           in zip(PARAMS, params))
 
     # title_str = "Estuary"
     # comps = []
@@ -171,6 +219,78 @@ def update_plots():
     # extra_str = " with " + " and ".join(comps)
     # top.title = title_str + extra_str
 
+    if current_run is not None:
+        current_run.cancel()
+        current_run = None
+
+    results = lookup_results(*params)
+    if results is not None:
+        # Update internal data handler with latest results/model run output
+        source.data = to_source_data(for_display(results))
+        update_ranges(results)
+        set_running(False)
+        return
+
+    # Otherwise, run the model on a worker thread and stream its output to
+    # the plots one chunk at a time, so that users see the results as
+    # they're computed and other sessions aren't blocked in the meantime
+    source.data = to_source_data()
+    set_running(True)
+
+    # Timing every evaluation of the ODEs slows runs down, so is only done
+    # when debugging
+    metrics = RunMetrics(callback=partial(log_metrics, params),
+                         detailed=logger.isEnabledFor(logging.DEBUG))
+    chunks = iter_scenario(*(params + (model_kwargs, model_run_kwargs)),
+                           chunk_hours=STREAM_CHUNK_HOURS, metrics=metrics)
+
+    def on_chunk(run, chunk):
+        # Prepare the data to send on the worker thread, too
+        data = to_source_data(for_display(chunk))
+        doc.add_next_tick_callback(partial(stream_chunk, run, data, chunk))
+
+    def on_done(run, run_results):
+        results_cache.put(cache_key(*params), run_results)
+        doc.add_next_tick_callback(partial(finish_run, run, run_results))
+
+    current_run = stream_in_background(chunks, on_chunk, on_done)
+
+
+def log_metrics(params, metrics):
+    """ Log the step counts and timings of a model run, so that slow
+    settings show up in the server's logs. """
+    logger.info("Model run %s: %r", dict(zip(PARAMS, params)), metrics)
+
+
+def stream_chunk(run, data, chunk):
+    """ Stream a chunk of output from a model run to the plots. """
+    if run is not current_run:
+        return
+
+    source.stream(data)
+    update_ranges(chunk)
+
+
+def finish_run(run, run_results):
+    """ Record the complete output of a model run. """
+    global results, current_run
+
+    if run is not current_run:
+        return
+
+    results = run_results
+    current_run = None
+    set_running(False)
+
+
+def set_running(running):
+    """ Indicate whether a model run is in progress for this session. """
+    go_button.label = "Running..." if running else "Run model"
+
+
+def update_ranges(results):
+    """ Expand the plot ranges to fit `results`, if necessary. """
+
     # Reset plot ranges if necessary
     # TODO: This seems to be an open bug in bokeh, where the plot doesn't
     #       detect the need to re-draw following a range change.
@@ -181,46 +301,24 @@ def update_plots():
     if results['O'].max() > bot.y_range.end:
         bot.y_range = Range1d(0, 1.05*results['O'].max())
 
-# Callback using Javascript to download current data as a CSV; note that
-# I've hardcoded in the iteration over objKeys (since I know the number of
-# columns in the source data) but it would have to be changed if the model
-# state variables change. This follows the example by Schaun Wheeler,
-# https://groups.google.com/a/continuum.io/forum/#!topic/bokeh/jMKf_Acj3XU
-download_data = CustomJS(args=dict(objArray=source), code="""
-
-    array = objArray.attributes.data;
-    var str = '';
-    var line = '';
-    objKeys = Object.keys(array);
-    var placeholder_key = objKeys[0];
-
-    console.log("Iterating over array to id keys");
-    for (i = 0; i < objKeys.length; i++ ) {
-        var value = objKeys[i] + "";
-        console.log(i, value);
-        line += '"' + value.replace(/"/g, '""') + '",';
-    }
-    line = line.slice(0, -1);
-    str += line + '\\r\\n';
-
-    console.log("Iterating again to record all data")
-    for (i = 0; i < array[placeholder_key].length; i++) {
-        var line = '';
-        console.log(i)
-        for (j = 0; j < objKeys.length; j++) {
-            var index = objKeys[j]
-            var value = array[index][i] + "";
-            line += '"' + value.replace(/"/g, '""') + '",';
-        }
-        line = line.slice(0, -1);
-        str += line + '\\r\\n';
+# Callback using Javascript to download the current run's full-resolution
+# output as a CSV, which the server streams from `export_url`
+download_data = CustomJS(args=dict(params=run_params), code="""
+
+    var data = params.get('data');
+    var keys = Object.keys(data);
+    if (data[keys[0]].length == 0) {
+        return;
     }
-    console.log("... done!")
 
-    var csv = escape(str);
-    window.open("data:text/csv;charset=utf-8," + csv);
+    var query = [];
+    for (i = 0; i < keys.length; i++) {
+        query.push(encodeURIComponent(keys[i]) + "=" +
+                   encodeURIComponent(data[keys[i]][0]));
+    }
+    window.open("%s?" + query.join("&"));
 
-""")
+""" % export_url)
 
 toggle_ocean = CustomJS(code="""
     var ocean_group = Snap.select("#ocean_group");
@@ -311,5 +409,6 @@ all_settings = VBox(prods, river, tide_run,
                     width=400)
 
 # Add to current document
-curdoc().add_root(HBox(children=[all_settings, plots]))
+doc = curdoc()
+doc.add_root(HBox(children=[all_settings, plots]))
 
@@ -0,0 +1,155 @@
+""" Instrumentation of model runs.
+
+Passing a `RunMetrics` to `EstuaryModel.run_model` (or `iter_model`) records
+where the time in the run goes: how many steps and evaluations of the model
+system of ODEs it took, how long was spent evaluating the ODEs, averaging
+N for the productivity scaling and building the output DataFrame, and how
+often non-physical states had to be clipped. Instrumentation works by
+wrapping the pieces of the integration, so runs without a `RunMetrics`
+don't pay for it at all. Timing every evaluation of the ODEs slows a run
+down noticeably, so a `RunMetrics` with `detailed=False` only records the
+step counts and wall times.
+
+"""
+
+from functools import wraps
+from timeit import default_timer
+
+#: Counters and timers recorded for each run, in reporting order
+FIELDS = ('method', 'backend', 'n_steps', 'n_rhs', 'n_clipped', 'ode_time',
+          'averaging_time', 'integration_time', 'frame_time', 'total_time',
+          'converged_at')
+
+
+class RunMetrics(object):
+
+    """ Counters and timers for a model run.
+
+    Parameters
+    ----------
+    callback : function, optional
+        Called with the metrics once the run finishes
+    detailed : bool
+        Count and time every evaluation of the ODEs, update of the rolling
+        average and clipping; if False, `n_rhs`, `n_clipped`, `ode_time`
+        and `averaging_time` are None for pure-NumPy runs
+
+    Attributes
+    ----------
+    method, backend : str
+        Integration scheme, and whether the compiled kernel ('numba') or
+        pure-NumPy integration ('numpy') was used
+    n_steps : int
+        Number of output timesteps
+    n_rhs : int
+        Number of evaluations of the model system of ODEs
+    n_clipped : int
+        Number of times a non-physical (negative) state was reset to zero;
+        for the compiled kernel, counted from the steps which ended with a
+        zero component
+    ode_time, averaging_time : float
+        Time in seconds spent evaluating the model system of ODEs and the
+        rolling 24-hour average of N; None for the compiled kernel, which
+        only records `integration_time`
+    integration_time : float
+        Time in seconds spent integrating the model, in total
+    frame_time : float
+        Time in seconds spent building the output DataFrame(s) or
+        `ModelResult`
+    total_time : float
+        Wall time of the whole run, in seconds
+    converged_at : float
+        Time in hours at which the run reached a periodic steady state, or
+        None; see `EstuaryModel.run_model`
+
+    """
+
+    def __init__(self, callback=None, detailed=True):
+        self.callback = callback
+        self.detailed = detailed
+        self.reset()
+
+    def reset(self):
+        """ Zero all the counters and timers. """
+        self.method = None
+        self.backend = None
+        self.n_steps = 0
+        self.n_rhs = 0 if self.detailed else None
+        self.n_clipped = 0 if self.detailed else None
+        self.ode_time = 0. if self.detailed else None
+        self.averaging_time = 0. if self.detailed else None
+        self.integration_time = 0.
+        self.frame_time = 0.
+        self.total_time = 0.
+        self.converged_at = None
+
+    def as_dict(self):
+        """ The recorded metrics, by name. """
+        return dict((name, getattr(self, name)) for name in FIELDS)
+
+    def __repr__(self):
+        def _fmt(value):
+            if isinstance(value, float):
+                return "{:.4g}".format(value)
+            return str(value)
+        return "RunMetrics({})".format(", ".join(
+            "{}={}".format(name, _fmt(getattr(self, name)))
+            for name in FIELDS))
+
+    def finish(self):
+        """ Called by the model once the run finishes. """
+        if self.callback is not None:
+            self.callback(self)
+
+    def wrap_rhs(self, f):
+        """ Wrap a model system of ODEs to count and time its
+        evaluations. """
+        @wraps(f)
+        def _f(*args, **kwargs):
+            start = default_timer()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.ode_time += default_timer() - start
+                self.n_rhs += 1
+        return _f
+
+    def wrap_clip(self, clip):
+        """ Wrap the clipping of non-physical states to count how often it
+        takes effect. """
+        @wraps(clip)
+        def _clip(y):
+            if (y < 0).any():
+                self.n_clipped += 1
+            return clip(y)
+        return _clip
+
+    def wrap_window(self, window):
+        """ Wrap a `RollingMean` to time updates and reads of its
+        average. """
+        return _TimedRollingMean(window, self)
+
+
+class _TimedRollingMean(object):
+
+    """ Proxy for a `RollingMean` which adds the time spent in it to the
+    `averaging_time` of a `RunMetrics`. """
+
+    def __init__(self, window, metrics):
+        self._window = window
+        self._metrics = metrics
+
+    def __len__(self):
+        return len(self._window)
+
+    def push(self, value):
+        start = default_timer()
+        self._window.push(value)
+        self._metrics.averaging_time += default_timer() - start
+
+    @property
+    def mean(self):
+        start = default_timer()
+        mean = self._window.mean
+        self._metrics.averaging_time += default_timer() - start
+        return mean
@@ -0,0 +1,418 @@
+""" Monte Carlo uncertainty runs with streaming statistics.
+
+`MonteCarlo` draws model parameters and initial conditions from
+distributions, runs the members in batches as `EstuaryEnsemble`s (in
+parallel, in a pool of worker processes) and folds the output of each batch
+into running statistics per output time and variable:
+
+- mean and variance, merged batch by batch (Chan et al.'s parallel form of
+  Welford's algorithm);
+- approximate quantiles, with the P-square algorithm of Jain and Chlamtac
+  (1985), which tracks five markers per quantile instead of the
+  observations.
+
+Only one batch of trajectories per worker is ever in memory, so the memory
+a study takes does not grow with its number of members. For example,
+
+>>> mc = MonteCarlo(dict(G=('uniform', 1., 5.), P=('normal', 1., 0.2)),
+...                 base_kwargs=dict(V=1e9, S=35., N=20., O=231.2))
+>>> summary = mc.run(100000, dt=1., t_end=24*42.)
+>>> summary['O']['q50']
+
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from numpy import (arange, array, asarray, column_stack, empty, float64,
+                   maximum, minimum, percentile, sign, sqrt, where, zeros)
+from numpy.random import RandomState
+from pandas import DataFrame, Index, MultiIndex
+
+try:
+    from .estuary import EstuaryEnsemble
+    from .result import COLUMNS
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from estuary import EstuaryEnsemble
+    from result import COLUMNS
+
+#: Parameters drawn from distributions by default studies; any other
+#: `EstuaryModel` argument may be sampled as well
+SAMPLED_PARAMS = ('G', 'P', 'N_river', 'river_flow_rate', 'S', 'N', 'O')
+
+
+def sample(distributions, size, random_state):
+    """ Draw `size` values of each parameter.
+
+    Parameters
+    ----------
+    distributions : dict
+        Maps parameter names to their distributions, each of which is
+        either a fixed value; a tuple of the name of a `RandomState` method
+        and its arguments, e.g. `('uniform', 1., 5.)` or
+        `('normal', 20., 2.)`; or a function called as
+        `func(random_state, size)`
+    size : int
+        Number of values to draw
+    random_state : RandomState
+        Source of random numbers
+
+    Returns
+    -------
+    samples : dict
+        Arrays of `size` values, by parameter name; parameters are drawn in
+        sorted order, so that a seed reproduces the same samples
+
+    """
+
+    samples = {}
+    for name in sorted(distributions):
+        dist = distributions[name]
+        if callable(dist):
+            values = dist(random_state, size)
+        elif isinstance(dist, (tuple, list)):
+            values = getattr(random_state, dist[0])(*dist[1:], size=size)
+        else:
+            values = [dist]*size
+        samples[name] = asarray(values, dtype=float)
+    return samples
+
+
+def run_batch(args):
+    """ Run a batch of members as an ensemble and return their output.
+
+    Parameters
+    ----------
+    args : tuple
+        The sampled parameters (as for `sample`), the arguments shared by
+        every member, and the arguments for `EstuaryEnsemble.run_model`
+
+    Returns
+    -------
+    ts : array
+        Output times, in hours
+    output : array
+        Output of each member, with shape `(n_members, n_times, 5)` and the
+        columns (in order) of `result.COLUMNS`
+
+    """
+
+    samples, base_kwargs, run_kwargs = args
+    n_members = len(next(iter(samples.values())))
+    kwargs_list = []
+    for i in range(n_members):
+        kwargs = dict(base_kwargs)
+        kwargs.update((name, float(values[i]))
+                      for name, values in samples.items())
+        kwargs_list.append(kwargs)
+
+    ensemble = EstuaryEnsemble.from_kwargs(kwargs_list)
+    traj = ensemble.run_model(as_frame=False, **run_kwargs)
+
+    # Convert to the output columns, member-major
+    ys = traj.ys.transpose(1, 0, 2)
+    V = ys[:, :, 0]
+    V0 = ensemble.V[:, None]
+    output = empty(V.shape + (len(COLUMNS), ))
+    output[:, :, 0] = 100*(V - V0)/V0
+    output[:, :, 1] = ys[:, :, 1]/V
+    output[:, :, 2] = ys[:, :, 2]/V
+    output[:, :, 3] = ys[:, :, 3]/V
+    output[:, :, 4] = V/ensemble.estuary_area[:, None]
+    return traj.ts.copy(), output
+
+
+class RunningMoments(object):
+
+    """ Running count, mean and variance of arrays of observations.
+
+    Parameters
+    ----------
+    shape : tuple of ints
+        Shape of each observation
+
+    """
+
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = zeros(shape)
+        self._m2 = zeros(shape)
+
+    def update(self, batch):
+        """ Fold in a batch of observations, stacked along the first
+        axis. """
+        batch = asarray(batch, dtype=float64)
+        n = batch.shape[0]
+        if n == 0:
+            return
+        batch_mean = batch.mean(axis=0)
+        batch_m2 = ((batch - batch_mean)**2).sum(axis=0)
+
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta*(n/float(total))
+        self._m2 = self._m2 + batch_m2 + delta**2*(self.count*n/float(total))
+        self.count = total
+
+    @property
+    def variance(self):
+        """ Sample variance (with one degree of freedom removed). """
+        if self.count < 2:
+            return zeros(self.mean.shape) + float('nan')
+        return self._m2/(self.count - 1)
+
+    @property
+    def std(self):
+        return sqrt(self.variance)
+
+
+class P2Quantiles(object):
+
+    """ Streaming estimates of quantiles with the P-square algorithm.
+
+    Each quantile of each element of the observations is tracked by five
+    markers, whose heights are adjusted with piecewise-parabolic
+    interpolation as observations arrive; the middle marker estimates the
+    quantile. The markers of every element and quantile are updated at
+    once, as whole arrays. Until five observations have arrived, the
+    quantiles are computed exactly.
+
+    Parameters
+    ----------
+    probs : sequence of floats
+        Probabilities of the quantiles to estimate, between 0 and 1
+    shape : tuple of ints
+        Shape of each observation
+
+    """
+
+    def __init__(self, probs, shape):
+        self.probs = array(probs, dtype=float)
+        self.shape = tuple(shape)
+        self.count = 0
+        self._first = empty((5, ) + self.shape)
+
+        p = self.probs[:, None]
+        # Desired marker positions (shared by every element) and their
+        # increments per observation
+        self._desired = array([1., 1., 1., 3., 5.]) + \
+            array([0., 2., 4., 2., 0.])*p
+        self._increment = column_stack([0.*p, p/2., p, (1. + p)/2., 1. + 0.*p])
+        self._heights = None
+        self._positions = None
+
+    def update(self, x):
+        """ Fold in one observation, an array of the shape given. """
+        x = asarray(x, dtype=float64)
+        if self.count < 5:
+            self._first[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                self._start()
+            return
+        self.count += 1
+
+        q = self._heights
+        n = self._positions
+        x = x.reshape(-1, 1)
+
+        # Extend the extreme markers to new minima and maxima, and move the
+        # markers above `x` up by one position
+        q[:, :, 0] = minimum(q[:, :, 0], x)
+        q[:, :, 4] = maximum(q[:, :, 4], x)
+        n[:, :, 1:4] += x[:, :, None] < q[:, :, 1:4]
+        n[:, :, 4] += 1.
+        self._desired += self._increment
+
+        # Adjust the heights of the middle markers which are off their
+        # desired positions by one or more; only a few of them are at each
+        # observation, so the adjustment is computed for those alone
+        for i in (1, 2, 3):
+            d = self._desired[:, i] - n[:, :, i]
+            move = (((d >= 1.) & (n[:, :, i+1] - n[:, :, i] > 1.)) |
+                    ((d <= -1.) & (n[:, :, i-1] - n[:, :, i] < -1.)))
+            cells, probs = move.nonzero()
+            if not cells.size:
+                continue
+            d = sign(d[cells, probs])
+            qs = q[cells, probs]
+            ns = n[cells, probs]
+
+            gap_up = ns[:, i+1] - ns[:, i]
+            gap_down = ns[:, i] - ns[:, i-1]
+            parabolic = qs[:, i] + d/(ns[:, i+1] - ns[:, i-1])*(
+                (gap_down + d)*(qs[:, i+1] - qs[:, i])/gap_up +
+                (gap_up - d)*(qs[:, i] - qs[:, i-1])/gap_down)
+            linear = where(d > 0,
+                           qs[:, i] + (qs[:, i+1] - qs[:, i])/gap_up,
+                           qs[:, i] - (qs[:, i] - qs[:, i-1])/gap_down)
+            bracketed = (qs[:, i-1] < parabolic) & (parabolic < qs[:, i+1])
+            q[cells, probs, i] = where(bracketed, parabolic, linear)
+            n[cells, probs, i] += d
+
+    def _start(self):
+        """ Place the markers at the first five observations, sorted. """
+        first = self._first.copy()
+        first.sort(axis=0)
+        # Markers are kept as (elements, probabilities, markers)
+        heights = first.reshape(5, -1).T
+        n_probs = self.probs.shape[0]
+        self._heights = heights[:, None, :].repeat(n_probs, axis=1)
+        self._positions = zeros(self._heights.shape) + arange(1., 6.)
+
+    @property
+    def values(self):
+        """ Current estimates, with shape `shape + (len(probs), )`. """
+        if self.count >= 5:
+            return self._heights[:, :, 2].reshape(self.shape + (-1, ))
+        if self.count == 0:
+            return zeros(self.shape + self.probs.shape) + float('nan')
+        exact = percentile(self._first[:self.count], 100*self.probs, axis=0)
+        return exact.transpose(tuple(range(1, exact.ndim)) + (0, ))
+
+
+class MonteCarlo(object):
+
+    """ Monte Carlo study of the estuary model's output.
+
+    Parameters
+    ----------
+    distributions : dict
+        Distributions of the sampled `EstuaryModel` arguments (e.g. those in
+        `SAMPLED_PARAMS`, with `S`, `N` and `O` being the initial state);
+        see `sample`
+    base_kwargs : dict, optional
+        `EstuaryModel` arguments shared by every member; must include
+        whichever of the initial state `V`, `S`, `N`, `O` aren't sampled
+    quantiles : sequence of floats
+        Probabilities of the quantiles to estimate
+    batch_size : int
+        Number of members run together as one `EstuaryEnsemble`
+    max_workers : int, optional
+        Number of worker processes; defaults to the number of CPUs. If 1,
+        the batches are run serially in this process.
+    seed : int, optional
+        Seed for sampling, for reproducible studies
+
+    Attributes
+    ----------
+    time : array
+        Output times, in hours, once members have been run
+    moments : RunningMoments
+        Running mean and variance of the output, with shape
+        `(n_times, 5)`
+    quantiles : P2Quantiles
+        Running quantile estimates of the output
+
+    """
+
+    def __init__(self, distributions, base_kwargs=None,
+                 quantiles=(0.05, 0.5, 0.95), batch_size=256,
+                 max_workers=None, seed=None):
+        self.distributions = dict(distributions)
+        self.base_kwargs = dict(base_kwargs or {})
+        self.probs = tuple(quantiles)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.random_state = RandomState(seed)
+
+        self.time = None
+        self.moments = None
+        self.quantiles = None
+        self._run_kwargs = None
+
+    @property
+    def n_members(self):
+        return 0 if self.moments is None else self.moments.count
+
+    def run(self, n_members, dt=1., t_end=1000., t_spinup=48.,
+            progress=None):
+        """ Run `n_members` more members and fold their output into the
+        running statistics.
+
+        Parameters
+        ----------
+        n_members : int
+            Number of members to run
+        dt, t_end, t_spinup : floats
+            See `EstuaryModel.run_model`; must be the same for every call
+        progress : function, optional
+            Called as `progress(n_done, n_members)` after each batch
+
+        Returns
+        -------
+        summary : DataFrame
+            See `summary`
+
+        """
+
+        run_kwargs = dict(dt=dt, t_end=t_end, t_spinup=t_spinup)
+        if self._run_kwargs not in (None, run_kwargs):
+            raise ValueError("Members must all be run with the same dt, "
+                             "t_end and t_spinup")
+        self._run_kwargs = run_kwargs
+
+        sizes = [min(self.batch_size, n_members - start)
+                 for start in range(0, n_members, self.batch_size)]
+
+        def _batches():
+            for size in sizes:
+                samples = sample(self.distributions, size, self.random_state)
+                yield samples, self.base_kwargs, run_kwargs
+
+        n_done = 0
+        for ts, output in self._imap(_batches()):
+            self._accumulate(ts, output)
+            n_done += output.shape[0]
+            if progress is not None:
+                progress(n_done, n_members)
+
+        return self.summary()
+
+    def _imap(self, batches):
+        """ Run the batches in worker processes, keeping only a couple of
+        batches per worker in flight so that finished output doesn't pile
+        up while it is folded into the statistics. """
+        if self.max_workers == 1:
+            for args in batches:
+                yield run_batch(args)
+            return
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            limit = 2*(self.max_workers or os.cpu_count() or 1)
+            pending = deque()
+            for args in batches:
+                pending.append(executor.submit(run_batch, args))
+                if len(pending) >= limit:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _accumulate(self, ts, output):
+        if self.moments is None:
+            self.time = ts
+            shape = output.shape[1:]
+            self.moments = RunningMoments(shape)
+            self.quantiles = P2Quantiles(self.probs, shape)
+        self.moments.update(output)
+        for member in output:
+            self.quantiles.update(member)
+
+    def summary(self):
+        """ The statistics so far, as a DataFrame indexed by time in hours,
+        with columns for each output variable (as in the output of
+        `EstuaryModel.run_model`) and statistic: 'mean', 'std', and e.g.
+        'q5', 'q50', 'q95' for the quantiles. """
+        if self.moments is None:
+            raise ValueError("No members have been run yet")
+        stats = ['mean', 'std'] + ["q{:g}".format(100*p) for p in self.probs]
+        quantiles = self.quantiles.values
+        data = empty((self.time.shape[0], len(COLUMNS), len(stats)))
+        data[:, :, 0] = self.moments.mean
+        data[:, :, 1] = self.moments.std
+        data[:, :, 2:] = quantiles
+        columns = MultiIndex.from_product([list(COLUMNS), stats],
+                                          names=['variable', 'statistic'])
+        return DataFrame(data.reshape(self.time.shape[0], -1),
+                         columns=columns,
+                         index=Index(self.time, name='time'))
@@ -0,0 +1,112 @@
+""" Compact, array-backed model output.
+
+Building the DataFrame which `EstuaryModel.run_model` returns by default
+costs a copy of the trajectory, divisions of three of its columns and two
+more columns besides. Callers who only need a few numbers from each of many
+runs can ask for a `ModelResult` instead, which keeps the raw trajectory as
+one contiguous array per state variable (optionally in single precision)
+and computes concentrations, tidal height and volume change only when they
+are asked for.
+
+"""
+
+from numpy import asarray
+from pandas import DataFrame, Index
+
+#: Columns of model output, as in the DataFrame returned by `run_model`
+COLUMNS = ('V', 'S', 'N', 'O', 'Z')
+
+
+class ModelResult(object):
+
+    """ Output of a model run, stored as raw state arrays.
+
+    Columns are computed on demand with the same definitions and units as
+    the DataFrame returned by `EstuaryModel.run_model`: S, N and O are
+    concentrations, Z is tidal height in m and V is % change from the
+    initial volume. Individual columns can be read by name (`result['S']`),
+    and `to_frame` builds the equivalent DataFrame.
+
+    Parameters
+    ----------
+    time : array
+        Output times, in hours
+    states : array
+        Raw model states (volume and amounts of S, N and O) at each output
+        time, with shape (len(time), 4)
+    V0 : float
+        Initial estuary volume, in m3
+    estuary_area : float
+        Surface area of the estuary, in m2
+    dtype : dtype
+        Floating-point type to store the output as
+
+    Attributes
+    ----------
+    time : array
+        Output times, in hours
+    volume, salt, nitrate, oxygen : arrays
+        Contiguous arrays of the raw model states
+    converged_at : float
+        Time in hours at which the run reached a periodic steady state, or
+        None; see `EstuaryModel.run_model`
+
+    """
+
+    __slots__ = ('time', 'volume', 'salt', 'nitrate', 'oxygen', 'V0',
+                 'estuary_area', 'converged_at')
+
+    def __init__(self, time, states, V0, estuary_area, dtype=float):
+        self.time = asarray(time, dtype=dtype).copy()
+        # One transposed copy gives a contiguous row per state variable
+        soa = asarray(states).T.astype(dtype, order='C')
+        self.volume, self.salt, self.nitrate, self.oxygen = soa
+        self.V0 = V0
+        self.estuary_area = estuary_area
+        self.converged_at = None
+
+    def __len__(self):
+        return self.time.shape[0]
+
+    def __repr__(self):
+        return "ModelResult(n={}, t={:g}..{:g}, dtype={})".format(
+            len(self), self.time[0], self.time[-1], self.time.dtype)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in
+                   ('time', 'volume', 'salt', 'nitrate', 'oxygen'))
+
+    @property
+    def columns(self):
+        return list(COLUMNS)
+
+    def __getitem__(self, column):
+        if column == 'V':
+            return 100*(self.volume - self.V0)/self.V0
+        elif column == 'S':
+            return self.salt/self.volume
+        elif column == 'N':
+            return self.nitrate/self.volume
+        elif column == 'O':
+            return self.oxygen/self.volume
+        elif column == 'Z':
+            return self.volume/self.estuary_area
+        raise KeyError(column)
+
+    def final(self):
+        """ Values of each column at the end of the run, by name. """
+        last = ModelResult(self.time[-1:], [[self.volume[-1], self.salt[-1],
+                                             self.nitrate[-1],
+                                             self.oxygen[-1]]],
+                           self.V0, self.estuary_area, self.time.dtype)
+        return dict((column, last[column][0]) for column in COLUMNS)
+
+    def to_frame(self, columns=COLUMNS):
+        """ Convert (some of the `columns` of) the output to a DataFrame
+        indexed by time in hours, like that returned by `run_model`. """
+        frame = DataFrame(dict((column, self[column]) for column in columns),
+                          columns=list(columns),
+                          index=Index(self.time, name='time'))
+        frame.attrs['converged_at'] = self.converged_at
+        return frame
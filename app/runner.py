@@ -0,0 +1,85 @@
+""" Background execution of model runs for the app.
+
+Running the model inside a Bokeh server callback blocks the server's event
+loop, and with it every connected session, until the run finishes. Instead,
+the app hands runs to the pool of worker threads here, which is shared by
+every session in the server process, and applies their results to the
+document from next-tick callbacks.
+
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pandas import concat
+
+#: Number of model runs executed at once; set the environment variable
+#: ESTUARY_WORKERS before starting the server to override
+MAX_WORKERS = int(os.environ.get("ESTUARY_WORKERS", 4))
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRun(object):
+
+    """ Handle on a model run submitted to the executor, which lets it be
+    cancelled once it has been superseded by a newer request. Cancellation
+    takes effect between chunks of output. """
+
+    def __init__(self):
+        self.cancelled = False
+        self.future = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+
+    def _log_errors(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Model run failed", exc_info=future.exception())
+
+
+def stream_in_background(chunks, on_chunk=None, on_done=None):
+    """ Consume an iterator of output chunks (see `lattice.iter_scenario`)
+    on a worker thread.
+
+    Parameters
+    ----------
+    chunks : iterator of DataFrames
+        Output of a model run, which is computed as it is iterated over
+    on_chunk : function, optional
+        Called from the worker thread as `on_chunk(run, chunk)` with each
+        chunk as it is computed
+    on_done : function, optional
+        Called from the worker thread as `on_done(run, results)` with the
+        complete output once the run finishes, unless it has been cancelled
+
+    Returns
+    -------
+    run : ModelRun
+        Handle for cancelling the run
+
+    """
+
+    # The handle exists before the work is submitted, and is passed to the
+    # callbacks, which may be called before this function returns
+    run = ModelRun()
+
+    def _work():
+        pieces = []
+        for chunk in chunks:
+            if run.cancelled:
+                return
+            pieces.append(chunk)
+            if on_chunk is not None:
+                on_chunk(run, chunk)
+        if on_done is not None and not run.cancelled:
+            on_done(run, concat(pieces))
+
+    run.future = executor.submit(_work)
+    run.future.add_done_callback(run._log_errors)
+    return run
@@ -0,0 +1,434 @@
+""" A 1-D, segmented version of the estuary box-model.
+
+`SegmentedEstuaryModel` divides the estuary along its channel into a chain
+of equal boxes, from the river end (box 0) to the ocean end (box N-1). Each
+box carries the same state and the same biology and gas exchange as the
+single box of `EstuaryModel`. The boxes are coupled by transport across
+their faces:
+
+    - the river enters box 0 and flows seaward through every box, leaving
+      through the mouth of box N-1;
+    - the tide acts at the mouth of box N-1. The water level rises and falls
+      uniformly along the estuary, so the flow across each face fills or
+      drains all the boxes landward of it;
+    - tidal dispersion exchanges water between neighbouring boxes, and
+      between box N-1 and the ocean, without any net flow.
+
+Advection is upwind. The state and the tendencies are whole-array
+operations over the segments, so a step costs about the same for 10 boxes
+as for 200. Transport across small boxes is much faster than the hourly
+timesteps of the single-box model: the flow through the mouth every hour
+can exceed the volume of the last box many times over. The marching
+scheme in `run_model` therefore treats the biology and gas exchange
+explicitly, as forward Euler does, and transport implicitly (backward
+Euler). That scheme is stable and keeps concentrations positive at any
+timestep. Each step solves one tridiagonal system by cyclic reduction,
+which is also vectorized across the segments.
+
+"""
+
+from numpy import (arange, array, asarray, ceil, column_stack, cumsum, empty,
+                   maximum, ones, pi, repeat, sin, tile, zeros)
+from pandas import DataFrame, MultiIndex
+
+try:
+    from .estuary import RollingMean, Trajectory
+    from .kernels import euler_times
+    from .tides import no_tidal_flow
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from estuary import RollingMean, Trajectory
+    from kernels import euler_times
+    from tides import no_tidal_flow
+
+
+def solve_tridiagonal(lower, diag, upper, rhs):
+    """ Solve a tridiagonal system of equations by parallel cyclic
+    reduction.
+
+    Every iteration eliminates the coupling of each equation to its
+    neighbours at twice the distance of the previous one, for all the
+    equations at once. The system is solved after ceil(log2(n))
+    iterations, without any loop over the equations. The reduction is
+    stable for diagonally dominant systems.
+
+    Parameters
+    ----------
+    lower, diag, upper : arrays
+        Sub-diagonal, diagonal and super-diagonal of the matrix, each of
+        length n; `lower[0]` and `upper[-1]` are ignored
+    rhs : array
+        Right-hand side(s), with shape (n, ) or (n, k)
+
+    Returns
+    -------
+    x : array
+        Solution, with the same shape as `rhs`
+
+    """
+
+    n = diag.shape[0]
+    extra = (1, ) * (rhs.ndim - 1)
+    # Pad with decoupled identity equations, so that neighbours beyond
+    # either end can be read without special cases
+    a = zeros((3*n, ) + extra)
+    b = ones((3*n, ) + extra)
+    c = zeros((3*n, ) + extra)
+    d = zeros((3*n, ) + rhs.shape[1:])
+    inner = slice(n, 2*n)
+    a[inner, ...] = lower.reshape((n, ) + extra)
+    a[n] = 0.
+    b[inner, ...] = diag.reshape((n, ) + extra)
+    c[inner, ...] = upper.reshape((n, ) + extra)
+    c[2*n - 1] = 0.
+    d[inner] = rhs
+
+    stride = 1
+    while stride < n:
+        below = slice(n - stride, 2*n - stride)
+        above = slice(n + stride, 2*n + stride)
+        alpha = -a[inner]/b[below]
+        gamma = -c[inner]/b[above]
+        a_new = alpha*a[below]
+        c_new = gamma*c[above]
+        b[inner] = b[inner] + alpha*c[below] + gamma*a[above]
+        d[inner] = d[inner] + alpha*d[below] + gamma*d[above]
+        a[inner] = a_new
+        c[inner] = c_new
+        stride *= 2
+
+    return d[inner]/b[inner]
+
+
+class SegmentedEstuaryModel(object):
+
+    """ Estuary model with N well-mixed boxes along its channel.
+
+    Parameters
+    ----------
+    V : float
+        Initial (average) volume of the whole estuary, in m3, divided
+        equally between the segments
+    S, N, O : floats or arrays of floats
+        Initial salinity [kg/m3] and molar concentrations of nitrogen and
+        oxygen [mmol/m3], either uniform or for each segment from the river
+        end to the ocean end
+    n_segments : int
+        Number of boxes along the channel
+    length : float
+        Length of the estuary along its channel, in m
+    dispersion : float
+        Longitudinal (tidal) dispersion coefficient, in m2/s
+    z, tide_func, river_flow_rate, N_river, O_river, S_ocean, N_ocean,
+    O_ocean, G, P :
+        As for `EstuaryModel`. The river flow is relative to the volume of
+        the whole estuary, and the tidal forcing is the rate of change of
+        the water level everywhere along it.
+
+    Attributes
+    ----------
+    y0 : array of floats
+        Model initial conditions, with shape `(n_segments, 4)`
+    V0 : float
+        Initial estuary volume, in m3
+    segment_volume, segment_area : floats
+        Initial volume [m3] and surface area [m2] of each segment
+    river_flow : float
+        River inflow, in m3/hr
+    exchange_flow : float
+        Dispersive exchange flow across each face of a segment, in m3/hr
+    trajectory : Trajectory
+        Raw (un-converted) state history from the most recent call to
+        `run_model`, with states of shape `(n_segments, 4)`
+
+    """
+
+    def __init__(self, V, S, N, O, n_segments=50, length=20e3,
+                 dispersion=50., z=5., tide_func=no_tidal_flow,
+                 river_flow_rate=0.05, N_river=100., O_river=231.2,
+                 S_ocean=35., N_ocean=20., O_ocean=231.2,
+                 G=3., P=1.):
+
+        if n_segments < 1:
+            raise ValueError("n_segments must be at least 1")
+
+        # Bind initial conditions
+        self.V = V
+        self.S = S
+        self.N = N
+        self.O = O
+
+        # Bind geometry, model parameters and arguments
+        self.n_segments = n_segments
+        self.length = length
+        self.dispersion = dispersion
+        self.tide_func = tide_func
+        self.z = z
+
+        self.river_flow_rate = river_flow_rate
+        self.N_river = N_river
+        self.O_river = O_river
+
+        self.S_ocean = S_ocean
+        self.N_ocean = N_ocean
+        self.O_ocean = O_ocean
+
+        self.G = G
+        self.P = P
+
+        # Infer additional parameters
+        self.V0 = V
+        self.segment_volume = V/float(n_segments)
+        self.segment_area = self.segment_volume/z
+        self.river_flow = river_flow_rate*V
+
+        # Exchange flow K*A/dx through a cross-section A = V/length between
+        # the centres of boxes dx = length/n_segments apart, in m3/hr
+        dx = length/float(n_segments)
+        self.exchange_flow = 3600.*dispersion*(V/length)/dx
+
+        V_seg = self.segment_volume*ones(n_segments)
+        self.y0 = column_stack([V_seg] + [asarray(c, dtype=float)*V_seg
+                                          for c in (S, N, O)])
+
+        # Concentrations carried in by the river and from the ocean
+        self._c_river = array([0., N_river, O_river])
+        self._c_ocean = array([S_ocean, N_ocean, O_ocean])
+
+        self.trajectory = None
+
+    def __len__(self):
+        return self.n_segments
+
+    def tide_at(self, ts):
+        """ Evaluate the tidal forcing at an array of times at once. """
+        tide_func = getattr(self.tide_func, 'flow', self.tide_func)
+        try:
+            values = asarray(tide_func(ts), dtype=float)
+        except (ValueError, TypeError):
+            # Only works on scalars, e.g. by branching on `t`
+            values = None
+        if values is None or values.shape != ts.shape:
+            # Not vectorized, e.g. the default `no_tidal_flow`
+            values = array([self.tide_func(t) for t in ts], dtype=float)
+        return values
+
+    def transport(self, tide):
+        """ Flows across the faces of the segments, as the bands of the
+        (tridiagonal) transport operator.
+
+        Parameters
+        ----------
+        tide : float
+            Tidal forcing (rate of water level change) in m/hr
+
+        Returns
+        -------
+        lower, diag, upper : arrays
+            Rates in m3/hr at which each segment exchanges water with the
+            segment landward of it, itself, and the segment seaward of it;
+            the tendency of the amounts of S, N and O from transport is
+            `inflow - diag*C - lower*C[i-1] - upper*C[i+1]` for the
+            concentrations C.
+        inflow : array
+            Amounts of S, N and O carried into each segment by the river and
+            from the ocean, in kg/hr or mmol/hr, with shape `(n_segments, 3)`
+
+        """
+
+        n = self.n_segments
+        Q = self.river_flow
+        E = self.exchange_flow
+
+        # Landward tidal flow across the seaward face of each segment, which
+        # fills every segment landward of it
+        T = cumsum(self.segment_area*tide*ones(n))
+        flood = maximum(T, 0.)
+        ebb = maximum(-T, 0.)
+
+        # Flows out of each segment: river, ebb and dispersion seaward;
+        # flood and dispersion landward (except from the landward end)
+        diag = Q + ebb + E
+        diag[1:] += flood[:-1] + E
+
+        lower = zeros(n)
+        lower[1:] = -(Q + ebb[:-1] + E)
+        upper = zeros(n)
+        upper[:-1] = -(flood[:-1] + E)
+
+        inflow = zeros((n, 3))
+        inflow[0] += Q*self._c_river
+        inflow[-1] += (flood[-1] + E)*self._c_ocean
+
+        return lower, diag, upper, inflow
+
+    def reactions(self, y, t, P_scale=1.0):
+        """ Sources and sinks of N and O in each segment from biological
+        production and gas exchange, in mmol/hr; see
+        `EstuaryModel.estuary_ode`. Returns an array with shape
+        `(n_segments, 3)` for S, N and O. """
+
+        V = y[:, 0]
+        O = y[:, 3]/V
+        area = self.segment_area
+
+        # Biological production minus respiration
+        J = P_scale*self.P*(125.*16./154.)*sin(2.*pi*(t+0.75)/24. + pi)
+
+        sources = zeros((self.n_segments, 3))
+        sources[:, 1] = -J*area
+        sources[:, 2] = J*(154./16.)*area \
+            + (self.G/24.)*(self.O_river - O)*area
+        return sources
+
+    def estuary_ode(self, y, t, P_scale=1.0, tide=None):
+        """ Model system of ODEs, evaluated for every segment at once.
+
+        Parameters
+        ----------
+        y : array
+            The current state of each segment, with shape
+            `(n_segments, 4)`; see `EstuaryModel.estuary_ode`
+        t : float
+            The current evaluation time, in hours.
+        P_scale : float or array of floats
+            Factor to scale system productivity, either for all segments or
+            for each one individually
+        tide : float, optional
+            Tidal forcing at time `t`, if already evaluated
+
+        Returns
+        -------
+        dy_dt : array
+            Derivative of the current state-time, with shape
+            `(n_segments, 4)`.
+
+        """
+
+        if tide is None:
+            tide = self.tide_func(t)
+        lower, diag, upper, inflow = self.transport(tide)
+
+        C = y[:, 1:]/y[:, :1]
+        neighbours = zeros(C.shape)
+        neighbours[1:] += lower[1:, None]*C[:-1]
+        neighbours[:-1] += upper[:-1, None]*C[1:]
+
+        dy_dt = empty(y.shape)
+        dy_dt[:, 0] = self.segment_area*tide
+        dy_dt[:, 1:] = self.reactions(y, t, P_scale) + inflow \
+            - diag[:, None]*C - neighbours
+        return dy_dt
+
+    def step(self, y, t, dt, tide, P_scale=1.0):
+        """ Advance the state `y` by one timestep `dt` to time `t`,
+        explicitly for the biology and gas exchange and implicitly for
+        transport.
+
+        Parameters
+        ----------
+        y : array
+            The current state of each segment, with shape
+            `(n_segments, 4)`
+        t : float
+            Time at the end of the step, at which the tendencies are
+            evaluated, as in the forward Euler step of `EstuaryModel`
+        dt : float
+            Timestep, in hours
+        tide : float
+            Tidal forcing at time `t`
+        P_scale : float or array of floats
+            Factor to scale system productivity
+
+        Returns
+        -------
+        new_y : array
+            The state at time `t`
+
+        """
+
+        lower, diag, upper, inflow = self.transport(tide)
+
+        new_y = empty(y.shape)
+        new_y[:, 0] = maximum(y[:, 0] + dt*self.segment_area*tide, 0.)
+
+        # (V_new + dt*diag) C_new + dt*(lower C_new[i-1] + upper C_new[i+1])
+        # = amounts now + dt*(sources + inflow)
+        amounts = y[:, 1:] + dt*(self.reactions(y, t, P_scale) + inflow)
+        C = solve_tridiagonal(dt*lower, new_y[:, 0] + dt*diag, dt*upper,
+                              maximum(amounts, 0.))
+        new_y[:, 1:] = C*new_y[:, :1]
+        return new_y
+
+    def run_model(self, dt=1., t_end=1000., t_spinup=48.):
+        """ Run the model, marching every segment together.
+
+        Parameters
+        ----------
+        dt, t_end, t_spinup : floats
+            See `EstuaryModel.run_model`. After spin-up, the productivity of
+            each segment is scaled by its own N concentration averaged over
+            the last 24 hours.
+
+        Returns
+        -------
+        result : DataFrame
+            A long-format DataFrame with the same columns as returned by
+            `EstuaryModel.run_model`, indexed by segment number (from the
+            river end) and time in hours. The raw, stacked state history is
+            retained in the `trajectory` attribute.
+
+        """
+
+        ts = euler_times(dt, t_end)
+        tides = self.tide_at(ts[1:])
+
+        traj = Trajectory(ts.size, n_vars=self.y0.shape)
+        traj.append(0., self.y0)
+
+        # Track the N concentration of each segment over the last 24 hours
+        N_24hrs = RollingMean(int(ceil(24./dt)), shape=(self.n_segments, ))
+        N_24hrs.push(self.y0[:, 2]/self.y0[:, 0])
+
+        # Main integration loop
+        for t, tide in zip(ts[1:], tides):
+            y = traj.last
+
+            # If we're past spin-up, then average the N concentration over
+            # the last 24 hours to scale productivity
+            if traj.ts[-1] > t_spinup:
+                P_scale = N_24hrs.mean/self.N_ocean
+            else:
+                P_scale = 1.
+
+            new_y = self.step(y, t, dt, tide, P_scale)
+            traj.append(t, new_y)
+            N_24hrs.push(new_y[:, 2]/new_y[:, 0])
+
+        self.trajectory = traj
+        return self._to_frame(traj)
+
+    def _to_frame(self, traj):
+        """ Shape the raw trajectory into a long DataFrame, segment-major,
+        with concentrations, tidal height and % volume change. """
+        n_times = len(traj)
+        out = traj.ys.transpose(1, 0, 2).reshape(-1, 4)
+        index = MultiIndex.from_arrays(
+            [repeat(arange(self.n_segments), n_times),
+             tile(traj.ts, self.n_segments)],
+            names=['segment', 'time']
+        )
+        result = DataFrame(data=out, columns=['V', 'S', 'N', 'O'],
+                           dtype=float, index=index)
+
+        # Convert to molar concentrations
+        result.S /= result.V
+        result.N /= result.V
+        result.O /= result.V
+
+        # Add tidal height (meters) and convert volume to percentage relative
+        # to initial
+        result['Z'] = result.V/self.segment_area
+        result.V = 100*(result.V - self.segment_volume)/self.segment_volume
+
+        return result
+
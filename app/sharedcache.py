@@ -0,0 +1,285 @@
+""" On-disk cache of model results shared between processes.
+
+`bokeh serve --num-procs N` (or several server instances behind a proxy)
+gives every worker process its own `cache.results_cache`, so a run which one
+process has computed is still cold in all the others. A `SharedResultCache`
+keeps results in a directory which every process on the machine reads and
+writes instead:
+
+- each result is one `.npy` file named by a hash of its cache key, and is
+  memory-mapped on reading; results whose columns share one dtype (such as
+  model output) are read as DataFrames backed by the mapping itself, so
+  processes share the pages of popular runs;
+- results are written to a temporary file and atomically renamed into
+  place, so readers never see partial files, and concurrent writers of the
+  same run simply replace one another's identical output;
+- entries are evicted once they haven't been used for `max_age` seconds,
+  and then least recently used first to keep the directory under
+  `max_bytes`; reading an entry refreshes its modification time.
+
+Sweeping the directory for eviction lists and stats every file, so each
+process only sweeps once the results it has written take its estimate of
+the cache size over `max_bytes`, or after every `sweep_every` writes to
+catch up with those of the other processes. Only one process at a time
+sweeps, guarded by a lock file where `fcntl` is available; reads and writes
+take no locks.
+
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from threading import Lock
+
+from numpy import empty, load, save
+from pandas import DataFrame, Index
+
+try:
+    import fcntl
+except ImportError:  # e.g. on Windows, where sweeps are left unguarded
+    fcntl = None
+
+#: Suffix of cached result files
+SUFFIX = ".npy"
+
+#: Age in seconds after which abandoned temporary files are removed
+STALE_TMP_AGE = 3600.
+
+
+def key_digest(key):
+    """ Content address of a cache key: a hash of its representation, which
+    is the same in every process for keys built from plain values by
+    `cache.make_key`. """
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def frame_to_records(results):
+    """ Pack a DataFrame, index first, into a structured array. """
+    index_name = results.index.name or 'index'
+    names = [index_name] + [str(c) for c in results.columns]
+    dtypes = [results.index.dtype] + list(results.dtypes)
+    records = empty(len(results), dtype=list(zip(names, dtypes)))
+    records[index_name] = results.index.values
+    for name, column in zip(names[1:], results.columns):
+        records[name] = results[column].values
+    return records
+
+
+def records_to_frame(records):
+    """ Unpack a structured array written by `frame_to_records`. If its
+    fields all have the same dtype, the columns of the DataFrame are a view
+    of `records` rather than a copy. """
+    names = records.dtype.names
+    index_name = None if names[0] == 'index' else names[0]
+    dtypes = set(records.dtype.fields[name][0] for name in names)
+    dtype = dtypes.pop() if len(dtypes) == 1 else None
+    if dtype is not None and \
+            records.dtype.itemsize == len(names)*dtype.itemsize:
+        values = records.view(dtype).reshape(len(records), len(names))
+        return DataFrame(values[:, 1:], columns=list(names[1:]),
+                         index=Index(values[:, 0], name=index_name),
+                         copy=False)
+    return DataFrame(dict((name, records[name]) for name in names[1:]),
+                     columns=list(names[1:]),
+                     index=Index(records[names[0]], name=index_name))
+
+
+class SharedResultCache(object):
+
+    """ Cache of model output DataFrames in a directory shared between
+    processes, with the same interface as `cache.ResultCache`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache; created if it doesn't exist
+    max_bytes : int
+        Approximate cap on the total size of the cached files
+    max_age : float, optional
+        Time in seconds after which entries which haven't been used are
+        evicted, if any
+    sweep_every : int
+        Largest number of results which this process writes between sweeps
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of lookups in this process which did and didn't find a
+        cached result
+
+    """
+
+    def __init__(self, path, max_bytes=1024**3, max_age=None,
+                 sweep_every=64):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_every = sweep_every
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        # Size of the cache at the last sweep plus that of the results
+        # written since by this process, and the number of those results;
+        # the size is unknown until the first sweep
+        self._nbytes = None
+        self._n_puts = 0
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def get(self, key, default=None):
+        """ Look up `key`, marking it as most recently used. """
+        path = self._path(key)
+        try:
+            records = load(path, mmap_mode='r')
+            result = records_to_frame(records)
+        except (IOError, OSError, ValueError):
+            # Missing, or evicted by another process since
+            with self._lock:
+                self.misses += 1
+            return default
+        try:
+            os.utime(path, None)
+        except OSError:
+            # e.g. a file written by another user; it's still a hit
+            pass
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """ Store the DataFrame `result` under `key`, sweeping the cache
+        for old results when due. Results larger than the whole cache are
+        not stored. """
+        records = frame_to_records(result)
+        if records.nbytes > self.max_bytes:
+            return
+
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                save(f, records)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            _remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._n_puts += 1
+            if self._nbytes is not None:
+                self._nbytes += records.nbytes
+            due = (self._nbytes is None or self._nbytes > self.max_bytes or
+                   self._n_puts >= self.sweep_every)
+        if due:
+            self.evict()
+
+    def get_or_run(self, key, func, *args, **kwargs):
+        """ Return the result cached under `key`, or compute it by calling
+        `func(*args, **kwargs)` and cache it. """
+        result = self.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        for path in self._listdir():
+            _remove(path)
+
+    def stats(self):
+        """ Dictionary summarizing the cache usage and hit rate, without
+        scanning the directory: `nbytes` is this process's estimate of the
+        size of the cache (see `put`), or None before its first sweep. """
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    hit_rate=(self.hits/lookups if lookups else 0.),
+                    nbytes=self._nbytes, max_bytes=self.max_bytes)
+
+    def evict(self):
+        """ Remove entries which are too old, and then the least recently
+        used ones until the cache fits in `max_bytes`. """
+        with _SweepLock(os.path.join(self.path, ".lock")):
+            now = time.time()
+            for path in self._listdir(".tmp"):
+                if _age(path, now) > STALE_TMP_AGE:
+                    _remove(path)
+
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                too_old = (self.max_age is not None and
+                           now - mtime > self.max_age)
+                if not too_old and total <= self.max_bytes:
+                    break
+                _remove(path)
+                total -= size
+
+            with self._lock:
+                self._nbytes = total
+                self._n_puts = 0
+
+    def _path(self, key):
+        return os.path.join(self.path, key_digest(key) + SUFFIX)
+
+    def _listdir(self, suffix=SUFFIX):
+        return [os.path.join(self.path, name)
+                for name in os.listdir(self.path) if name.endswith(suffix)]
+
+    def _entries(self):
+        """ Modification time, size and path of every cached file, skipping
+        any removed while listing. """
+        entries = []
+        for path in self._listdir():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+
+class _SweepLock(object):
+
+    """ Exclusive lock on the file at `path` between processes, as a
+    context manager; a no-op without `fcntl`. """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        return False
+
+
+def _age(path, now):
+    try:
+        return now - os.stat(path).st_mtime
+    except OSError:
+        return 0.
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
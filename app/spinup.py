@@ -0,0 +1,66 @@
+""" Cache of the checkpoints reached at the end of spin-up periods.
+
+Many runs share their parameters and only differ in how long they run for
+or in what happens after their first weeks. `spinup_checkpoint` keeps the
+checkpoints which such runs reach at a common time in a process-wide cache,
+so that they don't re-integrate the same spin-up; runs then continue from
+the checkpoint with `EstuaryModel.run_model(..., restart=checkpoint)`.
+
+"""
+
+import os
+from copy import copy
+
+try:
+    from .cache import ResultCache, make_key
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from cache import ResultCache, make_key
+
+#: Memory for cached spin-up checkpoints, in MB; set the environment
+#: variable ESTUARY_CHECKPOINT_MB to override
+CHECKPOINT_MB = float(os.environ.get("ESTUARY_CHECKPOINT_MB", 16))
+
+#: Spin-up checkpoints shared by every model in the process
+spinup_cache = ResultCache(max_bytes=int(CHECKPOINT_MB*1024**2))
+
+
+def spinup_checkpoint(model, t, dt=1., t_spinup=48., method='euler',
+                      backend='auto', cache=spinup_cache, **options):
+    """ Checkpoint of a model run at time `t`, from the cache if a run with
+    the same parameters and settings has reached it before; otherwise a
+    copy of the model is run up to `t` (leaving the state of `model` as it
+    was), and its checkpoint cached.
+
+    Parameters
+    ----------
+    model : EstuaryModel
+        The model to run
+    t : float
+        Time of the checkpoint, in hours
+    dt, t_spinup, method, backend, **options :
+        See `EstuaryModel.run_model`
+    cache : ResultCache
+        Where checkpoints are kept
+
+    Returns
+    -------
+    checkpoint : Checkpoint
+        For restarting runs of `model` with these settings from time `t`,
+        via `run_model(..., restart=checkpoint)`
+
+    """
+
+    parameters = model.parameters()
+    if parameters['tide_func'] is None:
+        raise ValueError("Can't restart runs with a tidal forcing which "
+                         "can't be recognized, such as a lambda; see "
+                         "tides.forcing_fingerprint")
+    key = make_key(parameters, t, dt, t_spinup, method, options=options)
+    checkpoint = cache.get(key)
+    if checkpoint is None:
+        spinup = copy(model)
+        spinup.run_model(dt=dt, t_end=t, t_spinup=t_spinup, method=method,
+                         backend=backend, as_frame=False, **options)
+        checkpoint = spinup.checkpoint
+        cache.put(key, checkpoint)
+    return checkpoint
@@ -0,0 +1,138 @@
+""" Parallel parameter sweeps over the estuary model.
+
+Runs of `EstuaryModel` for many different parameter sets are independent of
+one another, so they can be spread across a pool of worker processes.
+
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from inspect import Parameter, signature
+from itertools import product
+
+try:
+    from .estuary import EstuaryModel
+    from .integrators import INTEGRATORS
+except ImportError:  # loaded as a top-level module, e.g. by `bokeh serve`
+    from estuary import EstuaryModel
+    from integrators import INTEGRATORS
+
+
+def _keyword_names(func, skip=()):
+    """ Names of the arguments of `func` which can be passed by keyword,
+    other than `skip`. """
+    return [name for name, p in signature(func).parameters.items()
+            if name not in skip and
+            p.kind in (Parameter.POSITIONAL_OR_KEYWORD,
+                       Parameter.KEYWORD_ONLY)]
+
+
+#: Keyword arguments which are passed to `EstuaryModel.run_model` rather than
+#: to the model constructor: its own arguments, and the options of its
+#: integrators
+RUN_KWARGS = tuple(OrderedDict.fromkeys(
+    _keyword_names(EstuaryModel.run_model, skip=('self',)) +
+    [name for method in sorted(INTEGRATORS)
+     for name in _keyword_names(INTEGRATORS[method].__init__,
+                                skip=('self', 'f', 'y0', 'dt', 't0'))]
+))
+
+
+def expand_grid(grid):
+    """ Expand a dictionary mapping parameter names to sequences of values
+    into a list of keyword argument dictionaries, one per combination. """
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in product(*[grid[name] for name in names])]
+
+
+def param_key(kwargs, names):
+    """ Tuple of the values in `kwargs` for each of `names`, in order. """
+    return tuple(kwargs.get(name) for name in names)
+
+
+def split_kwargs(kwargs):
+    """ Split a combined dictionary of arguments into those for the
+    `EstuaryModel` constructor and those for `run_model`. """
+    model_kwargs = dict((k, v) for k, v in kwargs.items()
+                        if k not in RUN_KWARGS)
+    run_kwargs = dict((k, v) for k, v in kwargs.items()
+                      if k in RUN_KWARGS)
+    return model_kwargs, run_kwargs
+
+
+def run_one(kwargs):
+    """ Construct and run a single model from a combined dictionary of
+    constructor and `run_model` arguments. """
+    model_kwargs, run_kwargs = split_kwargs(kwargs)
+    return EstuaryModel(**model_kwargs).run_model(**run_kwargs)
+
+
+def imap(func, iterable, max_workers=None, chunksize=1):
+    """ Apply `func` to each item of `iterable` in a pool of worker
+    processes, yielding the results in order. If `max_workers` is 1, the
+    items are processed serially in this process instead. """
+    if max_workers == 1:
+        for item in iterable:
+            yield func(item)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(func, iterable, chunksize=chunksize):
+                yield result
+
+
+def sweep(params, base_kwargs=None, max_workers=None, chunksize=1,
+          progress=None):
+    """ Run the estuary model for many parameter sets in parallel.
+
+    Parameters
+    ----------
+    params : dict or list of dicts
+        Either a grid, mapping parameter names to sequences of values to
+        take every combination of, or an explicit list of keyword argument
+        dictionaries. Keys may be any `EstuaryModel` constructor argument
+        or any of `RUN_KWARGS` for `run_model`.
+    base_kwargs : dict, optional
+        Arguments shared by every run; values in `params` take precedence.
+        The initial state `V`, `S`, `N`, `O` must be given in one or the
+        other.
+    max_workers : int, optional
+        Number of worker processes; defaults to the number of CPUs. If 1,
+        the runs are performed serially in this process.
+    chunksize : int
+        Number of runs to send to a worker process at a time. Larger chunks
+        reduce inter-process overhead when there are many short runs.
+    progress : function, optional
+        Called as `progress(n_done, n_total)` each time a run completes.
+
+    Returns
+    -------
+    results : OrderedDict
+        Model output DataFrames in the order the parameter sets were given,
+        keyed by the tuple of values of the swept parameters (sorted by
+        parameter name).
+
+    """
+
+    if isinstance(params, dict):
+        param_sets = expand_grid(params)
+    else:
+        param_sets = [dict(p) for p in params]
+    names = sorted(set(name for p in param_sets for name in p))
+
+    all_kwargs = []
+    for p in param_sets:
+        kwargs = dict(base_kwargs or {})
+        kwargs.update(p)
+        all_kwargs.append(kwargs)
+
+    n_total = len(all_kwargs)
+    results = OrderedDict()
+
+    outputs = imap(run_one, all_kwargs, max_workers, chunksize)
+    for n_done, (p, output) in enumerate(zip(param_sets, outputs), 1):
+        results[param_key(p, names)] = output
+        if progress is not None:
+            progress(n_done, n_total)
+
+    return results
@@ -0,0 +1,249 @@
+""" Tidal forcing for the estuary model.
+
+A tidal forcing is a callable of time `t` in hours, which yields the rate of
+change of tidal height in m/hr and can be used as the `tide_func` of an
+`EstuaryModel`. Two kinds are provided here: one built from harmonic
+constituents, and one from a tabulated record such as a tide-gauge series.
+
+Rather than evaluating the forcing from scratch every time the model system
+of ODEs is evaluated, the model asks the forcing to `precompute` itself on a
+regular time grid covering the run before integrating. Subsequent calls are
+then answered by interpolating the cached array.
+
+Every forcing also has a `fingerprint`, a plain description of the values
+which define it, so that runs with the same forcing can be recognized (see
+`forcing_fingerprint`).
+
+"""
+
+import hashlib
+from types import FunctionType
+
+from numpy import (arange, array, asarray, cos, gradient, interp, pi, sin,
+                   zeros_like)
+
+#: Periods of the principal tidal constituents, in hours
+CONSTITUENT_PERIODS = dict(
+    M2=12.4206012, S2=12., N2=12.65834751, K2=11.96723606,
+    K1=23.93447213, O1=25.81933871, P1=24.06588766, Q1=26.868350,
+)
+
+INTERPOLATIONS = ('linear', 'cubic')
+
+
+class TidalForcing(object):
+
+    """ Base class for tidal forcings with a cached, gridded evaluation.
+
+    Parameters
+    ----------
+    interpolation : str
+        How to evaluate the forcing between the points of the cached grid;
+        either 'linear' or 'cubic' (Catmull-Rom spline)
+
+    """
+
+    def __init__(self, interpolation='linear'):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("Unknown interpolation '{}'; expected one of "
+                             "{}".format(interpolation,
+                                         ", ".join(INTERPOLATIONS)))
+        self.interpolation = interpolation
+        self._grid = None
+
+    def flow(self, t):
+        """ Rate of tidal height change in m/hr at time(s) `t` in hours,
+        evaluated exactly. """
+        raise NotImplementedError
+
+    def height(self, t):
+        """ Tidal height in m at time(s) `t` in hours. """
+        raise NotImplementedError
+
+    def fingerprint(self):
+        """ Description of the forcing, as a list of plain values, which is
+        equal for forcings which give the same flow. """
+        raise NotImplementedError
+
+    def precompute(self, t_end, dt, t_start=0.):
+        """ Evaluate the forcing on a regular grid from `t_start` to `t_end`
+        with spacing `dt`, and answer subsequent calls within that interval
+        by interpolating it. """
+        ts = t_start + dt*arange(int(round((t_end - t_start)/dt)) + 2)
+        values = asarray(self.flow(ts), dtype=float)
+        # Stored as a list for fast scalar indexing
+        self._grid = (t_start, 1./dt, values.tolist())
+
+    @property
+    def grid(self):
+        """ Times and values of the cached grid, or None. """
+        if self._grid is None:
+            return None
+        t_start, inv_dt, values = self._grid
+        return t_start + arange(len(values))/inv_dt, array(values)
+
+    def clear(self):
+        """ Discard the cached grid. """
+        self._grid = None
+
+    def __call__(self, t):
+        if self._grid is None:
+            return self.flow(t)
+
+        t_start, inv_dt, values = self._grid
+        x = (t - t_start)*inv_dt
+        i = int(x)
+        if x < 0 or i >= len(values) - 1:
+            return self.flow(t)
+        s = x - i
+
+        v1, v2 = values[i], values[i + 1]
+        if (self.interpolation == 'linear' or i == 0 or
+                i >= len(values) - 2):
+            return v1 + s*(v2 - v1)
+
+        # Catmull-Rom spline through the neighbouring grid points
+        v0, v3 = values[i - 1], values[i + 2]
+        return v1 + 0.5*s*(v2 - v0 +
+                           s*(2.*v0 - 5.*v1 + 4.*v2 - v3 +
+                              s*(3.*(v1 - v2) + v3 - v0)))
+
+
+class HarmonicTide(TidalForcing):
+
+    """ Tide composed of harmonic constituents,
+
+        h(t) = mean_height + sum_i A_i cos(2 pi t / T_i - phi_i)
+
+    Parameters
+    ----------
+    constituents : dict or list of tuples
+        Constituents as a mapping from name (e.g. 'M2', see
+        `CONSTITUENT_PERIODS`) or period in hours to a tuple of amplitude
+        in m and phase in degrees, or a list of (name or period, amplitude,
+        phase) tuples
+    mean_height : float
+        Mean tidal height, in m
+    interpolation : str
+        See `TidalForcing`
+
+    """
+
+    def __init__(self, constituents, mean_height=0., interpolation='linear'):
+        super(HarmonicTide, self).__init__(interpolation)
+        if isinstance(constituents, dict):
+            constituents = [(k, ) + tuple(v) for k, v in
+                            sorted(constituents.items(), key=str)]
+
+        self.constituents = []
+        for name, amplitude, phase in constituents:
+            period = CONSTITUENT_PERIODS.get(name, name)
+            self.constituents.append((float(period), float(amplitude),
+                                      float(phase)))
+        self.mean_height = mean_height
+
+    def height(self, t):
+        t = asarray(t, dtype=float)
+        h = zeros_like(t) + self.mean_height
+        for period, amplitude, phase in self.constituents:
+            h = h + amplitude*cos(2.*pi*t/period - pi*phase/180.)
+        return h
+
+    def flow(self, t):
+        t = asarray(t, dtype=float)
+        dh_dt = zeros_like(t)
+        for period, amplitude, phase in self.constituents:
+            omega = 2.*pi/period
+            dh_dt = dh_dt - amplitude*omega*sin(omega*t - pi*phase/180.)
+        return dh_dt
+
+    def fingerprint(self):
+        # The mean height doesn't affect the flow
+        return [type(self).__name__, self.interpolation,
+                [list(c) for c in sorted(self.constituents)]]
+
+
+class TabulatedTide(TidalForcing):
+
+    """ Tide interpolated from a tabulated (e.g. observed) record.
+
+    Outside of the tabulated times, the tidal flow is zero.
+
+    Parameters
+    ----------
+    times : array of floats
+        Times of the record, in hours relative to the start of the model run
+    values : array of floats
+        Tidal heights in m, or rates of tidal height change in m/hr if
+        `kind` is 'flow'
+    kind : str
+        Either 'height' or 'flow'
+    interpolation : str
+        See `TidalForcing`
+
+    """
+
+    def __init__(self, times, values, kind='height', interpolation='linear'):
+        super(TabulatedTide, self).__init__(interpolation)
+        self.times = asarray(times, dtype=float)
+        values = asarray(values, dtype=float)
+        if kind == 'height':
+            self.heights = values
+            self.flows = gradient(values, self.times)
+        elif kind == 'flow':
+            self.heights = None
+            self.flows = values
+        else:
+            raise ValueError("Unknown kind '{}'; expected 'height' or "
+                             "'flow'".format(kind))
+
+    def height(self, t):
+        if self.heights is None:
+            raise ValueError("Tide was tabulated as flow, not height")
+        return interp(t, self.times, self.heights)
+
+    def flow(self, t):
+        return interp(t, self.times, self.flows, left=0., right=0.)
+
+    def fingerprint(self):
+        # A hash of the record, rather than the record itself
+        digest = hashlib.sha1(self.times.tobytes())
+        digest.update(self.flows.tobytes())
+        return [type(self).__name__, self.interpolation, digest.hexdigest()]
+
+
+def repeats_every(tide_func, period):
+    """ Whether a tidal forcing is known to repeat every `period` hours:
+    true of a `HarmonicTide` whose constituents' periods all divide it. """
+    if not isinstance(tide_func, HarmonicTide):
+        return False
+    for constituent_period, _, _ in tide_func.constituents:
+        cycles = period/constituent_period
+        if abs(cycles - round(cycles)) > 1e-6*cycles:
+            return False
+    return True
+
+
+def no_tidal_flow(t):
+    """ Tidal forcing of an estuary without tides. """
+    return 0.
+
+
+def forcing_fingerprint(tide_func):
+    """ Description of a tidal forcing as plain values, for recognizing
+    runs with the same forcing: the `fingerprint` of a `TidalForcing`, or
+    the name of a function defined at the top level of a module (such as
+    `estuary.basic_tidal_flow`). Other forcings, such as lambdas and
+    closures, can't be told apart, and give None. """
+    if isinstance(tide_func, TidalForcing):
+        try:
+            return tide_func.fingerprint()
+        except NotImplementedError:
+            return None
+    if isinstance(tide_func, FunctionType) and \
+            '<' not in tide_func.__qualname__:
+        # The same whether the module was imported from the `app` package
+        # or as a top-level module
+        module = tide_func.__module__.rsplit('.', 1)[-1]
+        return ['function', module, tide_func.__qualname__]
+    return None
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+""" Compare the compiled and pure-NumPy backends of EstuaryModel.run_model.
+
+For a range of scenarios, checks that the two backends give matching
+trajectories and reports the speed-up of the compiled kernel; exits with an
+error if they disagree. Requires Numba. Run from the top-level of the
+repository,
+
+$ python benchmarks/bench_backends.py
+
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from timeit import default_timer
+
+from numpy import allclose
+
+from app.estuary import EstuaryModel, basic_tidal_flow
+from app.kernels import HAS_NUMBA
+
+SCENARIOS = [
+    dict(),
+    dict(tide_func=basic_tidal_flow),
+    dict(tide_func=basic_tidal_flow, river_flow_rate=0.),
+    dict(tide_func=basic_tidal_flow, river_flow_rate=0.3, N_river=200.,
+         P=2., G=1.),
+]
+DTS = [1., 0.25, 0.05]
+T_END = 24*42.
+
+
+def run(backend, dt, **kwargs):
+    model = EstuaryModel(1e9, 35., 20., 231.2, **kwargs)
+    start = default_timer()
+    result = model.run_model(dt=dt, t_end=T_END, backend=backend)
+    return result, default_timer() - start
+
+
+if __name__ == "__main__":
+
+    if not HAS_NUMBA:
+        sys.exit("Numba is not installed")
+
+    # Compile the kernel before timing it
+    run('numba', 1.)
+
+    mismatched = 0
+    print("{:>8s} {:>6s} {:>10s} {:>10s} {:>8s}  {}".format(
+        "scenario", "dt", "numpy (s)", "numba (s)", "speedup", "match"))
+    for i, kwargs in enumerate(SCENARIOS):
+        for dt in DTS:
+            expected, t_numpy = run('numpy', dt, **kwargs)
+            actual, t_numba = run('numba', dt, **kwargs)
+            match = (expected.shape == actual.shape and
+                     allclose(expected.index, actual.index) and
+                     allclose(expected.values, actual.values,
+                              rtol=1e-9, atol=1e-9, equal_nan=True))
+            mismatched += not match
+            print("{:8d} {:6.2f} {:10.4f} {:10.4f} {:8.1f}  {}".format(
+                i, dt, t_numpy, t_numba, t_numpy/t_numba, match))
+
+    if mismatched:
+        sys.exit("{:d} runs did not match".format(mismatched))
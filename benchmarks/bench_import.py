@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Benchmark the time it takes to import the estuary model.
+
+Each import is timed in a fresh interpreter. The model should only need
+numpy and pandas; this exits with an error if importing it pulls in any of
+the plotting libraries. Run from the top-level of the repository,
+
+$ python benchmarks/bench_import.py
+
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+#: Modules which must not be imported as a side effect of importing the model
+PLOTTING_MODULES = ('matplotlib', 'seaborn', 'bokeh')
+
+MODULES = ['numpy', 'pandas', 'app.estuary', 'app.sweep']
+
+SCRIPT = """
+import sys
+from timeit import default_timer
+start = default_timer()
+import {module}
+elapsed = default_timer() - start
+loaded = [m for m in {plotting!r} if m in sys.modules]
+print(elapsed, ','.join(loaded))
+"""
+
+
+def time_import(module, repeat=5):
+    """ Best-of-`repeat` import time for `module` in a fresh interpreter,
+    along with any plotting modules which it imported. """
+    best, loaded = float('inf'), []
+    for _ in range(repeat):
+        script = SCRIPT.format(module=module, plotting=PLOTTING_MODULES)
+        out = subprocess.check_output([sys.executable, "-c", script],
+                                      cwd=ROOT, universal_newlines=True)
+        elapsed, loaded = out.split()[0], out.split()[1:]
+        best = min(best, float(elapsed))
+    return best, loaded
+
+
+if __name__ == "__main__":
+
+    failed = []
+    print("{:>12s} {:>10s}  {}".format("module", "time (ms)", "plotting"))
+    for module in MODULES:
+        elapsed, loaded = time_import(module)
+        print("{:>12s} {:10.1f}  {}".format(module, 1e3*elapsed,
+                                            ','.join(loaded) or '-'))
+        if loaded and module.startswith('app.'):
+            failed.append(module)
+
+    if failed:
+        sys.exit("Importing {} loaded plotting libraries".format(
+            ', '.join(failed)))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+""" Benchmark the size and serialization time of the app's plot updates.
+
+Compares the message payload Bokeh generates for `source.data` when it is
+given pandas Series of float64 (as the app originally did) against
+contiguous float32 NumPy arrays (as it does now), for model runs at a few
+timesteps. Requires Bokeh. Run from the top-level of the repository,
+
+$ python benchmarks/bench_payload.py
+
+"""
+
+import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from timeit import default_timer
+
+from numpy import ascontiguousarray
+
+from app.lattice import APP_MODEL_KWARGS, run_scenario
+
+COLUMNS = ['V', 'S', 'N', 'O', 'Z', 'day']
+DTS = [1., 0.25, 0.05]
+T_END = 24*42.
+
+
+def serialize(data):
+    """ Serialize a ColumnDataSource data dict as Bokeh would for a
+    document patch; returns the total size in bytes of the JSON content and
+    any binary buffers. """
+    try:
+        # Bokeh >= 3
+        from bokeh.core.serialization import Serializer
+        rep = Serializer().serialize(data)
+        content = json.dumps(rep.content, default=lambda buf: buf.id)
+        buffers = [buf.to_bytes() for buf in rep.buffers]
+    except ImportError:
+        from bokeh.util.serialization import transform_column_source_data
+        buffers = []
+        try:
+            rep = transform_column_source_data(data, buffers=buffers)
+        except TypeError:
+            # Bokeh < 0.13 has no binary buffers
+            rep = transform_column_source_data(data)
+        content = json.dumps(rep)
+        buffers = [buf for _, buf in buffers]
+    return len(content) + sum(len(buf) for buf in buffers)
+
+
+def old_data(results):
+    return dict((col, results[col]) for col in COLUMNS)
+
+
+def new_data(results):
+    return dict((col, ascontiguousarray(results[col].values, dtype='f4'))
+                for col in COLUMNS)
+
+
+def time_serialize(data, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = default_timer()
+        nbytes = serialize(data)
+        best = min(best, default_timer() - start)
+    return nbytes, best
+
+
+if __name__ == "__main__":
+
+    print("{:>6s} {:>7s} {:>12s} {:>10s} {:>12s} {:>10s}".format(
+        "dt", "rows", "series (kB)", "time (ms)", "f4 arr (kB)",
+        "time (ms)"))
+    for dt in DTS:
+        results = run_scenario(True, 0.05, 100., 3., 1., APP_MODEL_KWARGS,
+                               dict(dt=dt, t_end=T_END))
+        old_bytes, old_time = time_serialize(old_data(results))
+        new_bytes, new_time = time_serialize(new_data(results))
+        print("{:6.2f} {:7d} {:12.1f} {:10.2f} {:12.1f} {:10.2f}".format(
+            dt, len(results), old_bytes/1024., 1e3*old_time,
+            new_bytes/1024., 1e3*new_time))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+""" Benchmark the scaling of EstuaryModel.run_model with the number of steps.
+
+With preallocated trajectory storage, the cost of a run should grow linearly
+with the number of timesteps; the time per step printed here should stay
+roughly constant as the step count increases. Runs use the pure-NumPy
+integration (see bench_backends.py for the compiled kernel). Run from the
+top-level of the repository,
+
+$ python benchmarks/bench_run_model.py
+
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from timeit import default_timer
+
+from app.estuary import EstuaryModel, basic_tidal_flow
+
+T_END = 24*42.
+STEP_COUNTS = [1000, 2000, 4000, 8000, 16000]
+
+
+def time_run(n_steps, tide_func=basic_tidal_flow, repeat=3):
+    """ Best-of-`repeat` wall time for a run with `n_steps` timesteps. """
+    dt = T_END/n_steps
+    best = float('inf')
+    for _ in range(repeat):
+        model = EstuaryModel(1e9, 35., 20., 231.2, tide_func=tide_func)
+        start = default_timer()
+        model.run_model(dt=dt, t_end=T_END, backend='numpy')
+        best = min(best, default_timer() - start)
+    return best
+
+
+if __name__ == "__main__":
+
+    print("{:>8s} {:>10s} {:>14s}".format("steps", "total (s)",
+                                          "per step (us)"))
+    for n_steps in STEP_COUNTS:
+        elapsed = time_run(n_steps)
+        print("{:8d} {:10.3f} {:14.2f}".format(n_steps, elapsed,
+                                               1e6*elapsed/n_steps))
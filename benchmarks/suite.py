@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+""" Benchmark suite for the model core and the app's update path.
+
+The benchmarks are written in the style of airspeed velocity (asv): each
+`Time*` class has optional `params`/`param_names` and a `setup` method, and
+each of its `time_*` methods is timed for every combination of parameters.
+Raising NotImplementedError from `setup` skips a benchmark.
+
+Running this module times the whole suite (or the benchmarks whose names
+contain one of the `-k` filters) and appends the results as one JSON line
+to a history file, along with the commit, machine and library versions.
+Each result is compared to the previous run on the same machine, so that
+performance regressions show up before deploying. Run from the top-level
+of the repository,
+
+$ python benchmarks/suite.py
+$ python benchmarks/suite.py -k run_model --check
+
+"""
+
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from timeit import default_timer
+
+import numpy
+import pandas
+from numpy import ascontiguousarray, ceil
+
+from app.cache import ResultCache
+from app.calibrate import CALIBRATION_BOUNDS, Calibration
+from app.decimate import decimate
+from app.estuary import EstuaryModel, basic_tidal_flow
+from app.export import load_results
+from app.kernels import HAS_NUMBA
+from app.lattice import APP_MODEL_KWARGS, APP_RUN_KWARGS, run_scenario
+from app.metrics import RunMetrics
+from app.montecarlo import MonteCarlo
+from app.segmented import SegmentedEstuaryModel
+
+#: Default location of the results history, one JSON object per line
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "history.jsonl")
+
+FORCINGS = ['none', 'tide', 'river', 'both']
+
+#: App settings for the end-to-end benchmarks (tide, river flow, river N,
+#: G, P)
+APP_PARAMS = (True, 0.05, 100., 3., 1.)
+
+#: Display resolution and dtype of the app's plot data; see `app/main.py`
+DISPLAY_POINTS = 1200
+SOURCE_COLUMNS = ['V', 'S', 'N', 'O', 'Z', 'day']
+SOURCE_DTYPE = 'float32'
+
+
+def make_model(forcing):
+    """ Model at the app's default settings, with tides and/or river flow
+    enabled according to `forcing`. """
+    kwargs = dict(river_flow_rate=0.)
+    if forcing in ('tide', 'both'):
+        kwargs['tide_func'] = basic_tidal_flow
+    if forcing in ('river', 'both'):
+        kwargs['river_flow_rate'] = 0.05
+    return EstuaryModel(1e9, 35., 20., 231.2, **kwargs)
+
+
+def to_source_data(results, n_total):
+    """ Downsample model output and convert it to plot data as the app
+    does before updating its ColumnDataSource. """
+    n_out = int(ceil(DISPLAY_POINTS*len(results)/float(n_total)))
+    shown = decimate(results, max(n_out, 2))
+    return dict((col, ascontiguousarray(shown[col].values,
+                                        dtype=SOURCE_DTYPE))
+                for col in SOURCE_COLUMNS)
+
+
+class TimeEstuaryODE(object):
+
+    """ A single evaluation of the model system of ODEs. """
+
+    params = [FORCINGS]
+    param_names = ['forcing']
+
+    def setup(self, forcing):
+        self.model = make_model(forcing)
+        self.y = self.model.y0.copy()
+
+    def time_estuary_ode(self, forcing):
+        self.model.estuary_ode(self.y, 50.25, 1.)
+
+
+class TimeRunModel(object):
+
+    """ Complete model runs across timesteps, run lengths and forcings. """
+
+    params = [[1., 0.25], [24*7., 24*42.], FORCINGS, ['numpy', 'numba']]
+    param_names = ['dt', 't_end', 'forcing', 'backend']
+
+    def setup(self, dt, t_end, forcing, backend):
+        if backend == 'numba' and not HAS_NUMBA:
+            raise NotImplementedError("Numba is not installed")
+        self.model = make_model(forcing)
+
+    def time_run_model(self, dt, t_end, forcing, backend):
+        self.model.run_model(dt=dt, t_end=t_end, backend=backend)
+
+
+class TimeSegmentedRun(object):
+
+    """ Runs of the segmented model, whose cost should hardly grow with the
+    number of segments. """
+
+    params = [[10, 50, 200]]
+    param_names = ['n_segments']
+
+    def setup(self, n_segments):
+        self.model = SegmentedEstuaryModel(1e9, 35., 20., 231.2,
+                                           n_segments=n_segments,
+                                           tide_func=basic_tidal_flow)
+
+    def time_run_model(self, n_segments):
+        self.model.run_model(dt=1., t_end=24*42.)
+
+
+class TimeInstrumentedRun(object):
+
+    """ Overhead of recording `RunMetrics` for a pure-NumPy run. """
+
+    params = [[False, True]]
+    param_names = ['metrics']
+
+    def setup(self, metrics):
+        self.model = make_model('both')
+        self.metrics = RunMetrics() if metrics else None
+
+    def time_run_model(self, metrics):
+        self.model.run_model(dt=1., t_end=24*42., backend='numpy',
+                             metrics=self.metrics)
+
+
+class TimeMonteCarlo(object):
+
+    """ A small Monte Carlo study, run serially: batched ensemble runs and
+    the streaming statistics of their output. """
+
+    def setup(self):
+        self.study = MonteCarlo(
+            dict(G=('uniform', 1., 5.), P=('normal', 1., 0.2),
+                 N_river=('uniform', 50., 150.)),
+            base_kwargs=dict(V=1e9, S=35., N=20., O=231.2,
+                             tide_func=basic_tidal_flow),
+            max_workers=1, seed=0)
+
+    def time_run(self):
+        self.study.run(512, dt=1., t_end=24*7.)
+
+
+class TimeCalibrationBatch(object):
+
+    """ One generation of a calibration: the misfits of a population of
+    candidates, run serially as batches with the cache bypassed. """
+
+    def setup(self):
+        model = make_model('both')
+        results = model.run_model(dt=1., t_end=24*21.)
+        observations = results[['S', 'N', 'O']].iloc[6::6]
+        self.calibration = Calibration(
+            observations, max_workers=1,
+            base_kwargs=dict(V=1e9, S=35., N=20., O=231.2,
+                             tide_func=basic_tidal_flow))
+        bounds = numpy.array([CALIBRATION_BOUNDS[name]
+                              for name in self.calibration.names])
+        unit = numpy.random.RandomState(0).rand(40, len(bounds))
+        self.candidates = bounds[:, 0] + unit*(bounds[:, 1] - bounds[:, 0])
+
+    def time_misfit(self):
+        self.calibration.cache = ResultCache()
+        self.calibration.misfit(self.candidates)
+
+
+class TimePostProcess(object):
+
+    """ Shaping the raw trajectory of a fine-timestep run into the output
+    DataFrame, and adding the app's time column. """
+
+    def setup(self):
+        self.model = make_model('both')
+        self.results = self.model.run_model(dt=0.25, t_end=24*42.)
+
+    def time_to_frame(self):
+        self.model._to_frame(self.model.trajectory)
+
+    def time_add_day(self):
+        self.results['day'] = self.results.index/24.
+
+
+class TimeDecimate(object):
+
+    """ Downsampling the output of a fine-timestep run for display. """
+
+    params = [['minmax', 'lttb']]
+    param_names = ['method']
+
+    def setup(self, method):
+        self.results = run_scenario(*(APP_PARAMS + (APP_MODEL_KWARGS,
+                                                    dict(dt=0.25,
+                                                         t_end=24*42.))))
+
+    def time_decimate(self, method):
+        decimate(self.results, DISPLAY_POINTS, method=method)
+
+
+class TimeAppUpdate(object):
+
+    """ The app's "Run model" path end to end: getting the output of a run,
+    either by running the model or from the results cache, and updating the
+    plots' ColumnDataSource with it. """
+
+    params = [['run', 'cached']]
+    param_names = ['source']
+
+    def setup(self, source):
+        try:
+            from bokeh.models import ColumnDataSource
+        except ImportError:
+            raise NotImplementedError("Bokeh is not installed")
+        self.plot_source = ColumnDataSource(data=dict())
+        self.cache = ResultCache()
+        self.n_total = 1 + int(ceil(APP_RUN_KWARGS['t_end'] /
+                                    APP_RUN_KWARGS['dt']))
+        if source == 'cached':
+            load_results(*APP_PARAMS, cache=self.cache)
+
+    def time_update(self, source):
+        if source == 'run':
+            results = run_scenario(*(APP_PARAMS + (APP_MODEL_KWARGS,
+                                                   APP_RUN_KWARGS)))
+        else:
+            results = load_results(*APP_PARAMS, cache=self.cache)
+        self.plot_source.data = to_source_data(results, self.n_total)
+
+
+def iter_benchmarks(namespace):
+    """ Yield (name, class, method name, parameter dict) for every
+    benchmark and parameter combination defined in `namespace`. """
+    for cls_name in sorted(namespace):
+        cls = namespace[cls_name]
+        if not (cls_name.startswith('Time') and isinstance(cls, type)):
+            continue
+        param_names = getattr(cls, 'param_names', [])
+        combos = list(itertools.product(*getattr(cls, 'params', [])))
+        for method in sorted(m for m in dir(cls) if m.startswith('time_')):
+            for combo in combos:
+                yield ("{}.{}".format(cls_name, method), cls, method,
+                       dict(zip(param_names, combo)))
+
+
+def time_benchmark(cls, method, params, repeat=5, min_time=0.2):
+    """ Best and median time per call of a benchmark method, in seconds,
+    or None if it was skipped. Each of the `repeat` samples loops over the
+    method enough times to take at least `min_time` in total. """
+
+    bench = cls()
+    args = [params[name] for name in getattr(cls, 'param_names', [])]
+    try:
+        if hasattr(bench, 'setup'):
+            bench.setup(*args)
+    except NotImplementedError:
+        return None
+    func = getattr(bench, method)
+
+    # Warm up (e.g. compile kernels), and calibrate the number of loops
+    start = default_timer()
+    func(*args)
+    once = default_timer() - start
+    number = max(1, int(min_time/max(once, 1e-9)))
+
+    samples = []
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            func(*args)
+        samples.append((default_timer() - start)/number)
+
+    if hasattr(bench, 'teardown'):
+        bench.teardown(*args)
+
+    samples.sort()
+    return dict(best=samples[0], median=samples[len(samples)//2],
+                number=number, repeat=repeat)
+
+
+def benchmark_key(name, params):
+    """ Identifier of a benchmark and parameter combination. """
+    if not params:
+        return name
+    return "{}({})".format(name, ", ".join(
+        "{}={}".format(k, params[k]) for k in sorted(params)))
+
+
+def environment():
+    """ Description of the code and machine that benchmarks were run on. """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        commit=commit, machine=platform.node(),
+        platform=platform.platform(), python=platform.python_version(),
+        numpy=numpy.__version__, pandas=pandas.__version__,
+        numba=HAS_NUMBA,
+    )
+
+
+def read_history(path):
+    """ All recorded runs of the suite, oldest first. """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_results(history, machine):
+    """ Results of the latest recorded run on `machine`, by benchmark
+    key. """
+    for record in reversed(history):
+        if record['env']['machine'] == machine:
+            return dict((r['key'], r) for r in record['results'])
+    return {}
+
+
+parser = ArgumentParser(description=__doc__,
+                        formatter_class=RawTextHelpFormatter)
+parser.add_argument("-k", "--filter", action="append", default=[],
+                    help="Only run benchmarks whose names contain this "
+                         "string; may be repeated")
+parser.add_argument("--history", default=HISTORY_PATH,
+                    help="File to append results to (default: "
+                         "benchmarks/history.jsonl)")
+parser.add_argument("--no-save", action="store_true",
+                    help="Don't record the results in the history")
+parser.add_argument("--repeat", type=int, default=5,
+                    help="Number of timing samples per benchmark")
+parser.add_argument("--threshold", type=float, default=1.25,
+                    help="Slow-down relative to the previous run which is "
+                         "reported as a regression")
+parser.add_argument("--check", action="store_true",
+                    help="Exit with an error if any benchmark regressed")
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    env = environment()
+    previous = previous_results(read_history(args.history), env['machine'])
+
+    results, regressions = [], []
+    print("{:<80s} {:>12s} {:>8s}".format("benchmark", "time (us)",
+                                          "ratio"))
+    for name, cls, method, params in iter_benchmarks(dict(globals())):
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        key = benchmark_key(name, params)
+        timing = time_benchmark(cls, method, params, repeat=args.repeat)
+        if timing is None:
+            print("{:<80s} {:>12s}".format(key, "skipped"))
+            continue
+
+        result = dict(key=key, name=name, params=params, **timing)
+        results.append(result)
+
+        ratio = ""
+        if key in previous:
+            change = timing['best']/previous[key]['best']
+            ratio = "{:.2f}".format(change)
+            if change > args.threshold:
+                regressions.append(key)
+                ratio += " !"
+        print("{:<80s} {:12.2f} {:>8s}".format(key, 1e6*timing['best'],
+                                               ratio))
+
+    if not args.no_save and results:
+        record = dict(date=datetime.datetime.utcnow().isoformat(),
+                      env=env, results=results)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+        print("Results appended to {}".format(args.history))
+
+    if regressions:
+        print("{} benchmark(s) slowed down by more than {:g}x since the "
+              "previous run:".format(len(regressions), args.threshold))
+        for key in regressions:
+            print("  " + key)
+        if args.check:
+            sys.exit(1)
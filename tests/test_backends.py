@@ -0,0 +1,43 @@
+""" Tests that the compiled and pure-NumPy backends of
+`EstuaryModel.run_model` give the same trajectories. """
+
+import pytest
+from numpy import allclose
+
+from app.estuary import EstuaryModel, basic_tidal_flow
+from app.kernels import HAS_NUMBA
+
+pytestmark = pytest.mark.skipif(not HAS_NUMBA,
+                                reason="Numba is not installed")
+
+T_END = 24*14.
+
+
+def scalar_tide(t):
+    """ Tidal forcing which only works on scalar times. """
+    if t % 12. < 6.:
+        return 0.2
+    return -0.2
+
+
+def run(backend, dt, **kwargs):
+    model = EstuaryModel(1e9, 35., 20., 231.2, **kwargs)
+    return model.run_model(dt=dt, t_end=T_END, backend=backend)
+
+
+@pytest.mark.parametrize('dt', [1., 0.25, 0.05])
+@pytest.mark.parametrize('kwargs', [
+    dict(),
+    dict(tide_func=basic_tidal_flow),
+    dict(tide_func=basic_tidal_flow, river_flow_rate=0.),
+    dict(tide_func=basic_tidal_flow, river_flow_rate=0.3, N_river=200.,
+         P=2., G=1.),
+    dict(tide_func=scalar_tide),
+], ids=['none', 'tide', 'tide-no-river', 'tide-strong-river', 'scalar-tide'])
+def test_backends_match(kwargs, dt):
+    expected = run('numpy', dt, **kwargs)
+    actual = run('numba', dt, **kwargs)
+    assert expected.shape == actual.shape
+    assert allclose(expected.index, actual.index)
+    assert allclose(expected.values, actual.values, rtol=1e-9, atol=1e-9,
+                    equal_nan=True)
@@ -0,0 +1,48 @@
+""" Tests of the background execution of app model runs. """
+
+from concurrent.futures import Future
+
+from pandas import DataFrame
+
+from app import runner
+
+
+class ImmediateExecutor(object):
+
+    """ Executor which runs work as soon as it is submitted, so that the
+    callbacks of a run are called before `stream_in_background` returns:
+    the worst case of a worker thread picking the work up straight away. """
+
+    def submit(self, func):
+        future = Future()
+        future.set_result(func())
+        return future
+
+
+def test_callbacks_get_run_before_submit_returns(monkeypatch):
+    monkeypatch.setattr(runner, 'executor', ImmediateExecutor())
+    chunks = [DataFrame({'S': [1., 2.]}), DataFrame({'S': [3.]})]
+    calls = []
+
+    run = runner.stream_in_background(
+        iter(chunks),
+        on_chunk=lambda run, chunk: calls.append(('chunk', run, len(chunk))),
+        on_done=lambda run, results: calls.append(('done', run,
+                                                   len(results))))
+
+    assert calls == [('chunk', run, 2), ('chunk', run, 1), ('done', run, 3)]
+
+
+def test_cancelled_run_stops_calling_back(monkeypatch):
+    monkeypatch.setattr(runner, 'executor', ImmediateExecutor())
+    calls = []
+
+    def on_chunk(run, chunk):
+        calls.append(len(chunk))
+        run.cancel()
+
+    runner.stream_in_background(
+        iter([DataFrame({'S': [1.]}), DataFrame({'S': [2.]})]),
+        on_chunk=on_chunk, on_done=lambda run, results: calls.append('done'))
+
+    assert calls == [1]